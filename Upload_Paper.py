@@ -1,29 +1,16 @@
 from dataclasses import dataclass
 from io import BytesIO
-import json
 import os
 import subprocess
-from typing import Any
-import warnings
+import sys
 
 from huggingface_hub import HfApi
-from papermage.magelib import (
-    BlocksFieldName,
-    Box,
-    Document,
-    Metadata,
-    SentencesFieldName,
-    TokensFieldName,
-    WordsFieldName,
-)
-from papermage.predictors.word_predictors import make_text
-from papermage.utils.annotate import group_by
 import streamlit as st
 from streamlit_extras.st_keyup import st_keyup
 from streamlit_extras.stylable_container import stylable_container
 
 from app_config import app_config as config
-from papermage_components.hf_token_classification_predictor import HfTokenClassificationPredictor
+from papermage_components.job_queue import DONE, FAILED, QUEUED, RUNNING, Job, JobQueue
 from papermage_components.llm_completion_predictor import (
     AVAILABLE_LLMS,
     DEFAULT_MATERIALS_PROMPT,
@@ -31,8 +18,10 @@ from papermage_components.llm_completion_predictor import (
     get_prompt_generator,
     check_valid_key,
 )
-from papermage_components.materials_recipe import MaterialsRecipe, VILA_LABELS_MAP
-from interface_utils import CUSTOM_MODELS_KEY, PARSED_PAPER_FOLDER, EXPECTED_PARSE_LAYERS
+from interface_utils import (
+    CUSTOM_MODELS_KEY,
+    get_parsed_paper_filename,
+)
 from local_model_config import AVAILABLE_LOCAL_MODELS
 
 
@@ -41,6 +30,7 @@ st.set_page_config(layout="wide")
 ## resources
 
 UPLOADED_PDF_PATH = config["uploaded_pdf_path"]
+PAPER_JOBS_KEY = "paper_jobs"
 
 pagelink_style = """a[data-testid="stPageLink-NavLink"]
 {
@@ -68,6 +58,21 @@ class CustomModelInfo:
     def is_empty(self):
         return not (bool(self.token_predictors) or bool(self.llm_predictors))
 
+    def to_pipeline_config(self) -> dict:
+        """The models to run, in a form that can be passed to a background worker."""
+        return {
+            "local_predictors": sorted(self.local_predictors),
+            "token_predictors": sorted(self.token_predictors),
+            "llm_predictors": [
+                {
+                    "model_name": llm_predictor.model_name,
+                    "api_key": llm_predictor.api_key,
+                    "prompt_string": llm_predictor.prompt_string,
+                }
+                for llm_predictor in self.llm_predictors
+            ],
+        }
+
 
 def reset_custom_models():
     st.session_state[CUSTOM_MODELS_KEY] = CustomModelInfo(set(), set(), set())
@@ -76,21 +81,64 @@ def reset_custom_models():
 if CUSTOM_MODELS_KEY not in st.session_state:
     st.session_state[CUSTOM_MODELS_KEY] = CustomModelInfo(set(), set(), set())
 
+if PAPER_JOBS_KEY not in st.session_state:
+    # job IDs are kept in the URL too, so progress can still be followed after a refresh.
+    st.session_state[PAPER_JOBS_KEY] = st.query_params.get_all("job")
+
 
 @st.cache_resource
-def get_recipe():
-    recipe = MaterialsRecipe(
-        # matIE_directory="/Users/sireeshgururaja/src/MatIE",
-        grobid_server_url=config["grobid_url"],
-        gpu_id="mps",
-        dpi=150,
-    )
-    return recipe
+def get_job_queue():
+    return JobQueue(config["job_queue_path"])
+
+
+def launch_paper_workers() -> subprocess.Popen:
+    """Start the background workers that process uploaded papers. The workers exit when the app
+    does. Their output goes to a log file, so the app can show why they stopped."""
+    os.makedirs(os.path.dirname(config["paper_worker_log_path"]), exist_ok=True)
+    with open(config["paper_worker_log_path"], "w") as log_file:
+        return subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "paper_worker.py"),
+                f"--num_workers={config['paper_worker_count']}",
+                f"--parent_pid={os.getpid()}",
+            ],
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+        )
 
 
 @st.cache_resource
-def get_hf_tagger(model_name):
-    return HfTokenClassificationPredictor(model_name, device="cpu")
+def get_paper_workers() -> dict:
+    """The background workers, started once per app process. They're kept in a dict, so they can
+    be restarted if they stop."""
+    return {"process": launch_paper_workers() if config["start_paper_workers"] else None}
+
+
+get_paper_workers()
+
+
+def read_log_tail(path: str, max_bytes: int = 4000) -> str:
+    with open(path, "rb") as f:
+        f.seek(max(0, os.path.getsize(path) - max_bytes))
+        return f.read().decode("utf-8", errors="replace")
+
+
+def show_worker_status() -> None:
+    """If the background workers have stopped, say so, with their last output, as queued papers
+    won't be processed until they're restarted."""
+    workers = get_paper_workers()
+    process = workers["process"]
+    if process is None or process.poll() is None:
+        return
+    st.error(
+        f"The paper workers stopped (exit code {process.returncode}), so queued papers won't be"
+        " processed until they're restarted."
+    )
+    st.code(read_log_tail(config["paper_worker_log_path"]))
+    if st.button("Restart workers"):
+        workers["process"] = launch_paper_workers()
+        st.rerun()
 
 
 def validate_and_add_llm(model_name: str, api_key: str, prompt_string: str) -> None:
@@ -98,6 +146,7 @@ def validate_and_add_llm(model_name: str, api_key: str, prompt_string: str) -> N
         model_name=model_name,
         api_key=api_key,
         prompt_generator_function=get_prompt_generator(prompt_string),
+        prompt_string=prompt_string,
     )
 
     validation_result = llm_predictor.validate()
@@ -107,94 +156,52 @@ def validate_and_add_llm(model_name: str, api_key: str, prompt_string: str) -> N
         st.error(validation_result.failure_message)
 
 
-def process_paper(uploaded_paper: BytesIO, container: Any) -> None:
-    with container:
-        if uploaded_paper is not None:
-            bytes_data = uploaded_paper.read()
-            paper_filename = os.path.join(UPLOADED_PDF_PATH, uploaded_paper.name)
-            with open(paper_filename, "wb") as f:
-                f.write(bytes_data)
-            recipe = get_recipe()
-
-            try:
-                parsed_paper = parse_pdf(paper_filename, recipe)
-            except Exception as e:
-                st.error(
-                    "Your paper failed to parse. Please contact the developers,"
-                    " or try a different paper."
-                )
-                return
-
-            for local_predictor in st.session_state[CUSTOM_MODELS_KEY].local_predictors:
-                with st.status(f"Running model {local_predictor}") as model_status:
-                    try:
-                        predictor = AVAILABLE_LOCAL_MODELS[local_predictor].get_model()
-                        model_entities = predictor.predict(parsed_paper)
-                        parsed_paper.annotate_layer(predictor.preferred_layer_name, model_entities)
-
-                        if getattr(predictor, "entity_types", None):
-                            if "entity_types" not in parsed_paper.metadata:
-                                parsed_paper.metadata["entity_types"] = {}
-                            parsed_paper.metadata["entity_types"][
-                                predictor.predictor_identifier
-                            ] = predictor.entity_types
-                    except Exception as e:
-                        st.write(e)
-                        model_status.update(state="error")
-
-            for token_predictor in st.session_state[CUSTOM_MODELS_KEY].token_predictors:
-                with st.status(f"Running model {token_predictor}") as model_status:
-                    try:
-                        predictor = get_hf_tagger(token_predictor)
-                        model_entities = predictor.predict(parsed_paper)
-                        parsed_paper.annotate_layer(predictor.preferred_layer_name, model_entities)
-                        if "entity_types" not in parsed_paper.metadata:
-                            parsed_paper.metadata["entity_types"] = {}
-                        parsed_paper.metadata["entity_types"][
-                            predictor.predictor_identifier
-                        ] = predictor.entity_types
-                    except Exception as e:
-                        st.write(e)
-                        model_status.update(state="error")
-
-            for llm_predictor in st.session_state[CUSTOM_MODELS_KEY].llm_predictors:
-                with st.status(f"Generating responses from {llm_predictor.predictor_identifier}"):
-                    try:
-                        model_entities = llm_predictor.predict(parsed_paper)
-                        parsed_paper.annotate_layer(
-                            llm_predictor.preferred_layer_name, model_entities
-                        )
-                    except Exception as e:
-                        st.write(e)
-                        model_status.update(state="error")
-
-            with st.status("Finishing up...") as write_status:
-                try:
-                    paper_dict = parsed_paper.to_json()
-                    paper_json = json.dumps(paper_dict, indent=4)
-                    with open(
-                        os.path.join(
-                            PARSED_PAPER_FOLDER, uploaded_paper.name.replace("pdf", "json")
-                        ),
-                        "w",
-                    ) as f:
-                        f.write(paper_json)
-                except Exception as e:
-                    st.write(e)
-                    write_status.update(
-                        state="error",
-                        label="Processed file failed to serialize. Try again, or contact the devs.",
-                    )
-
-                    return
-
-            st.session_state["focus_document"] = uploaded_paper.name.replace("pdf", "json")
+def process_papers(uploaded_papers: list[BytesIO]) -> None:
+    """Save the uploaded papers and queue them for processing by the background workers, which
+    process several papers at once."""
+    pipeline_config = st.session_state[CUSTOM_MODELS_KEY].to_pipeline_config()
+    for uploaded_paper in uploaded_papers or []:
+        bytes_data = uploaded_paper.read()
+        paper_filename = os.path.join(UPLOADED_PDF_PATH, uploaded_paper.name)
+        with open(paper_filename, "wb") as f:
+            f.write(bytes_data)
+
+        job_id = get_job_queue().submit(
+            paper_filename, get_parsed_paper_filename(uploaded_paper.name), pipeline_config
+        )
+        st.session_state[PAPER_JOBS_KEY].append(job_id)
+    st.query_params["job"] = st.session_state[PAPER_JOBS_KEY]
+
+
+STAGE_ICONS = {"running": "⏳", "complete": "✅", "error": "❌"}
+
+
+def show_job(job: Job) -> None:
+    paper_name = os.path.basename(job.pdf_path)
+    label, state = {
+        QUEUED: (f"{paper_name}: waiting for a worker...", "running"),
+        RUNNING: (f"{paper_name}: processing...", "running"),
+        DONE: (f"{paper_name}: done!", "complete"),
+        FAILED: (f"{paper_name}: failed", "error"),
+    }[job.status]
+
+    with st.status(label, state=state, expanded=job.status in (RUNNING, FAILED)):
+        for stage in job.stages:
+            st.write(f"{STAGE_ICONS[stage['state']]} {stage['label']}")
+            if stage["message"]:
+                st.caption(stage["message"])
+
+        if job.status == FAILED:
+            st.error(
+                "Your paper failed to parse. Please contact the developers,"
+                " or try a different paper."
+            )
+            st.code(job.error)
+        elif job.status == DONE:
             st.write(
-                "Done processing paper! Expand any failed sections above to see the stack trace."
+                "Done processing paper! Any models that failed are marked above, with their errors."
             )
-            st.balloons()
-
-            with stylable_container(key="page_link_style", css_styles=pagelink_style):
+            with stylable_container(key=f"page_link_style_{job.job_id}", css_styles=pagelink_style):
                 st.page_link(
                     "pages/1_Summary_View.py",
                     label="View Summary of Annotations",
@@ -202,109 +209,30 @@ def process_paper(uploaded_paper: BytesIO, container: Any) -> None:
                 )
 
 
-def parse_pdf(pdf, _recipe) -> Document:
-    parsed_doc_filename = os.path.join(
-        PARSED_PAPER_FOLDER, os.path.basename(pdf.replace("pdf", "json"))
-    )
-    if os.path.exists(parsed_doc_filename):
-        with st.status("Paper has already been parsed! Using cached version...") as status:
-            try:
-                with open(parsed_doc_filename) as f:
-                    doc = Document.from_json(json.load(f))
-                    for layer in doc.layers:
-                        if layer not in EXPECTED_PARSE_LAYERS:
-                            doc.remove_layer(layer)
-                    return doc
-            except Exception as e:
-                status.update(
-                    state="error",
-                    label="Failed to parse cached version. Parsing from scratch.",
-                )
-                raise e
-
-    with st.status("Parsing PDF...") as status:
-        try:
-            doc = _recipe.pdfplumber_parser.parse(input_pdf_path=pdf)
-        except Exception as e:
-            status.update(state="error")
-            st.write(e)
-            raise e
-
-    with st.status("Getting sections in reading order...") as status:
-        try:
-            doc = _recipe.grobid_order_parser.parse(
-                pdf,
-                doc,
-            )
-        except Exception as e:
-            status.update(state="error")
-            st.write(e)
-            raise e
-
-    with st.status("Rasterizing Document...") as status:
-        try:
-            images = _recipe.rasterizer.rasterize(input_pdf_path=pdf, dpi=_recipe.dpi)
-            doc.annotate_images(images=list(images))
-            _recipe.rasterizer.attach_images(images=images, doc=doc)
-        except Exception as e:
-            status.update(state="error")
-            st.write(e)
-            raise e
-
-    with st.status("Predicting words...") as status:
-        try:
-            words = _recipe.word_predictor.predict(doc=doc)
-            doc.annotate_layer(name=WordsFieldName, entities=words)
-        except Exception as e:
-            status.update(state="error")
-            st.write(e)
-            raise e
-
-    with st.status("Predicting sentences...") as status:
-        try:
-            sentences = _recipe.sent_predictor.predict(doc=doc)
-            doc.annotate_layer(name=SentencesFieldName, entities=sentences)
-        except Exception as e:
-            status.update(state="error")
-            st.write(e)
-            raise e
-
-    with st.status("Predicting blocks...") as status:
-        try:
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                blocks = _recipe.publaynet_block_predictor.predict(doc=doc)
-            doc.annotate_layer(name=BlocksFieldName, entities=blocks)
-        except Exception as e:
-            status.update(state="error")
-            st.write(e)
-            raise e
-
-    with st.status("Predicting vila...") as status:
-        try:
-            vila_entities = _recipe.ivila_predictor.predict(doc=doc)
-            doc.annotate_layer(name="vila_entities", entities=vila_entities)
-            for entity in vila_entities:
-                entity.boxes = [
-                    Box.create_enclosing_box(
-                        [
-                            b
-                            for t in doc.intersect_by_span(entity, name=TokensFieldName)
-                            for b in t.boxes
-                        ]
-                    )
-                ]
-                entity.text = make_text(entity=entity, document=doc)
-            preds = group_by(
-                entities=vila_entities, metadata_field="label", metadata_values_map=VILA_LABELS_MAP
-            )
-            doc.annotate(*preds)
-        except Exception as e:
-            status.update(state="error")
-            st.write(e)
-            raise e
+def show_paper_jobs(jobs: list[Job]) -> None:
+    finished_count = sum(job.is_finished for job in jobs)
+    if len(jobs) > 1:
+        st.progress(
+            finished_count / len(jobs), text=f"{finished_count} of {len(jobs)} papers processed"
+        )
+
+    celebrated_jobs = st.session_state.setdefault("celebrated_jobs", set())
+    for job in reversed(jobs):
+        show_job(job)
+        if job.status == DONE and job.job_id not in celebrated_jobs:
+            celebrated_jobs.add(job.job_id)
+            st.session_state["focus_document"] = job.output_filename
+            st.balloons()
+
 
-    return doc
+@st.experimental_fragment(run_every=2)
+def poll_paper_jobs() -> None:
+    jobs = get_job_queue().get_many(st.session_state[PAPER_JOBS_KEY])
+    if all(job.is_finished for job in jobs):
+        # stop polling once everything is done.
+        st.rerun()
+    show_worker_status()
+    show_paper_jobs(jobs)
 
 
 st.title("Welcome to Collage!")
@@ -401,11 +329,19 @@ with col1:
 
 with col2:
     st.write("## 2. Upload a file to process")
-    uploaded_file = st.file_uploader(
-        "Upload a paper to process.", type="pdf", accept_multiple_files=False
+    uploaded_files = st.file_uploader(
+        "Upload papers to process.", type="pdf", accept_multiple_files=True
     )
     st.button(
-        "Process uploaded paper",
-        on_click=process_paper,
-        kwargs={"uploaded_paper": uploaded_file, "container": col2},
+        "Process uploaded papers",
+        on_click=process_papers,
+        kwargs={"uploaded_papers": uploaded_files},
     )
+
+    if st.session_state[PAPER_JOBS_KEY]:
+        st.write("## 3. Processing progress")
+        jobs = get_job_queue().get_many(st.session_state[PAPER_JOBS_KEY])
+        if all(job.is_finished for job in jobs):
+            show_paper_jobs(jobs)
+        else:
+            poll_paper_jobs()
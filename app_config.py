@@ -4,11 +4,46 @@ import os
 app_config = {
     "uploaded_pdf_path": "data/uploaded_papers",
     "processed_paper_path": "data/processed_papers",
+    # ".npz" for the compact binary format, ".json" for plain JSON.
+    "processed_paper_suffix": ".npz",
+    # rasterized pages are stored here as separate image files, rather than inside the documents.
+    "page_image_path": "data/page_images",
+    # memory cap for the documents the views keep loaded, shared between all pages and sessions.
+    "document_cache_size_mb": int(os.environ.get("DOCUMENT_CACHE_SIZE_MB", 2048)),
+    # uploaded papers are queued here, and processed by background workers (see paper_worker.py).
+    "job_queue_path": "data/jobs.sqlite",
+    # the tables the Summary View shows for each paper, written as papers are processed (see
+    # papermage_components/document_summary.py).
+    "document_summary_path": "data/document_summaries",
+    # the entities tagged across all processed papers, for the Corpus Search page (see
+    # papermage_components/corpus_index.py); updated by the workers as papers are processed.
+    "corpus_index_path": "data/corpus_index.sqlite",
+    # the MatIE relations merged across all processed papers (see
+    # papermage_components/corpus_graph.py). Workers merge the papers they add once this many are
+    # waiting, as each merge rewrites the whole graph.
+    "corpus_graph_path": "data/corpus_graph",
+    "corpus_graph_merge_batch_size": int(os.environ.get("CORPUS_GRAPH_MERGE_BATCH_SIZE", 10)),
+    # set START_PAPER_WORKERS=0 if the workers are run separately.
+    "start_paper_workers": os.environ.get("START_PAPER_WORKERS", "1") != "0",
+    "paper_worker_count": int(os.environ.get("PAPER_WORKER_COUNT", 4)),
+    # the output of the workers the app starts, shown in the app if they stop.
+    "paper_worker_log_path": "data/paper_workers.log",
+    # how many papers may use each backend service at once, across all workers.
+    "backend_concurrency": {
+        "grobid": int(os.environ.get("GROBID_CONCURRENCY", 2)),
+        "matie": int(os.environ.get("MATIE_CONCURRENCY", 2)),
+        "chemdataextractor": int(os.environ.get("CHEMDATAEXTRACTOR_CONCURRENCY", 2)),
+    },
+    "backend_lock_path": "data/backend_locks",
     "llm_api_keys": {},
     "mathpix_credentials": {
         "app_id": os.environ.get("MATHPIX_APP_ID", ""),
         "app_key": os.environ.get("MATHPIX_APP_KEY", ""),
     },
+    "mathpix_url": os.environ.get("MATHPIX_URL", "https://api.mathpix.com/v3/text"),
+    # MathPix responses are kept here, keyed by table image, so tables aren't paid for twice.
+    "mathpix_cache_path": "data/mathpix_cache",
+    "mathpix_concurrency": int(os.environ.get("MATHPIX_CONCURRENCY", 8)),
     "grobid_url": os.environ.get("GROBID_URL", "http://localhost:8070"),
     "chemdataextractor_service_url": os.environ.get(
         "CHEMDATAEXTRACTOR_SERVICE_URL", "http://localhost:8000"
@@ -0,0 +1,161 @@
+"""
+Run models on papers that have already been processed, adding their layers to the stored papers.
+
+Only the given models are run, and only their layers are written to each paper (see
+`append_layers` in `papermage_components/serialization.py`); the other layers stored with the
+paper, including those tagged by other models, are kept as they are. The papers' summaries and
+the corpus index are updated with the new entities (and the corpus graph with MatIE's relations, if
+it was run). For example:
+
+    python apply_predictors.py --token_predictors '["some-org/some-ner-model"]' --num_workers 4
+"""
+
+from datetime import datetime
+import json
+import logging
+import os
+from typing import Optional
+
+import fire
+from papermage.predictors import BasePredictor
+from tqdm.auto import tqdm
+
+from app_config import app_config as config
+from paper_worker import CustomModel, get_custom_models, run_custom_model
+from papermage_components.corpus_graph import CorpusGraph
+from papermage_components.corpus_index import CorpusIndex
+from papermage_components.document_summary import write_document_summary
+from papermage_components.forked_workers import map_with_forked_workers
+from papermage_components.instrumentation import PipelineMetrics
+from papermage_components.relation_graph import MATIE_LAYER_NAME, get_document_graph
+from papermage_components.serialization import append_layers, list_documents, load_document
+
+
+def apply_to_paper(
+    shared_state: tuple[
+        list[tuple[CustomModel, BasePredictor]],
+        Optional[str],
+        bool,
+        Optional[str],
+        Optional[str],
+    ],
+    paper_path: str,
+) -> Optional[dict]:
+    """Run the models on a single paper, and append their layers to it, returning a description of
+    the error if it failed."""
+    models_and_predictors, pdf_folder, overwrite, corpus_index_path, corpus_graph_path = (
+        shared_state
+    )
+    try:
+        paper = load_document(paper_path, lazy=True)
+        pdf_path = None
+        if pdf_folder is not None:
+            pdf_path = os.path.join(
+                pdf_folder, os.path.splitext(os.path.basename(paper_path))[0] + ".pdf"
+            )
+            if not os.path.exists(pdf_path):
+                pdf_path = None
+
+        metrics = PipelineMetrics()
+        new_layers = []
+        for custom_model, predictor in models_and_predictors:
+            if predictor.preferred_layer_name in paper.layers and not overwrite:
+                continue
+            with metrics.stage(custom_model.name, paper):
+                new_layers.extend(
+                    run_custom_model(paper, pdf_path, predictor, custom_model.backend)
+                )
+
+        if new_layers:
+            metrics.attach(paper)
+            append_layers(paper, paper_path, new_layers)
+            write_document_summary(
+                paper, config["document_summary_path"], os.path.basename(paper_path)
+            )
+            if corpus_index_path is not None:
+                CorpusIndex(corpus_index_path).index_document(
+                    os.path.basename(paper_path), paper, os.path.getmtime(paper_path)
+                )
+            if corpus_graph_path is not None and MATIE_LAYER_NAME in new_layers:
+                CorpusGraph(corpus_graph_path).add_paper(
+                    os.path.basename(paper_path), get_document_graph(paper)
+                )
+    except Exception as e:
+        logging.error(f"Failed to apply models to {paper_path}", exc_info=True)
+        return {"filename": paper_path, "exception_type": str(type(e)), "error_message": str(e)}
+    return None
+
+
+def apply_predictors(
+    local_predictors: list[str] = (),
+    token_predictors: list[str] = (),
+    llm_predictors: list[dict] = (),
+    folder: str = config["processed_paper_path"],
+    pdf_folder: Optional[str] = None,
+    overwrite: bool = False,
+    num_workers: int = 1,
+    corpus_index_path: Optional[str] = config["corpus_index_path"],
+    corpus_graph_path: Optional[str] = config["corpus_graph_path"],
+):
+    """Run the given models on every processed paper in `folder`, appending their layers.
+
+    Parameters
+    ----------
+    local_predictors : Names of models in `local_model_config.py`.
+    token_predictors : HuggingFace token classification models.
+    llm_predictors : LLM configs, as in a job's pipeline config, with "model_name", "api_key" and
+        "prompt_string".
+    folder : The folder of processed papers.
+    pdf_folder : Where to find each paper's PDF, with the same name, for models that rasterize
+        pages at their own resolution. Otherwise they use the page images stored with the paper.
+    overwrite : Whether to run a model again on papers that already have its layer, replacing it.
+    num_workers : How many papers to process at once. The models are loaded once, and shared with
+        workers forked from this process.
+    corpus_index_path : The corpus index to update with the new entities, or None to leave it.
+    corpus_graph_path : The corpus graph to merge MatIE's new relations into, or None to leave it.
+    """
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    custom_models = get_custom_models(
+        {
+            "local_predictors": list(local_predictors),
+            "token_predictors": list(token_predictors),
+            "llm_predictors": list(llm_predictors),
+        }
+    )
+    if not custom_models:
+        raise ValueError("No models given!")
+    models_and_predictors = [
+        (custom_model, custom_model.get_predictor()) for custom_model in custom_models
+    ]
+
+    paper_paths = [
+        os.path.join(folder, filename)
+        for filename in list_documents(folder, config["processed_paper_suffix"])
+    ]
+
+    shared_state = (
+        models_and_predictors, pdf_folder, overwrite, corpus_index_path, corpus_graph_path
+    )
+    if num_workers > 1:
+        results = map_with_forked_workers(apply_to_paper, shared_state, paper_paths, num_workers)
+    else:
+        results = (apply_to_paper(shared_state, paper_path) for paper_path in paper_paths)
+    failed_files = [result for result in tqdm(results, total=len(paper_paths)) if result is not None]
+    if corpus_graph_path is not None:
+        CorpusGraph(corpus_graph_path).merge()
+
+    with open(f"data/failed_applied_models_{timestamp}.json", "w") as f:
+        json.dump(
+            {
+                "folder": folder,
+                "models": [custom_model.name for custom_model in custom_models],
+                "errors": failed_files,
+            },
+            f,
+            indent=4,
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    fire.Fire(apply_predictors)
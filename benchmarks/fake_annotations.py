@@ -0,0 +1,77 @@
+"""
+Deterministic fake annotations, shared by the in-process stand-ins (`stand_ins.py`) and the replay
+servers (`replay_servers.py`). They come from simple regular expressions, and only depend on the
+standard library, so the servers can run without any of the pipeline's models installed.
+"""
+
+import re
+
+# formulae with at least two elements and a count, e.g. TiO2 or Ni3Al.
+CHEMICAL_RE = re.compile(r"\b(?=\w*\d)(?:[A-Z][a-z]?\d*){2,}\b")
+NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+UNIT_RE = re.compile(r"(?:MPa|GPa|°C|µm|h|%)(?!\w)")
+# how MatIE's tokenizer splits text: words, numbers with their decimals, and punctuation.
+MATIE_TOKEN_RE = re.compile(r"\w+(?:\.\d+)?|[^\w\s]")
+
+
+def tokenize_like_matie(text: str) -> str:
+    return " ".join(MATIE_TOKEN_RE.findall(text))
+
+
+def tag_like_matie(tokenized_text: str) -> list[dict]:
+    entities = []
+    for pattern, entity_type in [
+        (CHEMICAL_RE, "Material"),
+        (NUMBER_RE, "Number"),
+        (UNIT_RE, "Amount_Unit"),
+    ]:
+        for match in pattern.finditer(tokenized_text):
+            entities.append((match.start(), match.end(), entity_type, match.group()))
+    return [
+        {
+            "id": f"T{index + 1}",
+            "entity_type": entity_type,
+            "start": start,
+            "end": end,
+            "entity_string": entity_string,
+        }
+        for index, (start, end, entity_type, entity_string) in enumerate(sorted(entities))
+    ]
+
+
+def annotate_like_matie(document_payload: dict[str, str]) -> dict:
+    """A response in the MatIE service's format: like the service, each paragraph is re-tokenized,
+    and entity offsets are into the re-tokenized text."""
+    annotated_content = {}
+    for key, paragraph_text in document_payload.items():
+        tokenized_text = tokenize_like_matie(paragraph_text)
+        annotated_content[key] = {
+            "text": tokenized_text,
+            "entities": tag_like_matie(tokenized_text),
+            "relations": [],
+        }
+    return annotated_content
+
+
+def annotate_like_chemdataextractor(strings: list[str]) -> list[list[dict]]:
+    """A response in the ChemDataExtractor service's format."""
+    return [
+        [
+            {
+                "text": match.group(),
+                "start_char": match.start(),
+                "end_char": match.end(),
+                "entity_type": "CDE_Chemical",
+            }
+            for match in CHEMICAL_RE.finditer(text)
+        ]
+        for text in strings
+    ]
+
+
+def summarize_like_llm(text: str) -> dict:
+    return {
+        "materials": sorted(set(CHEMICAL_RE.findall(text))),
+        "values": NUMBER_RE.findall(text),
+        "num_words": len(text.split()),
+    }
@@ -0,0 +1,481 @@
+"""
+Offline stand-in servers for GROBID, MatIE, ChemDataExtractor and MathPix.
+
+Each server speaks the same HTTP API as the service it replaces, so the real clients
+(`GrobidReadingOrderParser`, `MatIEServicePredictor`, `ChemDataExtractorPredictor`,
+`MathPixTableStructurePredictor`) can be pointed at it unchanged. Responses are, in order of
+preference:
+
+1. recorded GROBID output, found by the uploaded PDF's name in `xml_dirs` (e.g. `data/grobid_xml`);
+2. responses recorded from the real service (see `record_from`), keyed by a hash of the request;
+3. deterministic fake annotations (see `fake_annotations.py`).
+
+To see how the clients behave when a backend is slow or overloaded, each server can inject latency
+and errors, and cap how many requests it handles at once, either queueing or rejecting the rest.
+None of the pipeline's models or dependencies are needed to run them:
+
+    python -m benchmarks.replay_servers --latency 0.5 --error_rate 0.05 \\
+        --matie '{"latency": 3, "max_concurrency": 1}'
+
+and then, e.g., `GROBID_URL=http://localhost:8070 MATIE_SERVICE_URL=http://localhost:8003
+CHEMDATAEXTRACTOR_SERVICE_URL=http://localhost:8000 MATHPIX_URL=http://localhost:8004/v3/text`
+for the app. Each server reports what it has served at `/replay_stats`.
+"""
+
+from dataclasses import asdict, dataclass, fields, replace
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from typing import Optional
+import urllib.error
+import urllib.request
+
+import fire
+
+from benchmarks.fake_annotations import annotate_like_chemdataextractor, annotate_like_matie
+
+DEFAULT_PORTS = {"grobid": 8070, "chemdataextractor": 8000, "matie": 8003, "mathpix": 8004}
+RECORDING_DIR = "data/replay_recordings"
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ReplayBehavior:
+    """How a replay server misbehaves.
+
+    latency : Seconds to wait before answering each request.
+    latency_jitter : Up to this many seconds, chosen uniformly at random, added to `latency`.
+    error_rate : The fraction of requests answered with `error_status` instead.
+    error_status : The HTTP status of injected errors.
+    max_concurrency : How many requests are handled at once; None for no limit.
+    reject_when_busy : Answer requests beyond `max_concurrency` with 503 (as GROBID does) rather
+        than queueing them.
+    seed : Seeds the random latency and errors, so runs are reproducible.
+    """
+
+    latency: float = 0.0
+    latency_jitter: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 500
+    max_concurrency: Optional[int] = None
+    reject_when_busy: bool = False
+    seed: int = 0
+
+
+@dataclass
+class ReplayStats:
+    requests: int = 0
+    replayed: int = 0
+    faked: int = 0
+    recorded: int = 0
+    injected_errors: int = 0
+    rejected: int = 0
+    # responses the client had stopped waiting for.
+    abandoned: int = 0
+    in_flight: int = 0
+    max_in_flight: int = 0
+
+
+@dataclass
+class ReplayResponse:
+    status: int
+    content_type: str
+    body: bytes
+    # where the response came from, for the stats: "replayed", "faked" or "recorded".
+    source: str = "faked"
+
+
+def json_response(content, source: str = "faked") -> ReplayResponse:
+    return ReplayResponse(200, "application/json", json.dumps(content).encode("utf-8"), source)
+
+
+def find_recorded_grobid_xml(xml_dirs: list[str], pdf_name: str) -> Optional[str]:
+    """The saved GROBID output for a PDF, e.g. `paper.xml` for `paper.pdf`, if any."""
+    xml_name = os.path.splitext(os.path.basename(pdf_name))[0] + ".xml"
+    for xml_dir in xml_dirs:
+        xml_path = os.path.join(xml_dir, xml_name)
+        if os.path.exists(xml_path):
+            return xml_path
+    return None
+
+
+class RecordedResponses:
+    """Responses from a real service, stored as one JSON file per request, keyed by a hash of the
+    request's path and body."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, path: str, body: bytes) -> str:
+        request_hash = hashlib.sha256(path.encode("utf-8") + b"\0" + body).hexdigest()
+        return os.path.join(self.directory, f"{request_hash}.json")
+
+    def get(self, path: str, body: bytes) -> Optional[ReplayResponse]:
+        recording_path = self._path(path, body)
+        if not os.path.exists(recording_path):
+            return None
+        with open(recording_path) as f:
+            recording = json.load(f)
+        return ReplayResponse(
+            recording["status"],
+            recording["content_type"],
+            recording["body"].encode("utf-8"),
+            source="replayed",
+        )
+
+    def put(self, path: str, body: bytes, response: ReplayResponse) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        recording = {
+            "status": response.status,
+            "content_type": response.content_type,
+            "body": response.body.decode("utf-8"),
+        }
+        with open(self._path(path, body), "w") as f:
+            json.dump(recording, f)
+
+
+class ReplayBackend:
+    """The API of one service. Subclasses answer the service's routes with `respond`, falling back
+    to `fake` when nothing was recorded."""
+
+    name: str = ""
+    # GET routes that report the service is up.
+    status_routes: tuple[str, ...] = ("/status",)
+
+    def __init__(self, recordings: Optional[RecordedResponses] = None):
+        self.recordings = recordings
+
+    def respond(self, path: str, headers: dict, body: bytes) -> ReplayResponse:
+        if self.recordings is not None:
+            recorded = self.recordings.get(path, body)
+            if recorded is not None:
+                return recorded
+        return self.fake(path, headers, body)
+
+    def fake(self, path: str, headers: dict, body: bytes) -> ReplayResponse:
+        return ReplayResponse(404, "text/plain", f"No route {path}".encode("utf-8"))
+
+
+class GrobidBackend(ReplayBackend):
+    name = "grobid"
+    status_routes = ("/api/isalive",)
+
+    def __init__(self, xml_dirs: list[str], recordings: Optional[RecordedResponses] = None):
+        super().__init__(recordings)
+        self.xml_dirs = xml_dirs
+
+    def respond(self, path: str, headers: dict, body: bytes) -> ReplayResponse:
+        # the GROBID client uploads the PDF as a multipart form field named "input", with the
+        # PDF's path as its filename.
+        filename_match = re.search(rb'name="input"; filename="([^"]*)"', body)
+        if path.startswith("/api/process") and filename_match:
+            pdf_name = filename_match.group(1).decode("utf-8", errors="replace")
+            xml_path = find_recorded_grobid_xml(self.xml_dirs, pdf_name)
+            if xml_path is not None:
+                with open(xml_path, "rb") as f:
+                    return ReplayResponse(200, "application/xml", f.read(), source="replayed")
+        return super().respond(path, headers, body)
+
+    def fake(self, path: str, headers: dict, body: bytes) -> ReplayResponse:
+        # GROBID has nothing to say about a PDF it can't process.
+        return ReplayResponse(204, "application/xml", b"")
+
+
+class MatIEBackend(ReplayBackend):
+    name = "matie"
+
+    def fake(self, path: str, headers: dict, body: bytes) -> ReplayResponse:
+        if path != "/annotate_strings":
+            return super().fake(path, headers, body)
+        return json_response(annotate_like_matie(json.loads(body)))
+
+
+class ChemDataExtractorBackend(ReplayBackend):
+    name = "chemdataextractor"
+
+    def fake(self, path: str, headers: dict, body: bytes) -> ReplayResponse:
+        if path != "/annotate_strings":
+            return super().fake(path, headers, body)
+        return json_response(annotate_like_chemdataextractor(json.loads(body)))
+
+
+class MathPixBackend(ReplayBackend):
+    name = "mathpix"
+    status_routes = ()
+
+    def fake(self, path: str, headers: dict, body: bytes) -> ReplayResponse:
+        if path != "/v3/text":
+            return super().fake(path, headers, body)
+        # a small table, different for each image.
+        values = list(hashlib.sha256(body).digest()[:4])
+        tsv = "value\tindex\n" + "".join(f"{v}\t{i}\n" for i, v in enumerate(values))
+        latex = (
+            "\\begin{tabular}{ll}\nvalue & index \\\\\n"
+            + "".join(f"{v} & {i} \\\\\n" for i, v in enumerate(values))
+            + "\\end{tabular}"
+        )
+        return json_response({"text": latex, "data": [{"type": "tsv", "value": tsv}]})
+
+
+class ReplayServer:
+    """Serves one backend over HTTP, on its own thread, injecting the configured misbehavior. Port
+    0 picks a free port; see `url`."""
+
+    def __init__(
+        self,
+        backend: ReplayBackend,
+        behavior: Optional[ReplayBehavior] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        record_from: Optional[str] = None,
+    ):
+        self.backend = backend
+        self.behavior = behavior or ReplayBehavior()
+        self.record_from = record_from
+        self.stats = ReplayStats()
+        self._stats_lock = threading.Lock()
+        self._random = random.Random(self.behavior.seed)
+        self._slots = (
+            threading.BoundedSemaphore(self.behavior.max_concurrency)
+            if self.behavior.max_concurrency
+            else None
+        )
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "ReplayServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"Replaying {self.backend.name} at {self.url}")
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "ReplayServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _count(self, **increments: int) -> None:
+        with self._stats_lock:
+            for stat, increment in increments.items():
+                setattr(self.stats, stat, getattr(self.stats, stat) + increment)
+            self.stats.max_in_flight = max(self.stats.max_in_flight, self.stats.in_flight)
+
+    def _draw(self) -> tuple[float, bool]:
+        """The latency of the next request, and whether it fails."""
+        with self._stats_lock:
+            latency = self.behavior.latency + self._random.uniform(0, self.behavior.latency_jitter)
+            fails = self._random.random() < self.behavior.error_rate
+        return latency, fails
+
+    def _record(self, path: str, headers: dict, body: bytes) -> ReplayResponse:
+        request = urllib.request.Request(
+            self.record_from.rstrip("/") + path,
+            data=body,
+            headers={key: headers[key] for key in ("Content-Type", "Accept") if key in headers},
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=600) as upstream:
+                status, content_type, response_body = (
+                    upstream.status,
+                    upstream.headers.get("Content-Type", "application/octet-stream"),
+                    upstream.read(),
+                )
+        except urllib.error.HTTPError as e:
+            status, content_type, response_body = e.code, "text/plain", e.read()
+        response = ReplayResponse(status, content_type, response_body, source="recorded")
+        if status == 200 and self.backend.recordings is not None:
+            self.backend.recordings.put(path, body, response)
+        return response
+
+    def handle_post(self, path: str, headers: dict, body: bytes) -> ReplayResponse:
+        self._count(requests=1)
+        if self._slots is not None:
+            if not self._slots.acquire(blocking=not self.behavior.reject_when_busy):
+                self._count(rejected=1)
+                return ReplayResponse(503, "text/plain", b"Service busy")
+        self._count(in_flight=1)
+        try:
+            latency, fails = self._draw()
+            time.sleep(latency)
+            if fails:
+                self._count(injected_errors=1)
+                return ReplayResponse(self.behavior.error_status, "text/plain", b"Injected error")
+
+            response = self.backend.respond(path, headers, body)
+            if self.record_from and response.source == "faked":
+                response = self._record(path, headers, body)
+            self._count(**{response.source: 1})
+            return response
+        finally:
+            self._count(in_flight=-1)
+            if self._slots is not None:
+                self._slots.release()
+
+    def _make_handler(self):
+        server = self
+
+        class ReplayRequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # otherwise, on kept-alive connections, the body waits on the client's delayed ACK of
+            # the headers.
+            disable_nagle_algorithm = True
+
+            def _send(self, response: ReplayResponse) -> None:
+                try:
+                    self.send_response(response.status)
+                    self.send_header("Content-Type", response.content_type)
+                    self.send_header("Content-Length", str(len(response.body)))
+                    self.end_headers()
+                    self.wfile.write(response.body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up waiting, e.g. it timed out while latency was injected.
+                    server._count(abandoned=1)
+                    self.close_connection = True
+
+            def do_GET(self):
+                if self.path == "/replay_stats":
+                    with server._stats_lock:
+                        self._send(json_response(asdict(server.stats)))
+                elif self.path in server.backend.status_routes or self.path == "/":
+                    self._send(ReplayResponse(200, "application/json", b'"Service is up!"'))
+                else:
+                    self._send(ReplayResponse(404, "text/plain", b"Not found"))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self._send(server.handle_post(self.path, dict(self.headers), body))
+
+            def log_message(self, format, *args):
+                logger.debug(f"{server.backend.name}: {format % args}")
+
+        return ReplayRequestHandler
+
+
+def make_backends(xml_dirs: list[str], recording_dir: Optional[str]) -> dict[str, ReplayBackend]:
+    def recordings(name):
+        return RecordedResponses(os.path.join(recording_dir, name)) if recording_dir else None
+
+    return {
+        "grobid": GrobidBackend(xml_dirs, recordings("grobid")),
+        "matie": MatIEBackend(recordings("matie")),
+        "chemdataextractor": ChemDataExtractorBackend(recordings("chemdataextractor")),
+        "mathpix": MathPixBackend(recordings("mathpix")),
+    }
+
+
+def start_replay_servers(
+    behaviors: Optional[dict[str, ReplayBehavior]] = None,
+    xml_dirs: Optional[list[str]] = None,
+    recording_dir: Optional[str] = RECORDING_DIR,
+    ports: Optional[dict[str, int]] = None,
+    host: str = "127.0.0.1",
+    record_from: Optional[dict[str, str]] = None,
+) -> dict[str, ReplayServer]:
+    """Start a replay server for each backend, by default on free ports. Stop them with `stop`."""
+    behaviors = behaviors or {}
+    ports = ports or {}
+    record_from = record_from or {}
+    backends = make_backends(xml_dirs or ["data/grobid_xml"], recording_dir)
+    return {
+        name: ReplayServer(
+            backend,
+            behaviors.get(name),
+            host=host,
+            port=ports.get(name, 0),
+            record_from=record_from.get(name),
+        ).start()
+        for name, backend in backends.items()
+    }
+
+
+def run_replay_servers(
+    latency: float = 0.0,
+    latency_jitter: float = 0.0,
+    error_rate: float = 0.0,
+    error_status: int = 500,
+    max_concurrency: Optional[int] = None,
+    reject_when_busy: bool = False,
+    seed: int = 0,
+    grobid: Optional[dict] = None,
+    matie: Optional[dict] = None,
+    chemdataextractor: Optional[dict] = None,
+    mathpix: Optional[dict] = None,
+    xml_dir: str = "data/grobid_xml",
+    recording_dir: str = RECORDING_DIR,
+    record_from: Optional[dict] = None,
+    host: str = "127.0.0.1",
+):
+    """Run replay servers for all four backends, on their usual ports (GROBID 8070,
+    ChemDataExtractor 8000, MatIE 8003, MathPix 8004), until interrupted.
+
+    Parameters
+    ----------
+    latency, latency_jitter, error_rate, error_status, max_concurrency, reject_when_busy, seed :
+        The misbehavior of every server; see `ReplayBehavior`.
+    grobid, matie, chemdataextractor, mathpix : Overrides of the above for one server, plus its
+        "port", e.g. `--matie '{"latency": 3, "max_concurrency": 1}'`.
+    xml_dir : Saved GROBID output, replayed for PDFs of the same name.
+    recording_dir : Where responses recorded from the real services are stored, and replayed from.
+    record_from : The URL of the real service to forward unrecorded requests to, by backend, e.g.
+        `--record_from '{"matie": "http://localhost:8003"}'` (run the replay server on another port
+        then). Their responses are recorded for later runs.
+    """
+    defaults = ReplayBehavior(
+        latency=latency,
+        latency_jitter=latency_jitter,
+        error_rate=error_rate,
+        error_status=error_status,
+        max_concurrency=max_concurrency,
+        reject_when_busy=reject_when_busy,
+        seed=seed,
+    )
+    behavior_fields = {f.name for f in fields(ReplayBehavior)}
+    behaviors, ports = {}, {}
+    for name, overrides in [
+        ("grobid", grobid),
+        ("matie", matie),
+        ("chemdataextractor", chemdataextractor),
+        ("mathpix", mathpix),
+    ]:
+        overrides = dict(overrides or {})
+        ports[name] = overrides.pop("port", DEFAULT_PORTS[name])
+        unknown = set(overrides) - behavior_fields
+        if unknown:
+            raise ValueError(f"Unknown settings for {name}: {sorted(unknown)}")
+        behaviors[name] = replace(defaults, **overrides)
+
+    servers = start_replay_servers(
+        behaviors, [xml_dir], recording_dir, ports, host, record_from=record_from
+    )
+    for name, server in servers.items():
+        print(f"{name:<20} {server.url:<28} {server.behavior}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for server in servers.values():
+            server.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    fire.Fire(run_replay_servers)
@@ -0,0 +1,540 @@
+"""
+Benchmarks for the processing pipeline.
+
+Each benchmark runs one stage on a fixed set of papers: synthetic papers generated from a seed
+(see `synthetic.py`), plus any sample PDFs in `sample_dir` whose GROBID output is in `xml_dir`.
+GROBID, MatIE, ChemDataExtractor and the LLMs are replaced by the local stand-ins in
+`stand_ins.py`, so the suite runs offline and measures the pipeline's own work; the
+`*_service_client` benchmarks instead run the real clients against the replay servers in
+`replay_servers.py`, to measure the cost of the HTTP round trips. Benchmarks whose
+models or dependencies aren't available (e.g. scispacy, torch, poppler) are skipped.
+
+The results are compared against a stored baseline, and any benchmark whose median time grew by
+more than `tolerance` is reported as a regression:
+
+    python -m benchmarks.run_benchmarks
+    python -m benchmarks.run_benchmarks --save_baseline
+"""
+
+from dataclasses import asdict, dataclass, field
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import statistics
+import sys
+from tempfile import TemporaryDirectory
+import time
+from typing import Callable, Optional
+import xml.etree.ElementTree as ET
+
+import fire
+from papermage.magelib import Document
+
+from benchmarks.synthetic import SyntheticLayout, make_synthetic_document, write_synthetic_paper
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), "baselines")
+
+logger = logging.getLogger(__name__)
+
+
+class SkipBenchmark(Exception):
+    """Raised by a benchmark's setup when what it measures can't run in this environment."""
+
+
+@dataclass
+class BenchmarkPapers:
+    """The papers every benchmark runs on. Documents are built once, and each benchmark gets its
+    own copies."""
+
+    synthetic: list[tuple[str, SyntheticLayout]]
+    samples: list[str]
+    xml_dirs: list[str]
+    _synthetic_docs: list[dict] = field(default_factory=list)
+
+    @property
+    def pdf_paths(self) -> list[str]:
+        return [pdf_path for pdf_path, _ in self.synthetic] + self.samples
+
+    @property
+    def xml_paths(self) -> list[str]:
+        from benchmarks.stand_ins import ReplayGrobidClient
+
+        client = ReplayGrobidClient(self.xml_dirs)
+        return [xml for xml in map(client.find_xml, self.pdf_paths) if xml is not None]
+
+    def synthetic_docs(self) -> list[Document]:
+        if not self._synthetic_docs:
+            self._synthetic_docs = [
+                make_synthetic_document(layout=layout).to_json() for _, layout in self.synthetic
+            ]
+        return [Document.from_json(doc_json) for doc_json in self._synthetic_docs]
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    status: str
+    message: Optional[str] = None
+    repeats: int = 0
+    items: int = 0
+    item_name: Optional[str] = None
+    median_seconds: Optional[float] = None
+    p95_seconds: Optional[float] = None
+    items_per_second: Optional[float] = None
+
+
+# benchmark name -> setup function, which returns the function to time, the number of items it
+# processes per run, and what those items are; and optionally a function that releases what the
+# setup started (e.g. a server), called once the benchmark is done.
+BENCHMARKS: dict[str, Callable[[BenchmarkPapers], tuple]] = {}
+
+
+def benchmark(name: str):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def require_pdf_rasterizer() -> None:
+    if shutil.which("pdfinfo") is None:
+        raise SkipBenchmark("poppler (pdfinfo) is not installed")
+
+
+@benchmark("reading_order_consolidation")
+def setup_reading_order_consolidation(papers: BenchmarkPapers):
+    from papermage_components.reading_order_parser import (
+        get_coords_by_section,
+        get_page_dimensions,
+        segment_and_consolidate_boxes,
+    )
+
+    xml_roots = []
+    for xml_path in papers.xml_paths:
+        with open(xml_path) as f:
+            xml_roots.append(ET.fromstring(f.read()))
+
+    def run():
+        for xml_root in xml_roots:
+            page_dimensions = get_page_dimensions(xml_root)
+            section_to_boxes = get_coords_by_section(xml_root, page_dimensions)
+            for section, section_boxes in section_to_boxes.items():
+                segment_and_consolidate_boxes(section_boxes, section)
+
+    return run, len(xml_roots), "papers"
+
+
+@benchmark("reading_order_parse")
+def setup_reading_order_parse(papers: BenchmarkPapers):
+    from papermage.parsers import PDFPlumberParser
+
+    from benchmarks.stand_ins import make_replay_grobid_parser
+
+    grobid_parser = make_replay_grobid_parser(papers.xml_dirs)
+    pdf_parser = PDFPlumberParser()
+    parsed = [
+        (pdf_path, pdf_parser.parse(input_pdf_path=pdf_path))
+        for pdf_path in papers.pdf_paths
+        if grobid_parser.client.find_xml(pdf_path) is not None
+    ]
+
+    def run():
+        for pdf_path, doc in parsed:
+            if "reading_order_sections" in doc.layers:
+                doc.remove_layer("reading_order_sections")
+            grobid_parser.parse(pdf_path, doc)
+
+    return run, len(parsed), "papers"
+
+
+@benchmark("sentence_splitting")
+def setup_sentence_splitting(papers: BenchmarkPapers):
+    from papermage_components.scispacy_sentence_predictor import SciSpacySentencePredictor
+
+    try:
+        predictor = SciSpacySentencePredictor(model_name="en_core_sci_md")
+    except OSError as e:
+        raise SkipBenchmark(f"scispacy model is not installed: {e}")
+    docs = papers.synthetic_docs()
+
+    def run():
+        for doc in docs:
+            predictor.predict(doc)
+
+    return run, sum(len(doc.sentences) for doc in docs), "sentences"
+
+
+@benchmark("matie_offsets")
+def setup_matie_offsets(papers: BenchmarkPapers):
+    from benchmarks.stand_ins import LocalMatIEPredictor
+
+    predictor = LocalMatIEPredictor()
+    docs = papers.synthetic_docs()
+
+    def run():
+        for doc in docs:
+            predictor.predict(doc)
+
+    return run, sum(len(doc.reading_order_sections) for doc in docs), "paragraphs"
+
+
+@benchmark("token_classification_batching")
+def setup_token_classification_batching(papers: BenchmarkPapers):
+    from benchmarks.stand_ins import LocalChemDataExtractorPredictor
+
+    predictor = LocalChemDataExtractorPredictor()
+    docs = papers.synthetic_docs()
+
+    def run():
+        for doc in docs:
+            predictor.predict(doc)
+
+    return run, sum(len(doc.sentences) for doc in docs), "sentences"
+
+
+@benchmark("llm_generation")
+def setup_llm_generation(papers: BenchmarkPapers):
+    from benchmarks.stand_ins import CannedTextGenerationPredictor
+
+    predictor = CannedTextGenerationPredictor()
+    docs = papers.synthetic_docs()
+
+    def run():
+        for doc in docs:
+            predictor.predict(doc)
+
+    return run, sum(len(doc.reading_order_sections) for doc in docs), "paragraphs"
+
+
+def setup_service_client(papers: BenchmarkPapers, backend: str, make_predictor):
+    from benchmarks.replay_servers import ReplayServer, make_backends
+
+    server = ReplayServer(make_backends(papers.xml_dirs, recording_dir=None)[backend]).start()
+    try:
+        predictor = make_predictor(server.url)
+        docs = papers.synthetic_docs()
+    except BaseException:
+        server.stop()
+        raise
+
+    def run():
+        for doc in docs:
+            predictor.predict(doc)
+
+    return run, len(docs), "papers", server.stop
+
+
+@benchmark("matie_service_client")
+def setup_matie_service_client(papers: BenchmarkPapers):
+    from papermage_components.matie_service_predictor import MatIEServicePredictor
+
+    return setup_service_client(papers, "matie", MatIEServicePredictor)
+
+
+@benchmark("chemdataextractor_service_client")
+def setup_chemdataextractor_service_client(papers: BenchmarkPapers):
+    from papermage_components.chem_data_extractor_predictor import ChemDataExtractorPredictor
+
+    return setup_service_client(papers, "chemdataextractor", ChemDataExtractorPredictor)
+
+
+@benchmark("table_transformer")
+def setup_table_transformer(papers: BenchmarkPapers):
+    from papermage_components.page_images import rasterized_for_stage
+    from papermage_components.table_transformer_structure_predictor import (
+        TableTransformerStructurePredictor,
+    )
+
+    require_pdf_rasterizer()
+    try:
+        predictor = TableTransformerStructurePredictor.from_model_name()
+    except OSError as e:
+        raise SkipBenchmark(f"Table Transformer weights are not available: {e}")
+    docs = list(zip(papers.synthetic_docs(), (pdf_path for pdf_path, _ in papers.synthetic)))
+
+    def run():
+        for doc, pdf_path in docs:
+            with rasterized_for_stage(doc, pdf_path, predictor.dpi):
+                predictor.predict(doc)
+
+    return run, sum(len(doc.tables) for doc, _ in docs), "tables"
+
+
+def setup_serialization(papers: BenchmarkPapers, suffix: str):
+    from papermage_components.serialization import load_document, save_document
+
+    docs = papers.synthetic_docs()
+    output_dir = TemporaryDirectory()
+
+    def run():
+        for index, doc in enumerate(docs):
+            path = os.path.join(output_dir.name, f"{index}{suffix}")
+            save_document(doc, path)
+            load_document(path)
+
+    # keep the directory alive as long as the benchmark is.
+    run.output_dir = output_dir
+    return run, len(docs), "documents"
+
+
+@benchmark("serialization_binary")
+def setup_serialization_binary(papers: BenchmarkPapers):
+    return setup_serialization(papers, ".npz")
+
+
+@benchmark("serialization_json")
+def setup_serialization_json(papers: BenchmarkPapers):
+    return setup_serialization(papers, ".json")
+
+
+@benchmark("serialization_lazy_load")
+def setup_serialization_lazy_load(papers: BenchmarkPapers):
+    from papermage_components.serialization import load_document, save_document
+
+    output_dir = TemporaryDirectory()
+    paths = []
+    for index, doc in enumerate(papers.synthetic_docs()):
+        paths.append(os.path.join(output_dir.name, f"{index}.npz"))
+        save_document(doc, paths[-1])
+
+    def run():
+        # what the views do: open the document, and read the layers they show.
+        for path in paths:
+            doc = load_document(path, lazy=True)
+            doc.reading_order_sections
+
+    run.output_dir = output_dir
+    return run, len(paths), "documents"
+
+
+@benchmark("full_recipe")
+def setup_full_recipe(papers: BenchmarkPapers):
+    from papermage_components.materials_recipe import MaterialsRecipe
+
+    from benchmarks.stand_ins import (
+        LocalChemDataExtractorPredictor,
+        LocalMatIEPredictor,
+        make_replay_grobid_parser,
+    )
+
+    require_pdf_rasterizer()
+    recipe = MaterialsRecipe(xml_out_dir=None, dpi=150)
+    # instance attributes take precedence over the recipe's lazily loaded components.
+    recipe.grobid_order_parser = make_replay_grobid_parser(papers.xml_dirs)
+    recipe.matIE_predictor = LocalMatIEPredictor()
+    recipe.cde_predictor = LocalChemDataExtractorPredictor()
+    try:
+        recipe.prewarm()
+    except (ImportError, OSError) as e:
+        raise SkipBenchmark(f"recipe models are not available: {e}")
+    pdf_paths = [
+        pdf_path
+        for pdf_path in papers.pdf_paths
+        if recipe.grobid_order_parser.client.find_xml(pdf_path) is not None
+    ]
+
+    def run():
+        for pdf_path in pdf_paths:
+            recipe.from_pdf(pdf_path)
+
+    return run, len(pdf_paths), "papers"
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """The nearest-rank percentile of `values`."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def run_benchmark(name: str, papers: BenchmarkPapers, repeats: int) -> BenchmarkResult:
+    try:
+        run, items, item_name, *cleanup = BENCHMARKS[name](papers)
+    except SkipBenchmark as e:
+        return BenchmarkResult(name, status="skipped", message=str(e))
+    except ImportError as e:
+        return BenchmarkResult(name, status="skipped", message=f"missing dependency: {e}")
+
+    try:
+        # the first run is a warm-up: caches, lazily loaded models and so on.
+        run()
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+    finally:
+        for release in cleanup:
+            release()
+
+    median = statistics.median(timings)
+    return BenchmarkResult(
+        name,
+        status="ok",
+        repeats=repeats,
+        items=items,
+        item_name=item_name,
+        median_seconds=median,
+        p95_seconds=percentile(timings, 0.95),
+        items_per_second=items / median if median > 0 else None,
+    )
+
+
+def get_environment() -> dict:
+    import papermage
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "papermage": getattr(papermage, "__version__", "unknown"),
+    }
+
+
+def compare_to_baseline(
+    results: list[BenchmarkResult], baseline: dict, tolerance: float
+) -> list[str]:
+    """Describe every benchmark that got slower than the baseline by more than `tolerance`, a
+    fraction of the baseline's median time."""
+    regressions = []
+    baseline_results = {result["name"]: result for result in baseline["results"]}
+    for result in results:
+        baseline_result = baseline_results.get(result.name)
+        if result.status != "ok" or not baseline_result or baseline_result["status"] != "ok":
+            continue
+        ratio = result.median_seconds / baseline_result["median_seconds"]
+        if ratio > 1 + tolerance:
+            regressions.append(
+                f"{result.name}: {result.median_seconds:.4f}s median, "
+                f"{ratio:.2f}x the baseline's {baseline_result['median_seconds']:.4f}s"
+            )
+    return regressions
+
+
+def format_results(results: list[BenchmarkResult], baseline: Optional[dict]) -> str:
+    baseline_results = {r["name"]: r for r in baseline["results"]} if baseline else {}
+    lines = [
+        f"{'benchmark':<32} {'median (s)':>11} {'p95 (s)':>11} {'throughput':>22}"
+        f" {'vs baseline':>12}"
+    ]
+    for result in results:
+        if result.status != "ok":
+            lines.append(f"{result.name:<32} {result.status}: {result.message}")
+            continue
+        throughput = f"{result.items_per_second:.1f} {result.item_name}/s"
+        baseline_result = baseline_results.get(result.name)
+        if baseline_result and baseline_result["status"] == "ok":
+            change = f"{result.median_seconds / baseline_result['median_seconds']:.2f}x"
+        else:
+            change = "-"
+        lines.append(
+            f"{result.name:<32} {result.median_seconds:>11.4f} {result.p95_seconds:>11.4f}"
+            f" {throughput:>22} {change:>12}"
+        )
+    return "\n".join(lines)
+
+
+def run_benchmarks(
+    benchmarks: Optional[list[str]] = None,
+    num_synthetic: int = 3,
+    synthetic_pages: int = 6,
+    sample_dir: str = "data/benchmark_papers",
+    xml_dir: str = "data/grobid_xml",
+    repeats: int = 5,
+    baseline: str = "default",
+    tolerance: float = 0.25,
+    save_baseline: bool = False,
+    output: Optional[str] = None,
+):
+    """Run the benchmarks and compare them against a stored baseline.
+
+    Parameters
+    ----------
+    benchmarks : The benchmarks to run; all of them by default.
+    num_synthetic : How many synthetic papers to generate, each from its own seed.
+    synthetic_pages : How many pages each synthetic paper has.
+    sample_dir : A folder of sample PDFs to include. Only those with GROBID output in `xml_dir`
+        (as `<name>.xml`, which is where the recipe saves it by default) are used.
+    xml_dir : Saved GROBID output for the sample PDFs, replayed in place of a GROBID server.
+    repeats : How many times to time each benchmark, after one warm-up run.
+    baseline : The name of the baseline, stored in `benchmarks/baselines/<baseline>.json`.
+    tolerance : How much slower than the baseline (as a fraction of its median time) a benchmark
+        may be before it's reported as a regression.
+    save_baseline : Store these results as the baseline, instead of comparing against it.
+    output : If given, also write the results here, as JSON.
+    """
+    names = list(BENCHMARKS) if benchmarks is None else list(benchmarks)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        raise ValueError(f"Unknown benchmarks {unknown}; expected some of {list(BENCHMARKS)}.")
+
+    with TemporaryDirectory() as synthetic_dir:
+        papers = BenchmarkPapers(
+            synthetic=[
+                write_synthetic_paper(synthetic_dir, f"synthetic_{seed}", synthetic_pages, seed)
+                for seed in range(num_synthetic)
+            ],
+            samples=sorted(
+                os.path.join(sample_dir, f)
+                for f in (os.listdir(sample_dir) if os.path.isdir(sample_dir) else [])
+                if f.endswith(".pdf")
+            ),
+            xml_dirs=[synthetic_dir, xml_dir],
+        )
+
+        results = []
+        for name in names:
+            logger.info(f"Running {name}...")
+            results.append(run_benchmark(name, papers, repeats))
+
+    report = {
+        "environment": get_environment(),
+        "settings": {
+            "num_synthetic": num_synthetic,
+            "synthetic_pages": synthetic_pages,
+            "samples": [os.path.basename(pdf_path) for pdf_path in papers.samples],
+            "repeats": repeats,
+        },
+        "results": [asdict(result) for result in results],
+    }
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    baseline_path = os.path.join(BASELINE_DIR, f"{baseline}.json")
+    if save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump(report, f, indent=4)
+        print(format_results(results, None))
+        print(f"\nSaved the baseline to {baseline_path}.")
+        return
+
+    baseline_report = None
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline_report = json.load(f)
+    print(format_results(results, baseline_report))
+
+    if baseline_report is None:
+        print(f"\nNo baseline at {baseline_path}; run with --save_baseline to store one.")
+        return
+    if baseline_report["environment"] != report["environment"]:
+        print("\nThe baseline was recorded in a different environment; comparisons may not hold.")
+    if baseline_report["settings"] != report["settings"]:
+        print("\nThe baseline was recorded with different settings; comparisons may not hold.")
+    regressions = compare_to_baseline(results, baseline_report, tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} regressions (more than {tolerance:.0%} slower):")
+        print("\n".join(f"  {regression}" for regression in regressions))
+        sys.exit(1)
+    print("\nNo regressions.")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    fire.Fire(run_benchmarks)
@@ -0,0 +1,99 @@
+"""
+Local stand-ins for the services the pipeline calls: GROBID, MatIE, ChemDataExtractor and the LLMs.
+
+Each stand-in subclasses the real predictor (or client) and replaces only the call to the service,
+so everything the pipeline does with a response, e.g. reconciling MatIE's offsets or mapping
+ChemDataExtractor's character spans back onto sentences, still runs and is measured. The
+"annotations" come from `fake_annotations.py`; they're deterministic, but not meant to be good.
+"""
+
+import json
+from typing import List, Optional
+
+from papermage_components.chem_data_extractor_predictor import ChemDataExtractorPredictor
+from papermage_components.interfaces.text_generation_predictor import (
+    TextGenerationPredictorABC,
+)
+from papermage_components.interfaces.token_classification_predictor import EntityCharSpan
+from papermage_components.matie_service_predictor import MatIEServicePredictor
+
+from benchmarks.fake_annotations import (
+    annotate_like_chemdataextractor,
+    annotate_like_matie,
+    summarize_like_llm,
+)
+from benchmarks.replay_servers import find_recorded_grobid_xml
+
+
+class ReplayGrobidClient:
+    """Answers `process_pdf` with GROBID output saved earlier, found by the PDF's name (e.g.
+    `paper.xml` for `paper.pdf`) in any of `xml_dirs`."""
+
+    def __init__(self, xml_dirs: List[str]):
+        self.xml_dirs = xml_dirs
+
+    def find_xml(self, pdf_file: str) -> Optional[str]:
+        return find_recorded_grobid_xml(self.xml_dirs, pdf_file)
+
+    def process_pdf(self, service: str, pdf_file: str, *args, **kwargs):
+        xml_path = self.find_xml(pdf_file)
+        if xml_path is None:
+            return pdf_file, 404, None
+        with open(xml_path) as f:
+            return pdf_file, 200, f.read()
+
+
+def make_replay_grobid_parser(xml_dirs: List[str]):
+    """A `GrobidReadingOrderParser` that reads saved GROBID output instead of calling a server."""
+    from papermage_components.reading_order_parser import GrobidReadingOrderParser
+
+    parser = GrobidReadingOrderParser("http://localhost:8070", check_server=False)
+    parser.client = ReplayGrobidClient(xml_dirs)
+    return parser
+
+
+class LocalMatIEPredictor(MatIEServicePredictor):
+    """MatIE, answered locally. Like the service, it re-tokenizes each paragraph and returns
+    offsets into the re-tokenized text, so the offset reconciliation does the same work."""
+
+    def __init__(self):
+        super().__init__(matIE_service_url=None)
+
+    def annotate_payload(self, document_payload: dict[str, str]) -> dict:
+        return annotate_like_matie(document_payload)
+
+
+class LocalChemDataExtractorPredictor(ChemDataExtractorPredictor):
+    """ChemDataExtractor, answered locally by matching chemical formulae."""
+
+    def __init__(self):
+        super().__init__(cde_service_url=None)
+
+    def tag_entities_in_batch(self, batch: List[str]) -> List[List[EntityCharSpan]]:
+        return [
+            [
+                EntityCharSpan(
+                    e_type=entity["entity_type"],
+                    start_char=entity["start_char"],
+                    end_char=entity["end_char"],
+                    metadata={},
+                )
+                for entity in instance
+            ]
+            for instance in annotate_like_chemdataextractor(batch)
+        ]
+
+
+class CannedTextGenerationPredictor(TextGenerationPredictorABC):
+    """An LLM that answers every prompt with a small JSON table summarizing the text it was given,
+    so the response parsing runs as it would for a real model."""
+
+    def __init__(self, entity_to_process="reading_order_sections"):
+        super().__init__(entity_to_process)
+
+    @property
+    def predictor_identifier(self) -> str:
+        return "Canned LLM"
+
+    def generate_from_entity_text(self, entity_text: str) -> str:
+        return json.dumps(summarize_like_llm(entity_text))
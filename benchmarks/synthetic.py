@@ -0,0 +1,331 @@
+"""
+Deterministic synthetic papers for benchmarking.
+
+A synthetic paper is laid out once, as words placed in two columns on each page, with a section
+heading at the top of each page and, optionally, a numeric table. The same layout is used to
+build a papermage Document directly (for benchmarks of individual stages), to write a PDF (for
+the full recipe), and to write the TEI XML GROBID would return for that PDF, so the stand-in
+GROBID client can replay it.
+"""
+
+from dataclasses import dataclass, field
+import os
+import random
+from typing import Optional
+from xml.sax.saxutils import escape
+
+import fitz
+from papermage.magelib import Box, Document, Entity, Metadata, Span
+
+PAGE_WIDTH = 612.0
+PAGE_HEIGHT = 792.0
+FONT_NAME = "helv"
+FONT_SIZE = 9.0
+HEADING_FONT_SIZE = 12.0
+LINE_HEIGHT = 12.0
+MARGIN = 54.0
+COLUMN_GAP = 18.0
+COLUMN_WIDTH = (PAGE_WIDTH - 2 * MARGIN - COLUMN_GAP) / 2
+PARAGRAPH_GAP = 8.0
+
+WORD_BANK = (
+    "the creep resistance of the alloy was measured at elevated temperature and the grain "
+    "boundary sliding rate increased with applied stress while precipitate coarsening reduced "
+    "strength samples were produced by laser powder bed fusion and annealed in argon before "
+    "tensile testing microstructure was characterized with EBSD and X-ray diffraction showing "
+    "columnar grains and a gamma prime phase fraction near forty percent"
+).split()
+CHEMICAL_BANK = ["Ni3Al", "TiO2", "Al2O3", "Cr23C6", "NbC", "Inconel", "Fe3O4", "MoSi2"]
+NUMBER_BANK = ["650", "700", "1200", "0.2", "15", "42.5", "900"]
+UNIT_BANK = ["MPa", "°C", "h", "%", "GPa", "µm"]
+
+
+@dataclass
+class PlacedWord:
+    text: str
+    page: int
+    # in PDF points, from the top left of the page.
+    x: float
+    y: float
+    width: float
+    height: float
+    paragraph: Optional[int] = None
+    sentence: Optional[int] = None
+    line: int = 0
+
+
+@dataclass
+class SyntheticLayout:
+    num_pages: int
+    words: list[PlacedWord] = field(default_factory=list)
+    # (page, title) per section, and the section each paragraph belongs to.
+    section_titles: list[str] = field(default_factory=list)
+    heading_words: list[list[int]] = field(default_factory=list)
+    paragraph_sections: list[int] = field(default_factory=list)
+    # (page, x, y, width, height) in points, and the rows of cell text of each table.
+    table_boxes: list[tuple[int, float, float, float, float]] = field(default_factory=list)
+    table_cells: list[list[list[str]]] = field(default_factory=list)
+
+
+def make_sentence(rng: random.Random) -> list[str]:
+    words = []
+    for _ in range(rng.randint(8, 24)):
+        roll = rng.random()
+        if roll < 0.08:
+            words.append(rng.choice(CHEMICAL_BANK))
+        elif roll < 0.14:
+            words.extend([rng.choice(NUMBER_BANK), rng.choice(UNIT_BANK)])
+        else:
+            words.append(rng.choice(WORD_BANK))
+    words[0] = words[0].capitalize()
+    words[-1] = words[-1] + "."
+    return words
+
+
+def text_width(text: str, font_size: float = FONT_SIZE) -> float:
+    return fitz.get_text_length(text, fontname=FONT_NAME, fontsize=font_size)
+
+
+def lay_out_paper(
+    num_pages: int = 4, seed: int = 0, tables_every: Optional[int] = 2
+) -> SyntheticLayout:
+    """Lay out a synthetic paper. Every `tables_every`-th page gets a table at the bottom of its
+    second column."""
+    rng = random.Random(seed)
+    layout = SyntheticLayout(num_pages=num_pages)
+    paragraph = -1
+    sentence = -1
+    line = -1
+    # a little wider than a space, so that PDF parsers reliably split the words.
+    space_width = 2 * text_width(" ")
+
+    for page in range(num_pages):
+        title = f"{page + 1}. " + " ".join(rng.choice(WORD_BANK) for _ in range(3)).title()
+        layout.section_titles.append(title)
+        heading_indices = []
+        x = MARGIN
+        line += 1
+        for word in title.split():
+            width = text_width(word, HEADING_FONT_SIZE)
+            heading_indices.append(len(layout.words))
+            layout.words.append(
+                PlacedWord(word, page, x, MARGIN, width, HEADING_FONT_SIZE * 1.2, line=line)
+            )
+            x += width + 2 * text_width(" ", HEADING_FONT_SIZE)
+        layout.heading_words.append(heading_indices)
+
+        has_table = tables_every is not None and page % tables_every == tables_every - 1
+        table_top = PAGE_HEIGHT - MARGIN - 160.0
+        for column in range(2):
+            column_left = MARGIN + column * (COLUMN_WIDTH + COLUMN_GAP)
+            column_bottom = table_top - PARAGRAPH_GAP if has_table and column == 1 else None
+            column_bottom = column_bottom or PAGE_HEIGHT - MARGIN
+            y = MARGIN + 2 * LINE_HEIGHT
+            while y + 3 * LINE_HEIGHT < column_bottom:
+                paragraph += 1
+                layout.paragraph_sections.append(page)
+                x = column_left
+                line += 1
+                for _ in range(rng.randint(2, 5)):
+                    sentence += 1
+                    for word in make_sentence(rng):
+                        width = text_width(word)
+                        if x + width > column_left + COLUMN_WIDTH:
+                            x = column_left
+                            y += LINE_HEIGHT
+                            line += 1
+                        if y + LINE_HEIGHT > column_bottom:
+                            break
+                        layout.words.append(
+                            PlacedWord(
+                                word,
+                                page,
+                                x,
+                                y,
+                                width,
+                                FONT_SIZE * 1.2,
+                                paragraph=paragraph,
+                                sentence=sentence,
+                                line=line,
+                            )
+                        )
+                        x += width + space_width
+                y += LINE_HEIGHT + PARAGRAPH_GAP
+
+        if has_table:
+            n_rows, n_cols = rng.randint(4, 8), rng.randint(3, 5)
+            cells = [[f"Header {c + 1}" for c in range(n_cols)]]
+            for _ in range(n_rows - 1):
+                cells.append([rng.choice(NUMBER_BANK) for _ in range(n_cols)])
+            layout.table_boxes.append(
+                (page, MARGIN + COLUMN_WIDTH + COLUMN_GAP, table_top, COLUMN_WIDTH, 150.0)
+            )
+            layout.table_cells.append(cells)
+
+    return layout
+
+
+def _relative_box(page: int, x: float, y: float, width: float, height: float) -> Box:
+    return Box(x / PAGE_WIDTH, y / PAGE_HEIGHT, width / PAGE_WIDTH, height / PAGE_HEIGHT, page)
+
+
+def make_synthetic_document(
+    num_pages: int = 4, seed: int = 0, layout: Optional[SyntheticLayout] = None
+) -> Document:
+    """Build a Document with the layers the parse stages would produce: tokens, words, rows,
+    pages, sentences, reading_order_sections and tables."""
+    layout = layout or lay_out_paper(num_pages, seed)
+    symbols = []
+    offset = 0
+    word_spans = []
+    for i, word in enumerate(layout.words):
+        if i > 0:
+            symbols.append("\n" if word.line != layout.words[i - 1].line else " ")
+            offset += 1
+        symbols.append(word.text)
+        word_spans.append(Span(offset, offset + len(word.text)))
+        offset += len(word.text)
+    doc = Document(symbols="".join(symbols))
+
+    word_boxes = [_relative_box(w.page, w.x, w.y, w.width, w.height) for w in layout.words]
+    tokens = [Entity(spans=[span], boxes=[box]) for span, box in zip(word_spans, word_boxes)]
+    doc.annotate_layer("tokens", tokens)
+    words = [
+        Entity(spans=[span], boxes=[box], metadata=Metadata(text=word.text))
+        for span, box, word in zip(word_spans, word_boxes, layout.words)
+    ]
+    doc.annotate_layer("words", words)
+
+    def group_entities(key) -> list[Entity]:
+        groups = {}
+        for index, word in enumerate(layout.words):
+            group = key(word)
+            if group is not None:
+                groups.setdefault(group, []).append(index)
+        return [
+            Entity(
+                spans=[Span(word_spans[indices[0]].start, word_spans[indices[-1]].end)],
+                boxes=[Box.create_enclosing_box([word_boxes[i] for i in indices])],
+            )
+            for _, indices in sorted(groups.items())
+        ]
+
+    doc.annotate_layer("rows", group_entities(lambda word: word.line))
+    doc.annotate_layer("pages", group_entities(lambda word: word.page))
+    doc.annotate_layer("sentences", group_entities(lambda word: word.sentence))
+
+    paragraphs = group_entities(lambda word: word.paragraph)
+    paragraph_ids = sorted({w.paragraph for w in layout.words if w.paragraph is not None})
+    for reading_order, (paragraph_id, paragraph) in enumerate(zip(paragraph_ids, paragraphs)):
+        section = layout.paragraph_sections[paragraph_id]
+        paragraph.metadata = Metadata(
+            section_name=layout.section_titles[section],
+            section_reading_order=section,
+            paragraph_reading_order=reading_order,
+        )
+    doc.annotate_layer("reading_order_sections", paragraphs)
+
+    tables = [
+        Entity(boxes=[_relative_box(*table_box)], metadata=Metadata(cells=cells))
+        for table_box, cells in zip(layout.table_boxes, layout.table_cells)
+    ]
+    doc.annotate_layer("tables", tables)
+    return doc
+
+
+def write_synthetic_pdf(layout: SyntheticLayout, pdf_path: str) -> None:
+    pdf = fitz.open()
+    for page_number in range(layout.num_pages):
+        pdf.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+    heading_indices = {i for indices in layout.heading_words for i in indices}
+    for i, word in enumerate(layout.words):
+        font_size = HEADING_FONT_SIZE if i in heading_indices else FONT_SIZE
+        # insert_text takes the baseline position.
+        pdf[word.page].insert_text(
+            (word.x, word.y + font_size), word.text, fontname=FONT_NAME, fontsize=font_size
+        )
+
+    for (page_number, x, y, width, height), cells in zip(layout.table_boxes, layout.table_cells):
+        page = pdf[page_number]
+        row_height = height / len(cells)
+        col_width = width / len(cells[0])
+        for row_index, row in enumerate(cells):
+            row_top = y + row_index * row_height
+            page.draw_line((x, row_top), (x + width, row_top))
+            for col_index, cell in enumerate(row):
+                page.insert_text(
+                    (x + col_index * col_width + 3, row_top + row_height * 0.7),
+                    cell,
+                    fontname=FONT_NAME,
+                    fontsize=FONT_SIZE - 1,
+                )
+        page.draw_line((x, y + height), (x + width, y + height))
+    pdf.save(pdf_path)
+    pdf.close()
+
+
+def _coords(words: list[PlacedWord]) -> str:
+    """GROBID coords for a run of words: one box per line, as page,x,y,w,h in points."""
+    boxes = []
+    lines = {}
+    for word in words:
+        lines.setdefault(word.line, []).append(word)
+    for line_words in lines.values():
+        left = min(w.x for w in line_words)
+        top = min(w.y for w in line_words)
+        right = max(w.x + w.width for w in line_words)
+        bottom = max(w.y + w.height for w in line_words)
+        page = line_words[0].page + 1
+        boxes.append(f"{page},{left:.2f},{top:.2f},{right - left:.2f},{bottom - top:.2f}")
+    return ";".join(boxes)
+
+
+def synthetic_grobid_xml(layout: SyntheticLayout) -> str:
+    """The TEI XML GROBID's processFulltextDocument would return for the synthetic PDF, with
+    coordinates for headings and sentences."""
+    surfaces = "".join(
+        f'<surface n="{page + 1}" ulx="0.0" uly="0.0" lrx="{PAGE_WIDTH}" lry="{PAGE_HEIGHT}"/>'
+        for page in range(layout.num_pages)
+    )
+    divs = []
+    for section, title in enumerate(layout.section_titles):
+        heading_words = [layout.words[i] for i in layout.heading_words[section]]
+        paragraphs = []
+        paragraph_ids = [p for p, s in enumerate(layout.paragraph_sections) if s == section]
+        for paragraph_id in paragraph_ids:
+            sentences = {}
+            for word in layout.words:
+                if word.paragraph == paragraph_id:
+                    sentences.setdefault(word.sentence, []).append(word)
+            if not sentences:
+                continue
+            sentence_xml = "".join(
+                f'<s coords="{_coords(words)}">{escape(" ".join(w.text for w in words))}</s>'
+                for words in sentences.values()
+            )
+            paragraphs.append(f"<p>{sentence_xml}</p>")
+        divs.append(
+            f'<div><head coords="{_coords(heading_words)}">{escape(title)}</head>'
+            + "".join(paragraphs)
+            + "</div>"
+        )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<TEI xmlns="http://www.tei-c.org/ns/1.0"><teiHeader/>'
+        f"<facsimile>{surfaces}</facsimile>"
+        f"<text><body>{''.join(divs)}</body></text></TEI>"
+    )
+
+
+def write_synthetic_paper(
+    output_dir: str, name: str, num_pages: int = 4, seed: int = 0
+) -> tuple[str, SyntheticLayout]:
+    """Write `<name>.pdf` and the matching GROBID output, `<name>.xml`, to `output_dir`, in the
+    layout the replay GROBID client reads from. Returns the PDF path and the layout."""
+    os.makedirs(output_dir, exist_ok=True)
+    layout = lay_out_paper(num_pages, seed)
+    pdf_path = os.path.join(output_dir, f"{name}.pdf")
+    write_synthetic_pdf(layout, pdf_path)
+    with open(os.path.join(output_dir, f"{name}.xml"), "w") as f:
+        f.write(synthetic_grobid_xml(layout))
+    return pdf_path, layout
@@ -0,0 +1,46 @@
+import logging
+import os
+
+import fire
+from tqdm.auto import tqdm
+
+from app_config import app_config as config
+from papermage_components.serialization import (
+    BINARY_DOCUMENT_SUFFIX,
+    JSON_DOCUMENT_SUFFIX,
+    convert_json_to_binary,
+    load_document_json,
+)
+
+
+def convert_parsed_papers(
+    folder: str = config["processed_paper_path"],
+    overwrite_if_present: bool = False,
+    remove_json: bool = False,
+):
+    """Convert every JSON document in `folder` to the compact binary format. The JSON file is only
+    removed (with `remove_json`) once the converted file has been read back and checked to be
+    identical."""
+    json_files = [f for f in os.listdir(folder) if f.endswith(JSON_DOCUMENT_SUFFIX)]
+
+    for json_filename in tqdm(json_files):
+        json_path = os.path.join(folder, json_filename)
+        binary_path = os.path.splitext(json_path)[0] + BINARY_DOCUMENT_SUFFIX
+
+        if os.path.exists(binary_path) and not overwrite_if_present:
+            print(f"File {binary_path} already exists! Skipping conversion.")
+            continue
+
+        try:
+            convert_json_to_binary(json_path, binary_path)
+            if remove_json:
+                if load_document_json(binary_path) != load_document_json(json_path):
+                    raise AssertionError("Converted document does not match the original!")
+                os.remove(json_path)
+        except Exception:
+            logging.error(f"Failed to convert {json_filename}", exc_info=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    fire.Fire(convert_parsed_papers)
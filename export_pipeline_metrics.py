@@ -0,0 +1,48 @@
+import logging
+import os
+from typing import Optional
+
+import fire
+from tqdm.auto import tqdm
+
+from app_config import app_config as config
+from papermage_components.instrumentation import (
+    get_document_metrics,
+    metrics_to_jsonl,
+    metrics_to_prometheus,
+)
+from papermage_components.serialization import list_documents, load_document
+
+
+def export_pipeline_metrics(
+    folder: str = config["processed_paper_path"],
+    output: Optional[str] = None,
+    format: str = "jsonl",
+):
+    """Export the per-stage metrics recorded in every processed paper in `folder`, as JSONL (one
+    record per stage per paper) or in the Prometheus text format ("prometheus"). Writes to
+    `output` if given, and prints otherwise."""
+    if format not in ("jsonl", "prometheus"):
+        raise ValueError(f"Unknown format {format}; expected 'jsonl' or 'prometheus'.")
+
+    document_files = list_documents(folder, config["processed_paper_suffix"])
+    records = []
+    for document_filename in tqdm(document_files):
+        try:
+            # binary documents are loaded lazily, so only the metadata is read.
+            doc = load_document(os.path.join(folder, document_filename), lazy=True)
+            records.extend(get_document_metrics(doc, document_filename))
+        except Exception:
+            logging.error(f"Failed to read {document_filename}", exc_info=True)
+
+    exported = metrics_to_jsonl(records) if format == "jsonl" else metrics_to_prometheus(records)
+    if output is None:
+        print(exported, end="")
+    else:
+        with open(output, "w") as f:
+            f.write(exported)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    fire.Fire(export_pipeline_metrics)
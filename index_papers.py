@@ -0,0 +1,106 @@
+"""
+Bring the corpus index (see `papermage_components/corpus_index.py`) and the corpus graph (see
+`papermage_components/corpus_graph.py`) up to date with a folder of processed papers.
+
+Papers are indexed, and added to the graph, as the workers process them, so this is only needed
+for papers processed before the index or the graph existed, or processed by other means. Only
+papers that are new, or have changed since they were indexed, are read; papers that are no longer
+in the folder are removed from both. The graph is merged at the end.
+
+    python index_papers.py --num_workers 4
+"""
+
+import logging
+import os
+from typing import Optional
+
+import fire
+from tqdm.auto import tqdm
+
+from app_config import app_config as config
+from papermage_components.corpus_graph import CorpusGraph
+from papermage_components.corpus_index import CorpusIndex
+from papermage_components.forked_workers import map_with_forked_workers
+from papermage_components.relation_graph import get_document_graph
+from papermage_components.serialization import list_documents, load_document
+
+
+def index_paper(shared_state: tuple[str, str, str], item: tuple[str, bool, bool]) -> Optional[str]:
+    """Index a single paper, and/or add it to the graph, returning its filename if it failed."""
+    folder, index_path, graph_path = shared_state
+    filename, add_to_index, add_to_graph = item
+    path = os.path.join(folder, filename)
+    try:
+        mtime = os.path.getmtime(path)
+        paper = load_document(path, lazy=True)
+        if add_to_index:
+            CorpusIndex(index_path).index_document(filename, paper, mtime)
+        if add_to_graph:
+            CorpusGraph(graph_path).add_paper(filename, get_document_graph(paper))
+    except Exception:
+        logging.error(f"Failed to index {filename}", exc_info=True)
+        return filename
+    return None
+
+
+def index_papers(
+    folder: str = config["processed_paper_path"],
+    index_path: str = config["corpus_index_path"],
+    graph_path: str = config["corpus_graph_path"],
+    reindex_all: bool = False,
+    num_workers: int = 1,
+):
+    """Index the papers in `folder` that aren't indexed yet, or have changed since, and merge them
+    into the corpus graph.
+
+    Parameters
+    ----------
+    folder : The folder of processed papers.
+    index_path : The corpus index database.
+    graph_path : The corpus graph folder.
+    reindex_all : Whether to index every paper again, e.g. after changing how entities are indexed.
+    num_workers : How many papers to read at once. Writes to the index are serialized either way.
+    """
+    index = CorpusIndex(index_path)
+    graph = CorpusGraph(graph_path)
+    indexed = index.indexed_papers()
+    contributed = graph.contributed_papers()
+    filenames = list_documents(folder, config["processed_paper_suffix"])
+
+    for filename in set(indexed) - set(filenames):
+        index.remove_document(filename)
+    for filename in set(contributed) - set(filenames):
+        graph.remove_paper(filename)
+
+    to_index = []
+    for filename in filenames:
+        mtime = os.path.getmtime(os.path.join(folder, filename))
+        add_to_index = reindex_all or indexed.get(filename, None) != mtime
+        # contributions are stored after the paper, so one older than the paper is out of date.
+        add_to_graph = reindex_all or contributed.get(filename, -1) < mtime
+        if add_to_index or add_to_graph:
+            to_index.append((filename, add_to_index, add_to_graph))
+    logging.info(f"Indexing {len(to_index)} of {len(filenames)} papers.")
+
+    shared_state = (folder, index_path, graph_path)
+    if num_workers > 1:
+        results = map_with_forked_workers(index_paper, shared_state, to_index, num_workers)
+    else:
+        results = (index_paper(shared_state, item) for item in to_index)
+    failed = [filename for filename in tqdm(results, total=len(to_index)) if filename is not None]
+    if failed:
+        logging.warning(f"Failed to index {len(failed)} papers: {failed}")
+    if removed_terms := index.remove_unused_terms():
+        logging.info(f"Removed {removed_terms} terms no paper mentions any more.")
+    logging.info(f"Index now holds {index.get_stats()}")
+
+    merged = graph.merge()
+    logging.info(
+        f"Graph now holds {merged.num_nodes} entities and {merged.num_edges} relations, from "
+        f"{len(merged.papers)} papers"
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    fire.Fire(index_papers)
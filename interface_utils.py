@@ -1,6 +1,8 @@
-import json
+from collections import OrderedDict
 import os
 import re
+from threading import Lock
+from weakref import WeakKeyDictionary
 
 from transformers import AutoConfig
 
@@ -10,10 +12,21 @@ import streamlit as st
 import spacy
 
 from papermage_components.constants import MAT_IE_TYPES
+from papermage_components.corpus_graph import CompactGraph, CorpusGraph
+from papermage_components.corpus_index import CorpusIndex
+from papermage_components.document_cache import DocumentCache
+from papermage_components.document_summary import (
+    DocumentSummary,
+    read_document_summary,
+    write_document_summary,
+)
+from papermage_components.relation_graph import DocumentGraph, get_document_graph
+from papermage_components.serialization import list_documents
 from app_config import app_config as config
 
 
 PARSED_PAPER_FOLDER = config["processed_paper_path"]
+PARSED_PAPER_SUFFIX = config["processed_paper_suffix"]
 CUSTOM_MODELS_KEY = "custom_models"
 
 
@@ -84,10 +97,83 @@ class EntityColorMapper:
         return color_map
 
 
+def get_parsed_paper_filename(pdf_filename: str) -> str:
+    return os.path.splitext(os.path.basename(pdf_filename))[0] + PARSED_PAPER_SUFFIX
+
+
+def list_parsed_papers() -> list[str]:
+    """List the parsed papers in the processed paper folder, each in its preferred format."""
+    return list_documents(PARSED_PAPER_FOLDER, PARSED_PAPER_SUFFIX)
+
+
+@st.cache_resource
+def get_document_cache() -> DocumentCache:
+    return DocumentCache(max_size_bytes=config["document_cache_size_mb"] * 1024 * 1024)
+
+
+@st.cache_resource
+def get_corpus_index() -> CorpusIndex:
+    return CorpusIndex(config["corpus_index_path"])
+
+
+@st.cache_resource
+def get_corpus_graph() -> CorpusGraph:
+    return CorpusGraph(config["corpus_graph_path"])
+
+
+@st.cache_resource(max_entries=1)
+def _load_merged_graph(graph_mtime: float) -> CompactGraph:
+    return get_corpus_graph().load()
+
+
+def load_corpus_graph() -> CompactGraph:
+    """The merged corpus graph, shared between sessions, and only loaded again once it's been
+    merged since."""
+    graph_path = get_corpus_graph().graph_path
+    return _load_merged_graph(os.path.getmtime(graph_path) if os.path.exists(graph_path) else 0.0)
+
+
 def load_document(doc_filename):
-    with open(os.path.join(PARSED_PAPER_FOLDER, doc_filename)) as f:
-        document = Document.from_json(json.load(f))
-    return document
+    """Load a parsed paper through the process-wide document cache. Documents are shared between
+    sessions and reruns, so they shouldn't be modified."""
+    return get_document_cache().get(os.path.join(PARSED_PAPER_FOLDER, doc_filename))
+
+
+# graphs of the loaded documents, dropped along with the documents.
+_document_graphs = WeakKeyDictionary()
+_document_graphs_lock = Lock()
+
+
+def load_document_graph(doc: Document) -> DocumentGraph:
+    """The MatIE relation graph stored with a document. Documents processed before graphs were
+    stored have theirs built once per loaded document, rather than on every rerun."""
+    with _document_graphs_lock:
+        if doc not in _document_graphs:
+            _document_graphs[doc] = get_document_graph(doc)
+        return _document_graphs[doc]
+
+
+# summaries of the loaded documents, dropped along with the documents.
+_document_summaries = WeakKeyDictionary()
+_document_summaries_lock = Lock()
+
+
+def load_document_summary(doc_filename: str, doc: Document) -> DocumentSummary:
+    """The summary written when a paper was processed. Papers processed before summaries were
+    written, or changed since, have theirs written the first time they're loaded."""
+    with _document_summaries_lock:
+        if doc not in _document_summaries:
+            summary = read_document_summary(
+                config["document_summary_path"],
+                doc_filename,
+                os.path.join(PARSED_PAPER_FOLDER, doc_filename),
+            )
+            if summary is None:
+                summary = write_document_summary(
+                    doc, config["document_summary_path"], doc_filename
+                )
+            _document_summaries[doc] = summary
+        return _document_summaries[doc]
 
 
 @st.cache_resource
@@ -125,8 +211,14 @@ def get_entity_types(model_name: str, doc: Document) -> set[str]:
     return doc.metadata["entity_types"][model_name]
 
 
-def plot_selectable_regions(document, page_number, selectable_layers, exclude_entities=None):
-    exclude_entities = exclude_entities if exclude_entities is not None else []
+# the pages the views have drawn the selectable regions of, by document, page and layers, so that
+# highlighting an entity only draws the highlight. Dropped along with the documents.
+PAGE_OVERLAYS_PER_DOCUMENT = 8
+_page_overlays = WeakKeyDictionary()
+_page_overlays_lock = Lock()
+
+
+def _draw_selectable_regions(document, page_number, selectable_layers, exclude_entities=()):
     page = document.pages[page_number]
     page_image = page.images[0]
 
@@ -135,7 +227,7 @@ def plot_selectable_regions(document, page_number, selectable_layers, exclude_en
         entities = getattr(page, field)
         all_entities.extend([entity for entity in entities if entity not in exclude_entities])
 
-    image_with_selectables = plot_entities_on_page(
+    return plot_entities_on_page(
         page_image,
         all_entities,
         box_width=2,
@@ -144,7 +236,28 @@ def plot_selectable_regions(document, page_number, selectable_layers, exclude_en
         page_number=page_number,
     )
 
-    return image_with_selectables
+
+def plot_selectable_regions(document, page_number, selectable_layers, exclude_entities=None):
+    """The page with the regions of `selectable_layers` drawn on it. Without `exclude_entities`,
+    the drawn page is cached, and shouldn't be modified."""
+    if exclude_entities:
+        return _draw_selectable_regions(
+            document, page_number, selectable_layers, exclude_entities
+        )
+
+    key = (page_number, tuple(selectable_layers))
+    with _page_overlays_lock:
+        document_overlays = _page_overlays.setdefault(document, OrderedDict())
+        if key in document_overlays:
+            document_overlays.move_to_end(key)
+            return document_overlays[key]
+
+    overlay = _draw_selectable_regions(document, page_number, selectable_layers)
+    with _page_overlays_lock:
+        document_overlays[key] = overlay
+        while len(document_overlays) > PAGE_OVERLAYS_PER_DOCUMENT:
+            document_overlays.popitem(last=False)
+    return overlay
 
 
 def highlight_section_on_page(document, page_number, section_name, paragraph):
@@ -155,41 +268,21 @@ def highlight_section_on_page(document, page_number, section_name, paragraph):
         if e.metadata["section_name"] == section_name
         and e.metadata["paragraph_reading_order"] == paragraph
     ]
-
-    page_image = plot_selectable_regions(
+    return highlight_entities_on_page(
         document,
         page_number,
-        selectable_layers=["reading_order_sections", TablesFieldName],
-        exclude_entities=section_entities,
-    )
-
-    highlighted = plot_entities_on_page(
-        page_image,
         section_entities,
-        box_width=2,
-        box_alpha=0.2,
-        box_color="green",
-        page_number=page_number,
+        selectable_layers=["reading_order_sections", TablesFieldName],
     )
-    return highlighted
 
 
 def highlight_entities_on_page(document, page_number, entities, selectable_layers):
-    page = document.pages[page_number]
-
-    page_image = plot_selectable_regions(
-        document,
-        page_number,
-        selectable_layers=selectable_layers,
-        exclude_entities=entities,
-    )
-
-    highlighted = plot_entities_on_page(
-        page_image,
+    # the highlight is drawn over the cached page, rather than drawing every region again.
+    return plot_entities_on_page(
+        plot_selectable_regions(document, page_number, selectable_layers),
         entities,
         box_width=2,
         box_alpha=0.2,
         box_color="green",
         page_number=page_number,
     )
-    return highlighted
@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 import os
-from typing import Callable
+from typing import Callable, Optional
 
 from papermage.predictors import BasePredictor
 from streamlit import cache_resource
@@ -22,6 +22,8 @@ class LocalModelInfo:
     model_desc: str
     get_model: Callable[[], BasePredictor]
     use_by_default: bool
+    # the backend service the model calls, if any, whose concurrency is limited in the app config.
+    backend: Optional[str] = None
 
 
 @cache_resource
@@ -41,7 +43,12 @@ def get_mathpix_predictor():
     if not config["mathpix_credentials"] or not config["mathpix_credentials"]["app_key"]:
         raise AssertionError("No MathPix API Key provided in config! Skipping predictor.")
 
-    return MathPixTableStructurePredictor(mathpix_headers=config["mathpix_credentials"])
+    return MathPixTableStructurePredictor(
+        mathpix_headers=config["mathpix_credentials"],
+        mathpix_url=config["mathpix_url"],
+        cache_dir=config["mathpix_cache_path"],
+        max_concurrent_requests=config["mathpix_concurrency"],
+    )
 
 
 MODEL_LIST: list[LocalModelInfo] = [
@@ -62,12 +69,14 @@ MODEL_LIST: list[LocalModelInfo] = [
         model_desc="A model that uses ChemDataExtractor to tag chemicals.",
         get_model=get_cde_predictor,
         use_by_default=False,
+        backend="chemdataextractor",
     ),
     LocalModelInfo(
         model_name="MatIE Information Extractor",
         model_desc="A model that tags material properties and relations.",
         get_model=get_matie_predictor,
         use_by_default=True,
+        backend="matie",
     ),
 ]
 
@@ -2,11 +2,15 @@ import pandas as pd
 from streamlit.column_config import TextColumn
 
 from interface_utils import *
-from interface_utils import get_entity_types, infer_token_predictors
+from interface_utils import (
+    get_entity_types,
+    infer_token_predictors,
+    load_document_graph,
+    load_document_summary,
+)
 from papermage_components.matie_heuristics import (
     get_most_common_materials,
     get_composition_table,
-    create_document_graph,
     get_property_table,
     get_synthesis_method_table,
 )
@@ -15,39 +19,12 @@ from papermage_components.utils import visualize_table_with_boxes
 st.set_page_config(layout="wide")
 
 
-file_options = os.listdir(PARSED_PAPER_FOLDER)
+file_options = list_parsed_papers()
 show_text_annotations_from = {}
 show_image_annotations_from = {}
 model_entity_type_filter = {}
 
 
-def get_tagged_entities(doc, model_name, allowed_sections, allowed_types):
-    all_entities = []
-    for section in doc.reading_order_sections:
-        if section.metadata["section_name"] not in allowed_sections:
-            continue
-        for entity in getattr(section, f"TAGGED_ENTITIES_{model_name}", []):
-            if entity.metadata["entity_type"] not in allowed_types:
-                continue
-            sentences = entity.sentences
-            if sentences:
-                sentence_context = sentences[0].text
-            else:
-                sentence_context = "Not found."
-
-            all_entities.append(
-                {
-                    "entity_type": entity.metadata["entity_type"],
-                    "entity_text": entity.text,
-                    "entity_section": section.metadata["section_name"],
-                    "sentence_context": sentence_context,
-                    "source_model": model_name,
-                }
-            )
-
-    return all_entities
-
-
 def get_processed_images(doc, model_name):
     layer = getattr(doc, f"TAGGED_IMAGE_{model_name}")
     return layer.entities
@@ -63,6 +40,7 @@ with st.sidebar:
     )
     st.session_state["focus_document"] = file_selector
     focus_document = load_document(file_selector)
+    focus_summary = load_document_summary(file_selector, focus_document)
 
     st.write("Show predicted results from:")
 
@@ -70,10 +48,14 @@ with st.sidebar:
         show_text_annotations_from[model_name] = st.toggle(model_name, value=True)
         if show_text_annotations_from[model_name]:
             model_entity_types = get_entity_types(model_name, focus_document)
+            type_counts = focus_summary.type_counts.get(model_name, {})
             model_entity_type_filter[model_name] = st.multiselect(
                 "Entity types to display:",
                 options=model_entity_types,
                 default=model_entity_types,
+                format_func=lambda entity_type: (
+                    f"{entity_type} ({type_counts.get(entity_type, 0)})"
+                ),
                 key=f"entity_type_select_{model_name}",
             )
 
@@ -87,27 +69,24 @@ with entities_column:
     existing_tab, heuristics_tab = st.tabs(["Entity Overview", "Material Heuristics"])
     with existing_tab:
         st.write("## Tagged Entities")
-        all_sections = {e.metadata["section_name"] for e in focus_document.reading_order_sections}
-
         section_choice = st.multiselect(
             label="Choose sections from which to display entities",
-            options=all_sections,
-            default=all_sections,
+            options=focus_summary.sections,
+            default=focus_summary.sections,
         )
 
-        entities = []
-        for predictor_name, show in show_text_annotations_from.items():
-            if show:
-                entities = entities + get_tagged_entities(
-                    focus_document,
-                    predictor_name,
-                    allowed_sections=section_choice,
-                    allowed_types=model_entity_type_filter[predictor_name],
-                )
+        entities = focus_summary.filter_entities(
+            {
+                predictor_name: model_entity_type_filter[predictor_name]
+                for predictor_name, show in show_text_annotations_from.items()
+                if show
+            },
+            section_choice,
+        )
 
         st.write(f"Found {len(entities)} entities:")
         st.dataframe(
-            pd.DataFrame(entities),
+            entities,
             hide_index=True,
             use_container_width=True,
             column_config={
@@ -120,7 +99,7 @@ with entities_column:
 
     with heuristics_tab:
         if getattr(focus_document, "TAGGED_ENTITIES_MatIE"):
-            doc_graph = create_document_graph(focus_document, str(focus_document.symbols[:50]))
+            doc_graph = load_document_graph(focus_document)
 
             st.write("## Most common materials")
             most_frequent_materials = get_most_common_materials(
@@ -22,7 +22,7 @@ st.set_page_config(layout="wide")
 # CONSTANTS
 BOX_PADDING = 0.01
 
-file_options = os.listdir(PARSED_PAPER_FOLDER)
+file_options = list_parsed_papers()
 show_text_annotations_from = {}
 show_image_annotations_from = {}
 model_entity_type_filter = {}
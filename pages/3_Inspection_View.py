@@ -2,6 +2,7 @@ from streamlit_image_coordinates import streamlit_image_coordinates
 
 from interface_utils import *
 from papermage import Box
+from papermage_components.serialization import layer_has_boxes
 from papermage_components.utils import (
     get_table_images,
 )
@@ -12,7 +13,7 @@ st.set_page_config(layout="wide")
 # CONSTANTS
 BOX_PADDING = 0.01
 
-file_options = os.listdir(PARSED_PAPER_FOLDER)
+file_options = list_parsed_papers()
 
 
 LAYER_EXCLUDES = ["symbols", "images", "metadata"]
@@ -24,7 +25,7 @@ def get_layers_with_boxes(document) -> list[str]:
     return [
         layer
         for layer in document.layers
-        if layer not in LAYER_EXCLUDES and all([e.boxes for e in getattr(document, layer)])
+        if layer not in LAYER_EXCLUDES and layer_has_boxes(document, layer)
     ]
 
 
@@ -0,0 +1,173 @@
+import pandas as pd
+from streamlit.column_config import TextColumn
+
+from interface_utils import *
+from interface_utils import get_corpus_graph, get_corpus_index, load_corpus_graph
+from papermage_components.corpus_index import EntityQuery
+
+st.set_page_config(layout="wide")
+
+ANY_TYPE = "Any type"
+RESULT_LIMIT = 1000
+
+corpus_index = get_corpus_index()
+entity_types = [ANY_TYPE] + corpus_index.get_entity_types()
+corpus_graph = load_corpus_graph()
+
+
+def entity_query_input(key: str, label: str) -> EntityQuery:
+    type_column, text_column = st.columns([0.3, 0.7])
+    with type_column:
+        entity_type = st.selectbox(f"{label} type", options=entity_types, key=f"{key}_type")
+    with text_column:
+        text = st.text_input(
+            f"{label} text", key=f"{key}_text", placeholder="e.g. IN718, creep rupture"
+        )
+    return EntityQuery(
+        text=text.strip() or None,
+        entity_type=None if entity_type == ANY_TYPE else entity_type,
+    )
+
+
+def is_empty(query: EntityQuery) -> bool:
+    return query.text is None and query.entity_type is None
+
+
+with st.sidebar:
+    stats = corpus_index.get_stats()
+    st.write("## Corpus Index")
+    st.metric("Papers", stats["papers"])
+    st.metric("Entities", stats["entities"])
+    st.metric("Relations", stats["relations"])
+    st.write(
+        "Papers are indexed as they are processed. Run `python index_papers.py` to index papers "
+        "processed before the index existed."
+    )
+
+    st.write("## Corpus Graph")
+    st.metric("Entities", corpus_graph.num_nodes)
+    st.metric("Relations", corpus_graph.num_edges)
+    pending = get_corpus_graph().count_pending()
+    if pending:
+        st.write(f"{pending} papers are waiting to be merged into the graph.")
+        if st.button("Merge now"):
+            with st.spinner("Merging..."):
+                get_corpus_graph().merge()
+            st.rerun()
+
+
+papers_tab, entities_tab, relations_tab, graph_tab = st.tabs(
+    ["Find Papers", "Entity Mentions", "Relations", "Knowledge Graph"]
+)
+
+with papers_tab:
+    st.write("## Papers mentioning all of:")
+    if "corpus_search_conditions" not in st.session_state:
+        st.session_state["corpus_search_conditions"] = 2
+    queries = [
+        entity_query_input(f"condition_{i}", f"Entity {i + 1}")
+        for i in range(st.session_state["corpus_search_conditions"])
+    ]
+    if st.button("Add condition"):
+        st.session_state["corpus_search_conditions"] += 1
+        st.rerun()
+
+    queries = [query for query in queries if not is_empty(query)]
+    if queries:
+        papers = corpus_index.find_papers(queries, limit=RESULT_LIMIT)
+        st.write(f"Found {len(papers)} papers:")
+        paper_rows = []
+        for paper in papers:
+            row = {"paper": paper["filename"]}
+            for i, count in enumerate(paper["matches"]):
+                row[f"entity {i + 1} mentions"] = count
+            paper_rows.append(row)
+        st.dataframe(
+            pd.DataFrame(paper_rows),
+            hide_index=True,
+            use_container_width=True,
+        )
+        if papers:
+            focus_paper = st.selectbox(
+                "Open a paper in the Summary View", options=[paper["filename"] for paper in papers]
+            )
+            if st.button("Open"):
+                st.session_state["focus_document"] = focus_paper
+                st.switch_page("pages/1_Summary_View.py")
+
+with entities_tab:
+    st.write("## Entity mentions")
+    entity_query = entity_query_input("mentions", "Entity")
+    if not is_empty(entity_query):
+        entities = corpus_index.find_entities(entity_query, limit=RESULT_LIMIT)
+        st.write(f"Found {len(entities)} mentions (showing at most {RESULT_LIMIT}):")
+        st.dataframe(
+            pd.DataFrame(entities),
+            hide_index=True,
+            use_container_width=True,
+            column_order=[
+                "filename", "entity_type", "text", "section", "page", "sentence", "model"
+            ],
+            column_config={
+                "sentence": TextColumn(label="Sentence Context", width="large"),
+                "entity_type": TextColumn("Entity Type", width=None),
+                "text": TextColumn("Text", width=None),
+                "section": TextColumn("Section", width=None),
+            },
+        )
+
+with relations_tab:
+    st.write("## Relations found by MatIE")
+    arg1_query = entity_query_input("relation_arg1", "First entity")
+    arg2_query = entity_query_input("relation_arg2", "Second entity")
+    if not (is_empty(arg1_query) and is_empty(arg2_query)):
+        relations = corpus_index.find_relations(arg1_query, arg2_query, limit=RESULT_LIMIT)
+        st.write(f"Found {len(relations)} relations (showing at most {RESULT_LIMIT}):")
+        st.dataframe(
+            pd.DataFrame(relations),
+            hide_index=True,
+            use_container_width=True,
+            column_config={"sentence": TextColumn(label="Sentence Context", width="large")},
+        )
+
+with graph_tab:
+    st.write("## Entities related across papers")
+    st.write(
+        "Mentions of the same entity in different papers are merged, ignoring case (except for "
+        "materials and numbers), punctuation and spacing."
+    )
+    graph_types = [ANY_TYPE] + corpus_graph.entity_types
+    type_column, text_column = st.columns([0.3, 0.7])
+    with type_column:
+        node_type = st.selectbox("Entity type", options=graph_types, key="graph_node_type")
+    with text_column:
+        node_text = st.text_input("Entity text", key="graph_node_text", placeholder="e.g. IN718")
+    if node_text.strip():
+        nodes = corpus_graph.find_nodes(
+            node_text, entity_type=None if node_type == ANY_TYPE else node_type
+        )
+        if not nodes:
+            st.write("No matching entities.")
+        else:
+            node = st.selectbox(
+                "Entity",
+                options=nodes,
+                format_func=lambda node: (
+                    f"{node['text']} ({node['entity_type']}, {node['degree']} relations)"
+                ),
+            )
+            relation_column, neighbor_column = st.columns(2)
+            with relation_column:
+                relation_type = st.selectbox(
+                    "Relation type", options=[ANY_TYPE] + corpus_graph.relation_names
+                )
+            with neighbor_column:
+                neighbor_type = st.selectbox("Related entity type", options=graph_types)
+            neighbors = corpus_graph.neighbors(
+                node["node"],
+                relation_type=None if relation_type == ANY_TYPE else relation_type,
+                neighbor_type=None if neighbor_type == ANY_TYPE else neighbor_type,
+                limit=RESULT_LIMIT,
+            )
+            st.write(f"Found {len(neighbors)} related entities (showing at most {RESULT_LIMIT}):")
+            st.dataframe(pd.DataFrame(neighbors), hide_index=True, use_container_width=True)
@@ -0,0 +1,379 @@
+"""
+Background worker for papers uploaded through the app.
+
+The Upload Paper page only saves the PDF and queues a job; this worker claims queued jobs, runs
+the pipeline on them, and records the progress of each stage so the page can show it. The app
+starts workers itself (see `start_paper_workers` in `Upload_Paper.py`), but they can also be run
+on their own:
+
+    python paper_worker.py --num_workers 2
+"""
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache, partial
+import logging
+import os
+import time
+import traceback
+from typing import Callable, Optional
+import warnings
+
+import fire
+from papermage.magelib import (
+    BlocksFieldName,
+    Document,
+    SentencesFieldName,
+    WordsFieldName,
+)
+from papermage.predictors import BasePredictor
+from papermage.utils.annotate import group_by
+
+from app_config import app_config as config
+from local_model_config import AVAILABLE_LOCAL_MODELS
+from papermage_components.backend_limits import backend_slot
+from papermage_components.corpus_graph import CorpusGraph
+from papermage_components.corpus_index import CorpusIndex
+from papermage_components.document_summary import write_document_summary
+from papermage_components.forked_workers import map_with_forked_workers
+from papermage_components.hf_token_classification_predictor import HfTokenClassificationPredictor
+from papermage_components.instrumentation import PipelineMetrics, add_count
+from papermage_components.job_queue import (
+    STAGE_COMPLETE,
+    STAGE_ERROR,
+    STAGE_RUNNING,
+    Job,
+    JobQueue,
+    pid_is_alive,
+)
+from papermage_components.llm_completion_predictor import (
+    LiteLlmCompletionPredictor,
+    get_prompt_generator,
+)
+from papermage_components.materials_recipe import MaterialsRecipe, VILA_LABELS_MAP
+from papermage_components.page_images import page_sizes_for_stage, rasterized_for_stage
+from papermage_components.relation_graph import (
+    MATIE_LAYER_NAME,
+    attach_document_graph,
+    get_document_graph,
+)
+from papermage_components.serialization import append_layers, load_document, save_document
+from papermage_components.utils import set_boxes_and_text_from_tokens
+
+# the recipe components the basic parse needs, loaded before forking workers.
+PARSE_COMPONENTS = [
+    "grobid_order_parser",
+    "word_predictor",
+    "sent_predictor",
+    "publaynet_block_predictor",
+    "ivila_predictor",
+]
+
+logger = logging.getLogger(__name__)
+
+
+def limit_backend(backend: Optional[str]):
+    """Hold one of the configured slots for a backend service while using it."""
+    return backend_slot(
+        backend,
+        config["backend_concurrency"].get(backend),
+        config["backend_lock_path"],
+    )
+
+
+def make_recipe() -> MaterialsRecipe:
+    return MaterialsRecipe(
+        # matIE_directory="/Users/sireeshgururaja/src/MatIE",
+        grobid_server_url=config["grobid_url"],
+        gpu_id="mps",
+        dpi=150,
+    )
+
+
+@lru_cache(maxsize=None)
+def get_hf_tagger(model_name):
+    return HfTokenClassificationPredictor(model_name, device="cpu")
+
+
+class StageRecorder:
+    """Records the progress of each stage of a job in the queue, for the app to display, and
+    measures each stage, for the document's metadata."""
+
+    def __init__(self, queue: JobQueue, job: Job):
+        self.queue = queue
+        self.job = job
+        self.stages = []
+        self.metrics = PipelineMetrics()
+
+    @contextmanager
+    def stage(
+        self, name: str, label: str, required: bool = True, doc: Optional[Document] = None
+    ):
+        """Run a stage. If a required stage fails, the error is re-raised, failing the job;
+        failures in other stages are recorded, and the job carries on. `name` identifies the stage
+        in the metrics, and `doc`, if given, is the document whose new layers are counted."""
+        stage = {"label": label, "state": STAGE_RUNNING, "message": None}
+        self.stages.append(stage)
+        self.queue.set_stages(self.job.job_id, self.stages)
+        try:
+            with self.metrics.stage(name, doc):
+                yield stage
+        except Exception as e:
+            logger.error(f"Stage '{label}' of job {self.job.job_id} failed", exc_info=True)
+            stage["state"] = STAGE_ERROR
+            stage["message"] = f"{type(e).__name__}: {e}"
+            self.queue.set_stages(self.job.job_id, self.stages)
+            if required:
+                raise
+        else:
+            stage["state"] = STAGE_COMPLETE
+            self.queue.set_stages(self.job.job_id, self.stages)
+
+
+def parse_pdf(pdf: str, recipe: MaterialsRecipe, recorder: StageRecorder) -> Document:
+    parsed_doc_filename = os.path.join(config["processed_paper_path"], recorder.job.output_filename)
+    if os.path.exists(parsed_doc_filename):
+        with recorder.stage(
+            "load_cached", "Paper has already been parsed! Using cached version..."
+        ):
+            # the layers tagged by earlier runs are kept; layers are only loaded when used.
+            return load_document(parsed_doc_filename, lazy=True)
+
+    with recorder.stage("parse", "Parsing PDF..."):
+        doc = recipe.pdfplumber_parser.parse(input_pdf_path=pdf)
+        add_count("pages", len(doc.pages))
+        add_count("tokens", len(doc.tokens))
+
+    with recorder.stage(
+        "reading_order", "Getting sections in reading order...", doc=doc
+    ), limit_backend("grobid"):
+        doc = recipe.grobid_order_parser.parse(
+            pdf,
+            doc,
+        )
+
+    with recorder.stage("rasterize", "Rasterizing Document..."):
+        images = recipe.rasterizer.rasterize(input_pdf_path=pdf, dpi=recipe.dpi)
+        doc.annotate_images(images=list(images))
+        recipe.rasterizer.attach_images(images=images, doc=doc)
+
+    with recorder.stage("words", "Predicting words...", doc=doc):
+        words = recipe.word_predictor.predict(doc=doc)
+        doc.annotate_layer(name=WordsFieldName, entities=words)
+
+    with recorder.stage("sentences", "Predicting sentences...", doc=doc):
+        sentences = recipe.sent_predictor.predict(doc=doc)
+        doc.annotate_layer(name=SentencesFieldName, entities=sentences)
+
+    with recorder.stage("blocks", "Predicting blocks...", doc=doc):
+        with warnings.catch_warnings(), rasterized_for_stage(doc, pdf, recipe.block_dpi):
+            warnings.simplefilter("ignore")
+            blocks = recipe.publaynet_block_predictor.predict(doc=doc)
+        doc.annotate_layer(name=BlocksFieldName, entities=blocks)
+
+    with recorder.stage("vila", "Predicting vila...", doc=doc):
+        with page_sizes_for_stage(doc, pdf, recipe.vila_dpi):
+            vila_entities = recipe.ivila_predictor.predict(doc=doc)
+        doc.annotate_layer(name="vila_entities", entities=vila_entities)
+        set_boxes_and_text_from_tokens(vila_entities, doc)
+        preds = group_by(
+            entities=vila_entities, metadata_field="label", metadata_values_map=VILA_LABELS_MAP
+        )
+        doc.annotate(*preds)
+
+    return doc
+
+
+def record_entity_types(paper: Document, predictor) -> None:
+    if "entity_types" not in paper.metadata:
+        paper.metadata["entity_types"] = {}
+    paper.metadata["entity_types"][predictor.predictor_identifier] = predictor.entity_types
+
+
+@dataclass
+class CustomModel:
+    """A model selected in a job's pipeline config, to run on top of the basic parse."""
+
+    name: str
+    label: str
+    get_predictor: Callable[[], BasePredictor]
+    # the backend service the model calls, if any.
+    backend: Optional[str] = None
+
+
+def get_local_model(model_name: str) -> BasePredictor:
+    return AVAILABLE_LOCAL_MODELS[model_name].get_model()
+
+
+def get_llm_predictor(llm_config: dict) -> LiteLlmCompletionPredictor:
+    return LiteLlmCompletionPredictor(
+        model_name=llm_config["model_name"],
+        api_key=llm_config["api_key"],
+        prompt_generator_function=get_prompt_generator(llm_config["prompt_string"]),
+        prompt_string=llm_config["prompt_string"],
+    )
+
+
+def get_custom_models(pipeline_config: dict) -> list[CustomModel]:
+    """The models selected in a pipeline config, in the order they're run."""
+    custom_models = []
+    for local_predictor in pipeline_config.get("local_predictors", []):
+        model_info = AVAILABLE_LOCAL_MODELS.get(local_predictor)
+        custom_models.append(
+            CustomModel(
+                name=local_predictor,
+                label=f"Running model {local_predictor}",
+                get_predictor=partial(get_local_model, local_predictor),
+                backend=model_info.backend if model_info else None,
+            )
+        )
+    for token_predictor in pipeline_config.get("token_predictors", []):
+        custom_models.append(
+            CustomModel(
+                name=token_predictor,
+                label=f"Running model {token_predictor}",
+                get_predictor=partial(get_hf_tagger, token_predictor),
+            )
+        )
+    for llm_config in pipeline_config.get("llm_predictors", []):
+        custom_models.append(
+            CustomModel(
+                name=llm_config["model_name"],
+                label=f"Generating responses from {llm_config['model_name']}",
+                get_predictor=partial(get_llm_predictor, llm_config),
+            )
+        )
+    return custom_models
+
+
+def run_custom_model(
+    paper: Document, pdf: Optional[str], predictor: BasePredictor, backend: Optional[str] = None
+) -> list[str]:
+    """Run a predictor on a paper, replacing the layer from any earlier run of it, and return the
+    names of the layers it changed: its own, and any whose metadata it adds to (its
+    `UPDATED_DOCUMENT_FIELDS`). Without a PDF, image predictors use the page images stored with the
+    paper."""
+    with rasterized_for_stage(
+        paper, pdf, getattr(predictor, "dpi", None)
+    ), limit_backend(backend):
+        model_entities = predictor.predict(paper)
+    layer_name = predictor.preferred_layer_name
+    paper.remove_layer(layer_name)
+    paper.annotate_layer(layer_name, model_entities)
+    if layer_name == MATIE_LAYER_NAME:
+        attach_document_graph(paper)
+    if getattr(predictor, "entity_types", None):
+        record_entity_types(paper, predictor)
+    return [layer_name] + list(getattr(predictor, "UPDATED_DOCUMENT_FIELDS", []))
+
+
+def run_custom_models(
+    paper: Document, pdf: Optional[str], custom_models: list[CustomModel], recorder: StageRecorder
+) -> list[str]:
+    """Run each model on the paper, in its own stage, returning the names of the layers they
+    produced. A model that fails doesn't stop the others."""
+    layer_names = []
+    for custom_model in custom_models:
+        with recorder.stage(custom_model.name, custom_model.label, required=False, doc=paper):
+            predictor = custom_model.get_predictor()
+            layer_names.extend(run_custom_model(paper, pdf, predictor, custom_model.backend))
+    return layer_names
+
+
+def process_job(recipe: MaterialsRecipe, queue: JobQueue, job: Job) -> None:
+    recorder = StageRecorder(queue, job)
+    output_path = os.path.join(config["processed_paper_path"], job.output_filename)
+    try:
+        already_parsed = os.path.exists(output_path)
+        parsed_paper = parse_pdf(job.pdf_path, recipe, recorder)
+        new_layers = run_custom_models(
+            parsed_paper, job.pdf_path, get_custom_models(job.pipeline_config), recorder
+        )
+        recorder.metrics.attach(parsed_paper)
+        with recorder.stage("save", "Finishing up..."):
+            if already_parsed:
+                # only the new layers are written; the rest of the stored paper is kept as is.
+                append_layers(parsed_paper, output_path, new_layers)
+            else:
+                save_document(
+                    parsed_paper, output_path, page_image_dir=config["page_image_path"]
+                )
+        # after only appending layers, the stored paper also has the layers of earlier runs.
+        stored_paper = load_document(output_path, lazy=True) if already_parsed else parsed_paper
+        with recorder.stage("summary", "Summarizing entities...", required=False):
+            write_document_summary(
+                stored_paper, config["document_summary_path"], job.output_filename
+            )
+        with recorder.stage("index", "Indexing entities...", required=False):
+            CorpusIndex(config["corpus_index_path"]).index_document(
+                job.output_filename, stored_paper, os.path.getmtime(output_path)
+            )
+        with recorder.stage("graph", "Adding relations to the corpus graph...", required=False):
+            corpus_graph = CorpusGraph(config["corpus_graph_path"])
+            corpus_graph.add_paper(job.output_filename, get_document_graph(stored_paper))
+            if corpus_graph.count_pending() >= config["corpus_graph_merge_batch_size"]:
+                corpus_graph.merge()
+    except Exception:
+        queue.finish(job.job_id, error=traceback.format_exc())
+    else:
+        queue.finish(job.job_id)
+
+
+def run_worker_loop(
+    recipe: MaterialsRecipe,
+    queue_path: str,
+    poll_interval: float = 1.0,
+    parent_pid: Optional[int] = None,
+) -> None:
+    """Claim and process jobs until interrupted, or until `parent_pid` exits."""
+    queue = JobQueue(queue_path)
+    while parent_pid is None or pid_is_alive(parent_pid):
+        job = queue.claim()
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        logger.info(f"Processing job {job.job_id} ({job.pdf_path})")
+        process_job(recipe, queue, job)
+
+
+def _run_forked_worker_loop(shared_state: tuple, worker_index: int) -> None:
+    recipe, queue_path, poll_interval, parent_pid = shared_state
+    run_worker_loop(recipe, queue_path, poll_interval, parent_pid)
+
+
+def run_paper_workers(
+    num_workers: int = 1,
+    queue_path: str = config["job_queue_path"],
+    poll_interval: float = 1.0,
+    parent_pid: Optional[int] = None,
+) -> None:
+    """Process queued papers with `num_workers` workers, which share one copy of the models.
+
+    Parameters
+    ----------
+    num_workers : How many papers to process at once.
+    queue_path : The job queue database.
+    poll_interval : How long to wait, in seconds, before checking an empty queue again.
+    parent_pid : If given, exit once this process does, i.e. when the app that started the
+        workers shuts down.
+    """
+    queue = JobQueue(queue_path)
+    if requeued := queue.requeue_abandoned():
+        logger.info(f"Requeued {requeued} jobs abandoned by workers that exited.")
+
+    recipe = make_recipe()
+    if num_workers == 1:
+        run_worker_loop(recipe, queue_path, poll_interval, parent_pid)
+        return
+
+    recipe.prewarm(PARSE_COMPONENTS)
+    shared_state = (recipe, queue_path, poll_interval, parent_pid)
+    for _ in map_with_forked_workers(
+        _run_forked_worker_loop, shared_state, range(num_workers), num_workers
+    ):
+        pass
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    fire.Fire(run_paper_workers)
@@ -0,0 +1,42 @@
+"""
+Limit how many processes use a backend service (GROBID, MatIE...) at once.
+
+Each backend gets `limit` slots, each a lock file; a process holds one of the slots for as long as
+it's using the backend. File locks work across every worker process on the machine, however they
+were started, and are released automatically if a worker dies while holding one.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import os
+import time
+from typing import Optional
+
+
+@contextmanager
+def backend_slot(
+    backend: str, limit: Optional[int], lock_dir: str, poll_interval: float = 0.5
+):
+    """Wait for one of the `limit` slots for `backend` to be free, and hold it for the duration of
+    the block. A limit of None or 0 means no limit."""
+    if not limit:
+        yield
+        return
+
+    os.makedirs(lock_dir, exist_ok=True)
+    while True:
+        for slot in range(limit):
+            lock_file = open(os.path.join(lock_dir, f"{backend}.{slot}.lock"), "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+            return
+        time.sleep(poll_interval)
@@ -1,18 +1,30 @@
 from typing import List
 
-from papermage.magelib import Metadata
-import requests
+from papermage.magelib import Document, Entity, Metadata
 
+from papermage_components.instrumentation import add_count
 from papermage_components.interfaces.token_classification_predictor import (
     TokenClassificationPredictorABC,
     EntityCharSpan,
 )
+from papermage_components.service_sessions import service_post
 
 
 class ChemDataExtractorPredictor(TokenClassificationPredictorABC):
-    def __init__(self, cde_service_url):
+    def __init__(self, cde_service_url, max_batch_chars=20_000, max_concurrent_batches=4):
+        """
+        Parameters
+        ----------
+        cde_service_url : The URL of the ChemDataExtractor service.
+        max_batch_chars : Sentences from across the document are sent together, in requests of up
+            to this many characters (or a single longer sentence).
+        max_concurrent_batches : How many batches, i.e. requests to the service, may be in flight
+            at once.
+        """
         super().__init__()
         self.cde_service_url = cde_service_url
+        self.max_batch_chars = max_batch_chars
+        self.max_concurrent_batches = max_concurrent_batches
 
     @property
     def predictor_identifier(self) -> str:
@@ -22,11 +34,27 @@ class ChemDataExtractorPredictor(TokenClassificationPredictorABC):
     def entity_types(self) -> set[str]:
         return ["CDE_Chemical"]
 
-    def tag_entities_in_batch(self, batch: List[str]) -> List[List[EntityCharSpan]]:
-        req = requests.post(self.cde_service_url + "/annotate_strings", json=batch, timeout=300)
+    def generate_batches(self, doc: Document) -> list[list[tuple[Entity, str]]]:
+        """Pack the sentences of all paragraphs, in order, into batches of up to
+        `max_batch_chars` characters, rather than sending one paragraph per request."""
+        batches = []
+        batch, batch_chars = [], 0
+        for paragraph_batch in super().generate_batches(doc):
+            for sentence, text in paragraph_batch:
+                if batch and batch_chars + len(text) > self.max_batch_chars:
+                    batches.append(batch)
+                    batch, batch_chars = [], 0
+                batch.append((sentence, text))
+                batch_chars += len(text)
+        if batch:
+            batches.append(batch)
+        return batches
 
-        if req.status_code != 200:
-            raise Exception(f"Request returned status code of {req.status_code}!")
+    def tag_entities_in_batch(self, batch: List[str]) -> List[List[EntityCharSpan]]:
+        add_count("requests")
+        req = service_post(
+            "chemdataextractor", self.cde_service_url + "/annotate_strings", json=batch
+        )
         entity_list = [
             [
                 EntityCharSpan(
@@ -1,10 +1,28 @@
-from typing import List
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import threading
+import time
+from typing import Deque, List, Tuple
 
 from chemdataextractor import Document
 import fastapi
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 
+# worker processes that annotate strings; defaults to one per core.
+NUM_WORKERS = int(os.environ.get("CDE_WORKERS", 0)) or os.cpu_count() or 1
+# each request's strings are split into chunks of about this many characters, annotated in
+# parallel.
+CHUNK_CHARS = int(os.environ.get("CDE_CHUNK_CHARS", 4000))
+# larger requests are rejected with a 413.
+MAX_REQUEST_CHARS = int(os.environ.get("CDE_MAX_REQUEST_CHARS", 500_000))
+MAX_REQUEST_STRINGS = int(os.environ.get("CDE_MAX_REQUEST_STRINGS", 10_000))
+# the window over which /status reports throughput.
+THROUGHPUT_WINDOW_SECONDS = 60.0
+
 
 app = FastAPI()
 
@@ -16,18 +34,8 @@ class EntityCharSpanResponse(BaseModel):
     entity_type: str
 
 
-@app.get("/")
-def get_root():
-    return {"hello": "world"}
-
-
-@app.get("/status")
-def get_status():
-    return "Service is up!"
-
-
-@app.post("/annotate_strings")
-def annotate_strings(strings: List[str]) -> List[List[EntityCharSpanResponse]]:
+def annotate_chunk(strings: List[str]) -> List[List[dict]]:
+    """Annotate a list of strings in one ChemDataExtractor document. Runs in a worker process."""
     document = Document(*strings)
 
     # compute all mentions before iterating through them
@@ -37,12 +45,148 @@ def annotate_strings(strings: List[str]) -> List[List[EntityCharSpanResponse]]:
     for element in document.elements:
         element_entities = []
         for entity in element.cems:
-            entity = EntityCharSpanResponse(
-                text=entity.text,
-                start_char=entity.start,
-                end_char=entity.end,
-                entity_type="CDE_Chemical",
+            element_entities.append(
+                dict(
+                    text=entity.text,
+                    start_char=entity.start,
+                    end_char=entity.end,
+                    entity_type="CDE_Chemical",
+                )
             )
-            element_entities.append(entity)
         all_entities.append(element_entities)
     return all_entities
+
+
+def load_models() -> None:
+    # ChemDataExtractor loads its models on first use; do that when the worker starts, rather than
+    # on its first request.
+    annotate_chunk(["Warming up with NaCl."])
+
+
+def chunk_strings(strings: List[str], chunk_chars: int) -> List[List[str]]:
+    """Split strings, in order, into chunks of up to `chunk_chars` characters (or a single longer
+    string)."""
+    chunks = []
+    chunk, current_chars = [], 0
+    for string in strings:
+        if chunk and current_chars + len(string) > chunk_chars:
+            chunks.append(chunk)
+            chunk, current_chars = [], 0
+        chunk.append(string)
+        current_chars += len(string)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+class ServiceStats:
+    def __init__(self):
+        self.started_at = time.time()
+        self.requests_in_flight = 0
+        self.chunks_in_flight = 0
+        self.total_requests = 0
+        self.total_strings = 0
+        self.total_chars = 0
+        self.rejected_requests = 0
+        # (finish time, strings, chars) of recent requests.
+        self.recent: Deque[Tuple[float, int, int]] = deque()
+        self.lock = threading.Lock()
+
+    def record_finished(self, num_strings: int, num_chars: int) -> None:
+        now = time.time()
+        with self.lock:
+            self.total_requests += 1
+            self.total_strings += num_strings
+            self.total_chars += num_chars
+            self.recent.append((now, num_strings, num_chars))
+            while self.recent and self.recent[0][0] < now - THROUGHPUT_WINDOW_SECONDS:
+                self.recent.popleft()
+
+    def to_dict(self) -> dict:
+        now = time.time()
+        with self.lock:
+            recent = [r for r in self.recent if r[0] >= now - THROUGHPUT_WINDOW_SECONDS]
+            window = min(THROUGHPUT_WINDOW_SECONDS, now - self.started_at) or 1.0
+            return {
+                "status": "Service is up!",
+                "workers": NUM_WORKERS,
+                "requests_in_flight": self.requests_in_flight,
+                "chunks_in_flight": self.chunks_in_flight,
+                # chunks waiting for a free worker.
+                "queue_depth": max(self.chunks_in_flight - NUM_WORKERS, 0),
+                "total_requests": self.total_requests,
+                "total_strings": self.total_strings,
+                "total_chars": self.total_chars,
+                "rejected_requests": self.rejected_requests,
+                "requests_per_second": len(recent) / window,
+                "strings_per_second": sum(r[1] for r in recent) / window,
+                "chars_per_second": sum(r[2] for r in recent) / window,
+            }
+
+
+stats = ServiceStats()
+worker_pool = None
+
+
+@app.on_event("startup")
+def start_worker_pool():
+    global worker_pool
+    worker_pool = ProcessPoolExecutor(
+        max_workers=NUM_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=load_models,
+    )
+
+
+@app.on_event("shutdown")
+def stop_worker_pool():
+    worker_pool.shutdown(wait=False)
+
+
+@app.get("/")
+def get_root():
+    return {"hello": "world"}
+
+
+@app.get("/status")
+def get_status():
+    return stats.to_dict()
+
+
+@app.post("/annotate_strings")
+async def annotate_strings(strings: List[str]) -> List[List[EntityCharSpanResponse]]:
+    num_chars = sum(len(string) for string in strings)
+    if num_chars > MAX_REQUEST_CHARS or len(strings) > MAX_REQUEST_STRINGS:
+        with stats.lock:
+            stats.rejected_requests += 1
+        raise HTTPException(
+            status_code=413,
+            detail=(
+                f"Request has {len(strings)} strings and {num_chars} characters; the limits are "
+                f"{MAX_REQUEST_STRINGS} strings and {MAX_REQUEST_CHARS} characters."
+            ),
+        )
+
+    def chunk_finished(future):
+        with stats.lock:
+            stats.chunks_in_flight -= 1
+
+    # the chunks are annotated in the worker processes, leaving the event loop free to take more
+    # requests meanwhile.
+    loop = asyncio.get_running_loop()
+    chunk_futures = []
+    with stats.lock:
+        stats.requests_in_flight += 1
+        for chunk in chunk_strings(strings, CHUNK_CHARS):
+            chunk_future = loop.run_in_executor(worker_pool, annotate_chunk, chunk)
+            chunk_future.add_done_callback(chunk_finished)
+            chunk_futures.append(chunk_future)
+            stats.chunks_in_flight += 1
+    try:
+        chunk_results = await asyncio.gather(*chunk_futures)
+    finally:
+        with stats.lock:
+            stats.requests_in_flight -= 1
+    stats.record_finished(len(strings), num_chars)
+
+    return [entities for chunk_result in chunk_results for entities in chunk_result]
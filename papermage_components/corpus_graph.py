@@ -0,0 +1,430 @@
+"""
+A knowledge graph of the entities and relations MatIE finds across every processed paper.
+
+Each paper's relation graph (see `relation_graph.py`) is reduced to its contribution: the
+relations between its entities, with the entities' text canonicalized (`canonicalize_entity_string`)
+so that mentions from different papers are merged, and repeated relations counted. Contributions
+are stored one file per paper, so they're only computed once, when a paper is processed.
+
+The merged graph is stored as compressed sparse row (CSR) arrays: the neighbors of node `i` are
+`indices[indptr[i]:indptr[i + 1]]`, with the relation type, direction, number of mentions and
+number of papers of each edge in parallel arrays. Neighborhood queries are then slices of those
+arrays, without building a graph object per paper, or for the corpus. Merging new papers into the
+graph only reads their contributions; papers that were reprocessed or removed since the graph was
+last merged make it rebuild from every contribution.
+"""
+
+from contextlib import contextmanager
+import fcntl
+from functools import cached_property
+import logging
+import os
+from typing import Iterator, Optional
+
+import numpy as np
+
+from papermage_components.relation_graph import DocumentGraph
+from papermage_components.serialization import decode_json, encode_json
+from papermage_components.utils import canonicalize_entity_string
+
+logger = logging.getLogger(__name__)
+
+GRAPH_FILENAME = "graph.npz"
+CONTRIBUTIONS_FOLDER = "papers"
+# edge directions: whether the node is the first or the second argument of the relation.
+OUTGOING = 1
+INCOMING = -1
+
+
+def get_contribution(doc_graph: Optional[DocumentGraph]) -> dict[str, np.ndarray]:
+    """A paper's contribution to the corpus graph: its distinct relations between canonicalized
+    entities, and how many times each was mentioned."""
+    nodes = {}
+    relation_names = {}
+    edge_mentions = {}
+    if doc_graph is not None:
+        node_keys = [
+            (entity_type, canonicalize_entity_string(text, entity_type))
+            for entity_type, text in zip(doc_graph.node_types, doc_graph.node_texts)
+        ]
+        for node1, node2, relation_type in doc_graph.edges:
+            source = nodes.setdefault(node_keys[node1], len(nodes))
+            target = nodes.setdefault(node_keys[node2], len(nodes))
+            relation = relation_names.setdefault(relation_type, len(relation_names))
+            edge = (source, target, relation)
+            edge_mentions[edge] = edge_mentions.get(edge, 0) + 1
+
+    edges = np.array(list(edge_mentions), dtype=np.int64).reshape(-1, 3)
+    return {
+        "nodes": encode_json([list(key) for key in nodes]),
+        "relation_names": encode_json(list(relation_names)),
+        "sources": edges[:, 0],
+        "targets": edges[:, 1],
+        "relations": edges[:, 2],
+        "mentions": np.array(list(edge_mentions.values()), dtype=np.int64),
+    }
+
+
+class CompactGraph:
+    """The merged corpus graph, as CSR arrays. Nodes are (entity type, canonical text) pairs;
+    their texts are stored as one string, as canonical texts never contain line breaks."""
+
+    def __init__(
+        self,
+        entity_types: list[str],
+        node_type_ids: np.ndarray,
+        node_texts: list[str],
+        relation_names: list[str],
+        papers: dict[str, float],
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        edge_relations: np.ndarray,
+        edge_directions: np.ndarray,
+        edge_mentions: np.ndarray,
+        edge_papers: np.ndarray,
+    ):
+        self.entity_types = entity_types
+        self.node_type_ids = node_type_ids
+        self.node_texts = node_texts
+        self.relation_names = relation_names
+        # the papers merged into the graph, and the version of each one's contribution.
+        self.papers = papers
+        self.indptr = indptr
+        self.indices = indices
+        self.edge_relations = edge_relations
+        self.edge_directions = edge_directions
+        self.edge_mentions = edge_mentions
+        self.edge_papers = edge_papers
+
+    @classmethod
+    def empty(cls) -> "CompactGraph":
+        no_edges = np.zeros(0, dtype=np.int32)
+        return cls(
+            entity_types=[],
+            node_type_ids=np.zeros(0, dtype=np.int16),
+            node_texts=[],
+            relation_names=[],
+            papers={},
+            indptr=np.zeros(1, dtype=np.int64),
+            indices=no_edges,
+            edge_relations=no_edges,
+            edge_directions=no_edges,
+            edge_mentions=no_edges,
+            edge_papers=no_edges,
+        )
+
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, np.ndarray]) -> "CompactGraph":
+        node_type_ids = arrays["node_type_ids"]
+        node_texts = arrays["node_texts"].tobytes().decode("utf-8").split("\n")
+        return cls(
+            decode_json(arrays["entity_types"]),
+            node_type_ids,
+            node_texts if len(node_type_ids) else [],
+            decode_json(arrays["relation_names"]),
+            decode_json(arrays["papers"]),
+            arrays["indptr"],
+            arrays["indices"],
+            arrays["edge_relations"],
+            arrays["edge_directions"],
+            arrays["edge_mentions"],
+            arrays["edge_papers"],
+        )
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        return {
+            "entity_types": encode_json(self.entity_types),
+            "node_type_ids": self.node_type_ids,
+            "node_texts": np.frombuffer("\n".join(self.node_texts).encode("utf-8"), np.uint8),
+            "relation_names": encode_json(self.relation_names),
+            "papers": encode_json(self.papers),
+            "indptr": self.indptr,
+            "indices": self.indices,
+            "edge_relations": self.edge_relations,
+            "edge_directions": self.edge_directions,
+            "edge_mentions": self.edge_mentions,
+            "edge_papers": self.edge_papers,
+        }
+
+    @cached_property
+    def node_ids(self) -> dict[tuple[str, str], int]:
+        return {
+            (self.entity_types[type_id], text): i
+            for i, (type_id, text) in enumerate(zip(self.node_type_ids.tolist(), self.node_texts))
+        }
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.node_texts)
+
+    @property
+    def num_edges(self) -> int:
+        # each edge is stored once from each end.
+        return len(self.indices) // 2
+
+    def get_node(self, node: int) -> tuple[str, str]:
+        return self.entity_types[self.node_type_ids[node]], self.node_texts[node]
+
+    def get_edges(self) -> tuple[np.ndarray, ...]:
+        """Every edge once, from its first argument: (sources, targets, relations, mentions,
+        papers)."""
+        rows = np.repeat(np.arange(self.num_nodes), np.diff(self.indptr))
+        outgoing = self.edge_directions == OUTGOING
+        return (
+            rows[outgoing],
+            self.indices[outgoing],
+            self.edge_relations[outgoing],
+            self.edge_mentions[outgoing],
+            self.edge_papers[outgoing],
+        )
+
+    def get_node_id(self, entity_type: str, text: str) -> Optional[int]:
+        return self.node_ids.get((entity_type, canonicalize_entity_string(text, entity_type)))
+
+    def get_degrees(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    def find_nodes(
+        self, text: str = "", entity_type: Optional[str] = None, limit: int = 100
+    ) -> list[dict]:
+        """Nodes whose canonical text contains `text`, ignoring case, most connected first."""
+        query = canonicalize_entity_string(text).casefold()
+        degrees = self.get_degrees()
+        type_id = self.entity_types.index(entity_type) if entity_type in self.entity_types else -1
+        matches = [
+            i
+            for i, (node_type_id, node_text) in enumerate(
+                zip(self.node_type_ids.tolist(), self.node_texts)
+            )
+            if (entity_type is None or node_type_id == type_id) and query in node_text.casefold()
+        ]
+        matches.sort(key=lambda i: -degrees[i])
+        return [
+            {
+                "node": i,
+                "entity_type": self.entity_types[self.node_type_ids[i]],
+                "text": self.node_texts[i],
+                "degree": int(degrees[i]),
+            }
+            for i in matches[:limit]
+        ]
+
+    def neighbors(
+        self,
+        node: int,
+        relation_type: Optional[str] = None,
+        neighbor_type: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> list[dict]:
+        """The nodes related to `node`, optionally only by `relation_type` or of `neighbor_type`,
+        with how many times, and in how many papers, each relation was found; most mentioned
+        first. Which papers those are can be looked up in the corpus index."""
+        start, end = self.indptr[node], self.indptr[node + 1]
+        neighbors = self.indices[start:end]
+        keep = np.ones(len(neighbors), dtype=bool)
+        if relation_type is not None:
+            if relation_type not in self.relation_names:
+                return []
+            keep &= self.edge_relations[start:end] == self.relation_names.index(relation_type)
+        if neighbor_type is not None:
+            if neighbor_type not in self.entity_types:
+                return []
+            keep &= self.node_type_ids[neighbors] == self.entity_types.index(neighbor_type)
+
+        positions = start + np.flatnonzero(keep)
+        positions = positions[np.argsort(-self.edge_mentions[positions], kind="stable")][:limit]
+        return [
+            {
+                "entity_type": self.entity_types[self.node_type_ids[self.indices[p]]],
+                "text": self.node_texts[self.indices[p]],
+                "relation_type": self.relation_names[self.edge_relations[p]],
+                "direction": "outgoing" if self.edge_directions[p] == OUTGOING else "incoming",
+                "mentions": int(self.edge_mentions[p]),
+                "papers": int(self.edge_papers[p]),
+            }
+            for p in positions
+        ]
+
+
+def merge_edges(
+    entity_types: list[str],
+    node_type_ids: np.ndarray,
+    node_texts: list[str],
+    relation_names: list[str],
+    papers: dict[str, float],
+    edge_arrays: list[tuple[np.ndarray, ...]],
+) -> CompactGraph:
+    """Build the CSR arrays from edge lists of (sources, targets, relations, mentions, papers),
+    in global node and relation ids, summing the counts of edges that appear more than once."""
+    sources, targets, relations, mentions, paper_counts = (
+        np.concatenate([arrays[i] for arrays in edge_arrays]).astype(np.int64) for i in range(5)
+    )
+    num_nodes, num_relations = len(node_texts), max(len(relation_names), 1)
+    edge_keys = (sources * num_nodes + targets) * num_relations + relations
+    unique_keys, inverse = np.unique(edge_keys, return_inverse=True)
+    mentions = np.bincount(inverse, weights=mentions, minlength=len(unique_keys))
+    paper_counts = np.bincount(inverse, weights=paper_counts, minlength=len(unique_keys))
+    relations = unique_keys % num_relations
+    targets = unique_keys // num_relations % num_nodes
+    sources = unique_keys // num_relations // num_nodes
+
+    # every edge is stored from both of its ends, sorted by node.
+    rows = np.concatenate([sources, targets])
+    order = np.lexsort((np.concatenate([targets, sources]), rows))
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_nodes), out=indptr[1:])
+    directions = np.repeat(np.array([OUTGOING, INCOMING], dtype=np.int8), len(unique_keys))
+    return CompactGraph(
+        entity_types=entity_types,
+        node_type_ids=node_type_ids,
+        node_texts=node_texts,
+        relation_names=relation_names,
+        papers=papers,
+        indptr=indptr,
+        indices=np.concatenate([targets, sources])[order].astype(np.int32),
+        edge_relations=np.concatenate([relations, relations])[order].astype(np.int16),
+        edge_directions=directions[order],
+        edge_mentions=np.concatenate([mentions, mentions])[order].astype(np.int32),
+        edge_papers=np.concatenate([paper_counts, paper_counts])[order].astype(np.int32),
+    )
+
+
+class CorpusGraph:
+    """The corpus graph stored in `graph_dir`, shared by every process that uses the same
+    folder. Papers are added with `add_paper`, and merged into the graph with `merge`."""
+
+    def __init__(self, graph_dir: str):
+        self.graph_dir = graph_dir
+        self.contributions_dir = os.path.join(graph_dir, CONTRIBUTIONS_FOLDER)
+        os.makedirs(self.contributions_dir, exist_ok=True)
+
+    @property
+    def graph_path(self) -> str:
+        return os.path.join(self.graph_dir, GRAPH_FILENAME)
+
+    def _contribution_path(self, filename: str) -> str:
+        return os.path.join(self.contributions_dir, filename + ".npz")
+
+    @contextmanager
+    def _merge_lock(self) -> Iterator[None]:
+        with open(os.path.join(self.graph_dir, "merge.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def add_paper(self, filename: str, doc_graph: Optional[DocumentGraph]) -> None:
+        """Store a paper's contribution, replacing any earlier one. Papers without a relation
+        graph are recorded with an empty contribution."""
+        path = self._contribution_path(filename)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, **get_contribution(doc_graph))
+        os.replace(temp_path, path)
+
+    def remove_paper(self, filename: str) -> None:
+        if os.path.exists(self._contribution_path(filename)):
+            os.remove(self._contribution_path(filename))
+
+    def contributed_papers(self) -> dict[str, float]:
+        """The papers with a stored contribution, and when it was stored."""
+        return {
+            entry.name[: -len(".npz")]: entry.stat().st_mtime
+            for entry in os.scandir(self.contributions_dir)
+            if entry.name.endswith(".npz")
+        }
+
+    def merged_papers(self) -> dict[str, float]:
+        """The papers in the graph as of its last merge, without loading the rest of it."""
+        if not os.path.exists(self.graph_path):
+            return {}
+        with np.load(self.graph_path) as arrays:
+            return decode_json(arrays["papers"])
+
+    def count_pending(self) -> int:
+        """How many papers were added, replaced or removed since the last merge."""
+        contributed = self.contributed_papers()
+        merged = self.merged_papers()
+        changed = sum(merged.get(paper, None) != version for paper, version in contributed.items())
+        return changed + len(merged.keys() - contributed.keys())
+
+    def load(self) -> CompactGraph:
+        """The graph as of its last merge."""
+        if not os.path.exists(self.graph_path):
+            return CompactGraph.empty()
+        with np.load(self.graph_path) as arrays:
+            return CompactGraph.from_arrays({key: arrays[key] for key in arrays.files})
+
+    def merge(self) -> CompactGraph:
+        """Merge the papers added since the last merge into the graph, and store it. If papers in
+        the graph have been replaced or removed since, the graph is rebuilt from every
+        contribution instead."""
+        with self._merge_lock():
+            graph = self.load()
+            contributed = self.contributed_papers()
+            stale = [
+                paper
+                for paper, version in graph.papers.items()
+                if contributed.get(paper, None) != version
+            ]
+            if stale:
+                logger.info(f"{len(stale)} papers changed since the last merge, rebuilding.")
+                graph = CompactGraph.empty()
+            new_papers = {
+                paper: version
+                for paper, version in contributed.items()
+                if paper not in graph.papers
+            }
+            if not new_papers and not stale:
+                return graph
+
+            # new nodes, entity types and relation types are numbered after the ones already in
+            # the graph.
+            node_ids = graph.node_ids
+            node_texts = list(graph.node_texts)
+            node_type_ids = [graph.node_type_ids]
+            type_ids = {name: i for i, name in enumerate(graph.entity_types)}
+            relation_ids = {name: i for i, name in enumerate(graph.relation_names)}
+            edge_arrays = [graph.get_edges()]
+            for paper in new_papers:
+                with np.load(self._contribution_path(paper)) as contribution:
+                    paper_node_ids = []
+                    for entity_type, text in decode_json(contribution["nodes"]):
+                        node_id = node_ids.setdefault((entity_type, text), len(node_texts))
+                        if node_id == len(node_texts):
+                            node_texts.append(text)
+                            type_id = type_ids.setdefault(entity_type, len(type_ids))
+                            node_type_ids.append(np.array([type_id], dtype=np.int16))
+                        paper_node_ids.append(node_id)
+                    node_map = np.array(paper_node_ids, dtype=np.int64)
+                    relation_map = np.array(
+                        [
+                            relation_ids.setdefault(name, len(relation_ids))
+                            for name in decode_json(contribution["relation_names"])
+                        ],
+                        dtype=np.int64,
+                    )
+                    edge_arrays.append(
+                        (
+                            node_map[contribution["sources"]],
+                            node_map[contribution["targets"]],
+                            relation_map[contribution["relations"]],
+                            contribution["mentions"],
+                            np.ones(len(contribution["mentions"]), dtype=np.int64),
+                        )
+                    )
+
+            merged = merge_edges(
+                list(type_ids),
+                np.concatenate(node_type_ids),
+                node_texts,
+                list(relation_ids),
+                {**graph.papers, **new_papers},
+                edge_arrays,
+            )
+            temp_path = f"{self.graph_path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f:
+                np.savez(f, **merged.to_arrays())
+            os.replace(temp_path, self.graph_path)
+            return merged
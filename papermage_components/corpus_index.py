@@ -0,0 +1,498 @@
+"""
+A searchable index of the entities tagged across all processed papers, backed by SQLite.
+
+Every entity tagged by a model (the `TAGGED_ENTITIES_*` layers) is stored with its type, the
+section and paragraph it's in, its page, and the sentence it occurs in; relations found by MatIE
+are stored between the entities they connect. Entity text is indexed with FTS5, and each paper's
+count of each entity is kept, so questions like "which papers mention IN718 together with a creep
+rupture property" are answered by a few index lookups, without loading any documents.
+
+The index is updated as papers are processed (see `paper_worker.py` and `apply_predictors.py`):
+indexing a paper replaces whatever was indexed for it before. `index_papers.py` brings the index up
+to date with a folder of processed papers.
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+import os
+import sqlite3
+import time
+from typing import Iterator, Optional
+
+import numpy as np
+from papermage import Document, PagesFieldName, SentencesFieldName
+
+from papermage_components.utils import (
+    find_overlapping_ranges,
+    get_span_arrays,
+    normalize_entity_string,
+)
+
+TAGGED_ENTITIES_PREFIX = "TAGGED_ENTITIES_"
+SECTIONS_LAYER = "reading_order_sections"
+
+# Each distinct (model, entity type, text) is a term, and its text is what the full-text index
+# covers: the vocabulary grows far more slowly than the number of mentions, so text queries first
+# find the matching terms, then look up the papers (`paper_terms`) or mentions (`entities`) of
+# those terms by index.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS papers (
+    paper_id INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL UNIQUE,
+    file_mtime REAL,
+    indexed_at REAL NOT NULL,
+    num_entities INTEGER NOT NULL,
+    num_relations INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS terms (
+    term_id INTEGER PRIMARY KEY,
+    model TEXT NOT NULL,
+    entity_type TEXT NOT NULL,
+    text TEXT NOT NULL,
+    UNIQUE (model, entity_type, text)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS terms_fts USING fts5 (
+    text, content='terms', content_rowid='term_id'
+);
+CREATE TRIGGER IF NOT EXISTS terms_fts_insert AFTER INSERT ON terms BEGIN
+    INSERT INTO terms_fts (rowid, text) VALUES (new.term_id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS terms_fts_delete AFTER DELETE ON terms BEGIN
+    INSERT INTO terms_fts (terms_fts, rowid, text) VALUES ('delete', old.term_id, old.text);
+END;
+CREATE TABLE IF NOT EXISTS paper_terms (
+    term_id INTEGER NOT NULL,
+    paper_id INTEGER NOT NULL REFERENCES papers (paper_id) ON DELETE CASCADE,
+    mentions INTEGER NOT NULL,
+    PRIMARY KEY (term_id, paper_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS paper_terms_by_paper ON paper_terms (paper_id);
+CREATE TABLE IF NOT EXISTS entities (
+    entity_id INTEGER PRIMARY KEY,
+    paper_id INTEGER NOT NULL REFERENCES papers (paper_id) ON DELETE CASCADE,
+    term_id INTEGER NOT NULL,
+    section TEXT,
+    paragraph INTEGER,
+    page INTEGER,
+    start_char INTEGER NOT NULL,
+    end_char INTEGER NOT NULL,
+    sentence TEXT
+);
+CREATE INDEX IF NOT EXISTS entities_by_paper ON entities (paper_id, start_char);
+CREATE INDEX IF NOT EXISTS entities_by_term ON entities (term_id, paper_id, start_char);
+CREATE TABLE IF NOT EXISTS relations (
+    relation_id INTEGER PRIMARY KEY,
+    paper_id INTEGER NOT NULL REFERENCES papers (paper_id) ON DELETE CASCADE,
+    relation_type TEXT NOT NULL,
+    arg1_id INTEGER NOT NULL,
+    arg2_id INTEGER NOT NULL,
+    arg1_term_id INTEGER NOT NULL,
+    arg2_term_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS relations_by_paper ON relations (paper_id);
+CREATE INDEX IF NOT EXISTS relations_by_arg1 ON relations (arg1_term_id, arg2_term_id);
+CREATE INDEX IF NOT EXISTS relations_by_arg2 ON relations (arg2_term_id, arg1_term_id);
+"""
+
+
+@dataclass
+class EntityQuery:
+    """Matches entities whose text contains `text` (as a phrase, case-insensitively), of the given
+    type, model and section, where given."""
+
+    text: Optional[str] = None
+    entity_type: Optional[str] = None
+    model: Optional[str] = None
+    section: Optional[str] = None
+
+
+def fts_phrase(text: str) -> str:
+    """An FTS5 query matching `text` as a phrase."""
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _term_conditions(query: EntityQuery, column: str) -> tuple[list[str], list]:
+    """Conditions restricting `column` to the terms the query matches, ignoring its section."""
+    conditions = []
+    parameters = []
+    if query.text:
+        conditions.append("term_id IN (SELECT rowid FROM terms_fts WHERE terms_fts MATCH ?)")
+        parameters.append(fts_phrase(query.text))
+    for term_column in ("entity_type", "model"):
+        value = getattr(query, term_column)
+        if value:
+            conditions.append(f"{term_column} = ?")
+            parameters.append(value)
+    if not conditions:
+        return [], []
+    return [f"{column} IN (SELECT term_id FROM terms WHERE {' AND '.join(conditions)})"], parameters
+
+
+def _entity_conditions(query: EntityQuery, alias: str = "e") -> tuple[list[str], list]:
+    conditions, parameters = _term_conditions(query, f"{alias}.term_id")
+    if query.section:
+        conditions.append(f"{alias}.section = ?")
+        parameters.append(query.section)
+    return conditions, parameters
+
+
+def _paper_conditions(filenames: Optional[list[str]], column: str) -> tuple[list[str], list]:
+    if filenames is None:
+        return [], []
+    placeholders = ", ".join("?" * len(filenames))
+    condition = f"{column} IN (SELECT paper_id FROM papers WHERE filename IN ({placeholders}))"
+    return [condition], list(filenames)
+
+
+def get_entity_rows(doc: Document) -> tuple[list[tuple], list[tuple]]:
+    """The entities tagged in a document, as (model, entity_type, text, section, paragraph, page,
+    start_char, end_char, sentence) rows, and MatIE's relations between them, as (relation_type,
+    arg1 row index, arg2 row index).
+
+    Each entity is matched to its paragraph and sentence by looking its span up in the sorted spans
+    of those layers, all at once, rather than with a span query per entity.
+    """
+    model_layers = [layer for layer in doc.layers if layer.startswith(TAGGED_ENTITIES_PREFIX)]
+    entities = []
+    models = []
+    for layer_name in model_layers:
+        layer_entities = [entity for entity in doc.get_layer(layer_name) if entity.spans]
+        entities.extend(layer_entities)
+        models.extend([layer_name[len(TAGGED_ENTITIES_PREFIX) :]] * len(layer_entities))
+    if not entities:
+        return [], []
+
+    entity_starts = np.array([entity.spans[0].start for entity in entities], dtype=np.int64)
+    entity_ends = np.array([entity.spans[0].end for entity in entities], dtype=np.int64)
+
+    def first_overlapping(layer_name: str) -> tuple[list, np.ndarray]:
+        # the index in `layer_name` of the first entity overlapping each tagged entity, or -1.
+        if layer_name not in doc.layers:
+            return [], np.full(len(entities), -1)
+        layer_entities = doc.get_layer(layer_name).entities
+        starts, ends, ids = get_span_arrays(layer_entities)
+        lo, hi = find_overlapping_ranges(starts, ends, entity_starts, entity_ends)
+        return layer_entities, np.where(hi > lo, ids[np.minimum(lo, len(ids) - 1)], -1)
+
+    sections, section_ids = first_overlapping(SECTIONS_LAYER)
+    sentences, sentence_ids = first_overlapping(SentencesFieldName)
+    _, page_ids = first_overlapping(PagesFieldName)
+    sentence_texts = {}
+
+    rows = []
+    # (paragraph index, MatIE entity id) -> row index, to resolve relation arguments.
+    rows_by_matie_id = {}
+    for i, (entity, model) in enumerate(zip(entities, models)):
+        section_name = paragraph = None
+        if section_ids[i] >= 0:
+            section_metadata = sections[section_ids[i]].metadata
+            section_name = section_metadata["section_name"]
+            paragraph = section_metadata["paragraph_reading_order"]
+        sentence = None
+        if sentence_ids[i] >= 0:
+            if sentence_ids[i] not in sentence_texts:
+                sentence_texts[sentence_ids[i]] = sentences[sentence_ids[i]].text
+            sentence = sentence_texts[sentence_ids[i]]
+        if model == "MatIE" and section_ids[i] >= 0:
+            rows_by_matie_id[(section_ids[i], entity.metadata["entity_id"])] = i
+
+        rows.append(
+            (
+                model,
+                entity.metadata.get("entity_type", None) or "",
+                normalize_entity_string(entity.text),
+                section_name,
+                paragraph,
+                int(page_ids[i]) if page_ids[i] >= 0 else None,
+                entity.spans[0].start,
+                entity.spans[-1].end,
+                sentence,
+            )
+        )
+
+    relations = []
+    for section_index, section in enumerate(sections):
+        for relation in section.metadata.get("in_section_relations", None) or []:
+            arg1 = rows_by_matie_id.get((section_index, relation["arg1"]))
+            arg2 = rows_by_matie_id.get((section_index, relation["arg2"]))
+            if arg1 is not None and arg2 is not None:
+                relations.append((relation["relation_type"], arg1, arg2))
+    return rows, relations
+
+
+def _delete_paper(connection: sqlite3.Connection, filename: str) -> list[int]:
+    """Delete a paper and everything indexed for it, returning the terms it mentioned."""
+    term_ids = [
+        row[0]
+        for row in connection.execute(
+            "SELECT term_id FROM paper_terms"
+            " WHERE paper_id = (SELECT paper_id FROM papers WHERE filename = ?)",
+            (filename,),
+        )
+    ]
+    connection.execute("DELETE FROM papers WHERE filename = ?", (filename,))
+    return term_ids
+
+
+def _delete_unused_terms(connection: sqlite3.Connection, term_ids: list[int]) -> None:
+    """Delete those of the terms that no paper mentions any more, so they're no longer matched by
+    text queries, or listed as entity types."""
+    connection.executemany(
+        "DELETE FROM terms WHERE term_id = ?"
+        " AND NOT EXISTS (SELECT 1 FROM paper_terms WHERE paper_terms.term_id = ?)",
+        [(term_id, term_id) for term_id in term_ids],
+    )
+
+
+class CorpusIndex:
+    """The entity index of a corpus of processed papers, shared by every process that opens the
+    same database. Like the job queue, each operation uses its own short-lived connection."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as connection:
+            # WAL lets the app query the index while a worker is updating it.
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA foreign_keys = ON")
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def index_document(
+        self, filename: str, doc: Document, file_mtime: Optional[float] = None
+    ) -> int:
+        """Index a paper's entities and relations, replacing anything indexed for it before.
+        Returns the number of entities indexed."""
+        rows, relations = get_entity_rows(doc)
+        term_keys = [row[:3] for row in rows]
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                old_term_ids = _delete_paper(connection, filename)
+                paper_id = connection.execute(
+                    "INSERT INTO papers (filename, file_mtime, indexed_at, num_entities,"
+                    " num_relations) VALUES (?, ?, ?, ?, ?)",
+                    (filename, file_mtime, time.time(), len(rows), len(relations)),
+                ).lastrowid
+
+                connection.executemany(
+                    "INSERT OR IGNORE INTO terms (model, entity_type, text) VALUES (?, ?, ?)",
+                    sorted(set(term_keys)),
+                )
+                term_ids = {}
+                for key in set(term_keys):
+                    term_ids[key] = connection.execute(
+                        "SELECT term_id FROM terms"
+                        " WHERE model = ? AND entity_type = ? AND text = ?",
+                        key,
+                    ).fetchone()[0]
+                row_term_ids = [term_ids[key] for key in term_keys]
+                connection.executemany(
+                    "INSERT INTO paper_terms (term_id, paper_id, mentions) VALUES (?, ?, ?)",
+                    [
+                        (term_id, paper_id, mentions)
+                        for term_id, mentions in Counter(row_term_ids).items()
+                    ],
+                )
+                _delete_unused_terms(connection, old_term_ids)
+
+                first_entity_id = connection.execute(
+                    "SELECT COALESCE(MAX(entity_id), 0) + 1 FROM entities"
+                ).fetchone()[0]
+                connection.executemany(
+                    "INSERT INTO entities (entity_id, paper_id, term_id, section, paragraph, page,"
+                    " start_char, end_char, sentence) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (first_entity_id + i, paper_id, term_id, *row[3:])
+                        for i, (term_id, row) in enumerate(zip(row_term_ids, rows))
+                    ],
+                )
+                connection.executemany(
+                    "INSERT INTO relations (paper_id, relation_type, arg1_id, arg2_id,"
+                    " arg1_term_id, arg2_term_id) VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            paper_id,
+                            relation_type,
+                            first_entity_id + arg1,
+                            first_entity_id + arg2,
+                            row_term_ids[arg1],
+                            row_term_ids[arg2],
+                        )
+                        for relation_type, arg1, arg2 in relations
+                    ],
+                )
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        return len(rows)
+
+    def remove_document(self, filename: str) -> None:
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                _delete_unused_terms(connection, _delete_paper(connection, filename))
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def remove_unused_terms(self) -> int:
+        """Remove every term that no indexed paper mentions, e.g. left by an index that was
+        updated before terms were removed along with their papers. Returns how many there were."""
+        with self._connect() as connection:
+            return connection.execute(
+                "DELETE FROM terms WHERE term_id NOT IN (SELECT term_id FROM paper_terms)"
+            ).rowcount
+
+    def indexed_papers(self) -> dict[str, Optional[float]]:
+        """The filename of every indexed paper, and the modification time of the file it was
+        indexed from, if known."""
+        with self._connect() as connection:
+            rows = connection.execute("SELECT filename, file_mtime FROM papers").fetchall()
+        return {row["filename"]: row["file_mtime"] for row in rows}
+
+    def find_papers(self, queries: list[EntityQuery], limit: int = 100) -> list[dict]:
+        """The papers that mention entities matching every one of the queries, with how many
+        entities match each query, most mentions first."""
+        if not queries:
+            return []
+        match_tables = []
+        parameters = []
+        for i, query in enumerate(queries):
+            if query.section:
+                # the per-paper term counts don't know about sections, so count the mentions.
+                conditions, query_parameters = _entity_conditions(query)
+                table = (
+                    f"SELECT e.paper_id, COUNT(*) AS matches FROM entities e"
+                    f" WHERE {' AND '.join(conditions)} GROUP BY e.paper_id"
+                )
+            else:
+                conditions, query_parameters = _term_conditions(query, "pt.term_id")
+                table = (
+                    f"SELECT pt.paper_id, SUM(pt.mentions) AS matches FROM paper_terms pt"
+                    f" WHERE {' AND '.join(conditions) or '1'} GROUP BY pt.paper_id"
+                )
+            match_tables.append(f"m{i} AS ({table})")
+            parameters.extend(query_parameters)
+
+        match_columns = ", ".join(f"m{i}.matches AS matches_{i}" for i in range(len(queries)))
+        joins = " ".join(f"JOIN m{i} ON m{i}.paper_id = p.paper_id" for i in range(len(queries)))
+        total = " + ".join(f"m{i}.matches" for i in range(len(queries)))
+        sql = (
+            f"WITH {', '.join(match_tables)}"
+            f" SELECT p.filename, {match_columns} FROM papers p {joins}"
+            f" ORDER BY {total} DESC, p.filename LIMIT ?"
+        )
+        with self._connect() as connection:
+            rows = connection.execute(sql, parameters + [limit]).fetchall()
+        return [
+            {
+                "filename": row["filename"],
+                "matches": [row[f"matches_{i}"] for i in range(len(queries))],
+            }
+            for row in rows
+        ]
+
+    def find_entities(
+        self, query: EntityQuery, filenames: Optional[list[str]] = None, limit: int = 1000
+    ) -> list[dict]:
+        """Entities matching the query, optionally only in the given papers, with their sentence
+        context, in the order the papers were indexed."""
+        conditions, parameters = _entity_conditions(query)
+        paper_conditions, paper_parameters = _paper_conditions(filenames, "e.paper_id")
+        where = " AND ".join(conditions + paper_conditions) or "1"
+        sql = (
+            "SELECT p.filename, t.model, t.entity_type, t.text, e.section, e.paragraph, e.page,"
+            " e.start_char, e.end_char, e.sentence"
+            " FROM entities e JOIN terms t ON t.term_id = e.term_id"
+            f" JOIN papers p ON p.paper_id = e.paper_id WHERE {where}"
+            " ORDER BY e.paper_id, e.start_char LIMIT ?"
+        )
+        with self._connect() as connection:
+            rows = connection.execute(sql, parameters + paper_parameters + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def find_relations(
+        self,
+        arg1: Optional[EntityQuery] = None,
+        arg2: Optional[EntityQuery] = None,
+        relation_type: Optional[str] = None,
+        filenames: Optional[list[str]] = None,
+        limit: int = 1000,
+    ) -> list[dict]:
+        """Relations between an entity matching `arg1` and one matching `arg2`, e.g. every
+        Material related to a Property mentioning "creep rupture". Relations are matched in either
+        direction; `entity_1` is always the entity matching `arg1`."""
+        directions = []
+        parameters = []
+        for direction, (x_column, y_column) in enumerate([("arg1", "arg2"), ("arg2", "arg1")]):
+            conditions = []
+            joins = ""
+            for alias, column, query in [("x", x_column, arg1), ("y", y_column, arg2)]:
+                if query is None:
+                    continue
+                query_conditions, query_parameters = _term_conditions(query, f"r.{column}_term_id")
+                conditions.extend(query_conditions)
+                parameters.extend(query_parameters)
+                if query.section:
+                    joins += f" JOIN entities {alias} ON {alias}.entity_id = r.{column}_id"
+                    conditions.append(f"{alias}.section = ?")
+                    parameters.append(query.section)
+            if relation_type:
+                conditions.append("r.relation_type = ?")
+                parameters.append(relation_type)
+            paper_conditions, paper_parameters = _paper_conditions(filenames, "r.paper_id")
+            conditions.extend(paper_conditions)
+            parameters.extend(paper_parameters + [limit])
+            # each direction is limited before the two are merged, and before looking up the
+            # entities, so only the relations returned are joined with them.
+            directions.append(
+                f"SELECT * FROM (SELECT r.relation_id, {direction} AS direction,"
+                f" r.{x_column}_id AS x_id, r.{y_column}_id AS y_id FROM relations r{joins}"
+                f" WHERE {' AND '.join(conditions) or '1'} ORDER BY r.relation_id LIMIT ?)"
+            )
+        # a relation that matches in both directions is only listed once, as it matched `arg1`
+        # first.
+        sql = (
+            "WITH matched AS (SELECT relation_id, MIN(direction), x_id, y_id"
+            f" FROM ({' UNION ALL '.join(directions)})"
+            " GROUP BY relation_id ORDER BY relation_id LIMIT ?)"
+            " SELECT p.filename, r.relation_type,"
+            " tx.entity_type AS entity_1_type, tx.text AS entity_1_text,"
+            " ty.entity_type AS entity_2_type, ty.text AS entity_2_text,"
+            " x.section, x.sentence"
+            " FROM matched m JOIN relations r ON r.relation_id = m.relation_id"
+            " JOIN entities x ON x.entity_id = m.x_id JOIN entities y ON y.entity_id = m.y_id"
+            " JOIN terms tx ON tx.term_id = x.term_id JOIN terms ty ON ty.term_id = y.term_id"
+            " JOIN papers p ON p.paper_id = r.paper_id ORDER BY m.relation_id"
+        )
+        with self._connect() as connection:
+            rows = connection.execute(sql, parameters + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_entity_types(self) -> list[str]:
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT DISTINCT entity_type FROM terms WHERE entity_type != ''"
+                " ORDER BY entity_type"
+            ).fetchall()
+        return [row["entity_type"] for row in rows]
+
+    def get_stats(self) -> dict:
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(num_entities), 0), COALESCE(SUM(num_relations), 0)"
+                " FROM papers"
+            ).fetchone()
+        return {"papers": row[0], "entities": row[1], "relations": row[2]}
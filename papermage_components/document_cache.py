@@ -0,0 +1,97 @@
+from collections import OrderedDict
+import os
+from threading import Lock
+from typing import Callable, Union
+
+from papermage import Document
+
+from papermage_components.serialization import LazyDocument, load_document
+
+# rough in-memory cost of a single entity, with its spans, boxes and metadata.
+ENTITY_SIZE_ESTIMATE = 1024
+
+
+def estimate_document_size(doc: Document) -> int:
+    """Roughly estimate the memory used by a document, in bytes. Only counts layers that have been
+    loaded, so the estimate for a LazyDocument grows as it's used."""
+    size = len(doc.symbols or "")
+    for layer_name in doc._layers:
+        if isinstance(doc, LazyDocument) and not doc.is_loaded(layer_name):
+            continue
+        layer = doc.get_layer(layer_name)
+        size += len(layer) * ENTITY_SIZE_ESTIMATE
+        if layer_name == "pages":
+            for page in layer:
+                for image in page.images:
+                    # don't count (or load) external page images that haven't been used yet.
+                    if image._pilimage is None:
+                        continue
+                    width, height = image._pilimage.size
+                    size += width * height * 3
+    return size
+
+
+class DocumentCache:
+    """A thread-safe LRU cache of loaded documents, keyed by path and modification time, and
+    capped by the estimated memory of the documents it holds.
+
+    A document is reloaded if the file on disk has changed since it was cached. The most recently
+    used document is never evicted, even if it alone exceeds the cap.
+    """
+
+    def __init__(
+        self,
+        max_size_bytes: int,
+        load_function: Callable[[str], Document] = lambda path: load_document(path, lazy=True),
+    ):
+        self.max_size_bytes = max_size_bytes
+        self.load_function = load_function
+        self._documents: OrderedDict[str, tuple[tuple[int, int], Document]] = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def _file_key(path: str) -> tuple[int, int]:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, path: Union[str, os.PathLike]) -> Document:
+        path = os.path.abspath(path)
+        file_key = self._file_key(path)
+        with self._lock:
+            cached = self._documents.get(path)
+            if cached is not None and cached[0] == file_key:
+                self._documents.move_to_end(path)
+                self._evict()
+                return cached[1]
+
+        document = self.load_function(path)
+        with self._lock:
+            self._documents[path] = (file_key, document)
+            self._documents.move_to_end(path)
+            self._evict()
+        return document
+
+    def invalidate(self, path: Union[str, os.PathLike]) -> None:
+        with self._lock:
+            self._documents.pop(os.path.abspath(path), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._documents.clear()
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(estimate_document_size(doc) for _, doc in self._documents.values())
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def __contains__(self, path: Union[str, os.PathLike]) -> bool:
+        return os.path.abspath(path) in self._documents
+
+    def _evict(self) -> None:
+        sizes = {path: estimate_document_size(doc) for path, (_, doc) in self._documents.items()}
+        total_size = sum(sizes.values())
+        while total_size > self.max_size_bytes and len(self._documents) > 1:
+            path, _ = self._documents.popitem(last=False)
+            total_size -= sizes[path]
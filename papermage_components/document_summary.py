@@ -0,0 +1,141 @@
+"""
+The tables the Summary View shows for a document, computed once, when the document is processed.
+
+A document's summary holds a row for every entity tagged in its reading-order sections, with the
+entity's type, text, section and the sentence it occurs in, along with the document's sections in
+reading order and the number of entities of each type each model tagged. Summaries are stored as
+`<summary_dir>/<document filename>.json`, next to rather than inside the document, so they can be
+rewritten after the document is saved, from whatever layers are stored with it. A summary older
+than its document is out of date, and is computed again when it's next loaded.
+
+The Summary View then filters the entity rows with vectorized DataFrame operations, instead of
+walking every section and entity of the document, and searching for each one's sentence, on every
+rerun.
+"""
+
+import json
+import os
+from typing import Optional
+
+import pandas as pd
+from papermage import Document
+
+from papermage_components.corpus_index import SECTIONS_LAYER, get_entity_rows
+
+SUMMARY_VERSION = 1
+NO_SENTENCE = "Not found."
+ENTITY_COLUMNS = [
+    "entity_type",
+    "entity_text",
+    "entity_section",
+    "sentence_context",
+    "source_model",
+]
+# columns with few distinct values, stored as categories so filtering compares integer codes.
+CATEGORICAL_COLUMNS = ["entity_type", "entity_section", "source_model"]
+
+
+class DocumentSummary:
+    def __init__(
+        self,
+        entities: pd.DataFrame,
+        sections: list[str],
+        type_counts: dict[str, dict[str, int]],
+    ):
+        self.entities = entities
+        self.sections = sections
+        # model -> entity type -> how many entities of that type it tagged.
+        self.type_counts = type_counts
+
+    @classmethod
+    def from_document(cls, doc: Document) -> "DocumentSummary":
+        rows, _ = get_entity_rows(doc)
+        entity_rows = [
+            (entity_type, text, section, sentence or NO_SENTENCE, model)
+            for model, entity_type, text, section, _, _, _, _, sentence in rows
+            if section is not None
+        ]
+        entities = pd.DataFrame(entity_rows, columns=ENTITY_COLUMNS)
+
+        sections = []
+        if SECTIONS_LAYER in doc.layers:
+            sections = list(
+                dict.fromkeys(
+                    section.metadata["section_name"] for section in doc.get_layer(SECTIONS_LAYER)
+                )
+            )
+        type_counts = {}
+        for (model, entity_type), count in entities.groupby(
+            ["source_model", "entity_type"], sort=False
+        ).size().items():
+            type_counts.setdefault(model, {})[entity_type] = int(count)
+        return cls(
+            entities.astype({column: "category" for column in CATEGORICAL_COLUMNS}),
+            sections,
+            type_counts,
+        )
+
+    def filter_entities(
+        self, entity_types: dict[str, list[str]], sections: list[str]
+    ) -> pd.DataFrame:
+        """The entities of the given types, by model, in the given sections."""
+        pairs = [
+            (model, entity_type) for model, types in entity_types.items() for entity_type in types
+        ]
+        keep = self.entities["entity_section"].isin(sections) & pd.MultiIndex.from_arrays(
+            [self.entities["source_model"], self.entities["entity_type"]]
+        ).isin(pairs)
+        return self.entities[keep]
+
+    def to_json(self) -> dict:
+        return {
+            "version": SUMMARY_VERSION,
+            "entities": {
+                column: self.entities[column].astype(object).tolist() for column in ENTITY_COLUMNS
+            },
+            "sections": self.sections,
+            "type_counts": self.type_counts,
+        }
+
+    @classmethod
+    def from_json(cls, summary_json: dict) -> "DocumentSummary":
+        entities = pd.DataFrame(summary_json["entities"], columns=ENTITY_COLUMNS)
+        return cls(
+            entities.astype({column: "category" for column in CATEGORICAL_COLUMNS}),
+            summary_json["sections"],
+            summary_json["type_counts"],
+        )
+
+
+def get_summary_path(summary_dir: str, doc_filename: str) -> str:
+    return os.path.join(summary_dir, doc_filename + ".json")
+
+
+def write_document_summary(doc: Document, summary_dir: str, doc_filename: str) -> DocumentSummary:
+    """Compute a document's summary, and store it, replacing any earlier one."""
+    summary = DocumentSummary.from_document(doc)
+    os.makedirs(summary_dir, exist_ok=True)
+    path = get_summary_path(summary_dir, doc_filename)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(summary.to_json(), f)
+    os.replace(temp_path, path)
+    return summary
+
+
+def read_document_summary(
+    summary_dir: str, doc_filename: str, doc_path: str
+) -> Optional[DocumentSummary]:
+    """The stored summary of the document at `doc_path`, or None if there's none, or it's older
+    than the document."""
+    path = get_summary_path(summary_dir, doc_filename)
+    try:
+        if os.path.getmtime(path) < os.path.getmtime(doc_path):
+            return None
+        with open(path) as f:
+            summary_json = json.load(f)
+    except FileNotFoundError:
+        return None
+    if summary_json.get("version", None) != SUMMARY_VERSION:
+        return None
+    return DocumentSummary.from_json(summary_json)
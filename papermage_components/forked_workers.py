@@ -0,0 +1,69 @@
+"""
+Run a function over many items in worker processes that share a single copy of some loaded state.
+
+The state (e.g. a `MaterialsRecipe` with all of its models prewarmed) is built once in the parent,
+and the workers are forked from it, so model weights are shared copy-on-write instead of being
+loaded again by every worker. Inference only reads the weights, so the pages holding them stay
+shared for the lifetime of the workers.
+"""
+
+import gc
+import multiprocessing
+import os
+import sys
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+
+Item = TypeVar("Item")
+Result = TypeVar("Result")
+
+# set in the parent just before forking, and inherited by the workers.
+_shared_state = None
+
+
+def _initialize_worker(threads_per_worker: int) -> None:
+    # by default each worker would use every core for torch ops, and they'd fight over them.
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(threads_per_worker)
+
+
+def _call_with_shared_state(function_and_item):
+    function, item = function_and_item
+    return function(_shared_state, item)
+
+
+def map_with_forked_workers(
+    function: Callable[[Any, Item], Result],
+    shared_state: Any,
+    items: Iterable[Item],
+    num_workers: int,
+) -> Iterator[Result]:
+    """Call `function(shared_state, item)` for each item, in `num_workers` forked processes,
+    yielding results as they complete (not necessarily in order).
+
+    `function` must be a module-level function, and its results must be picklable. The shared
+    state is never pickled: workers use the copy they inherited when they were forked.
+    """
+    global _shared_state
+    if "fork" not in multiprocessing.get_all_start_methods():
+        raise RuntimeError(
+            "Sharing loaded models between workers requires the 'fork' start method,"
+            " which isn't available on this platform."
+        )
+
+    _shared_state = shared_state
+    # move everything allocated so far out of the garbage collector's generations, so that
+    # collections in the workers don't write to (and so copy) the pages the models live in.
+    gc.collect()
+    gc.freeze()
+    threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+    context = multiprocessing.get_context("fork")
+    try:
+        with context.Pool(
+            num_workers, initializer=_initialize_worker, initargs=(threads_per_worker,)
+        ) as pool:
+            yield from pool.imap_unordered(
+                _call_with_shared_state, ((function, item) for item in items)
+            )
+    finally:
+        gc.unfreeze()
+        _shared_state = None
@@ -1,6 +1,7 @@
 import os
 
 import fitz
+import numpy as np
 from papermage.magelib import (
     Box,
     Document,
@@ -8,11 +9,10 @@ from papermage.magelib import (
     Metadata,
 )
 from papermage.parsers.parser import Parser
-from papermage_components.utils import get_spans_from_boxes
+from papermage_components.utils import get_spans_from_box_groups
 
 HighlightsFieldName = "annotation_highlights"
 
-FITZ_HIGHLIGHT_FIELD_NAME = "Highlight"
 ANNOTATION_TYPE_KEY = "annotation_type"
 B_VALUE_TO_TYPE = {
     1.0: "structure",
@@ -38,50 +38,60 @@ def vertical_shrink(box, factor):
     return Box(box.l, box.t + top_diff, box.w, box.h * factor, box.page)
 
 
-def get_highlight_entities_from_pdf(pdf_filename: str, doc: Document) -> list[Entity]:
-    highlight_entities = []
-    with fitz.open(pdf_filename) as pdf:
-        for page_number, page in enumerate(pdf):
-            for annotation in page.annots():
-                if annotation.type[1] != FITZ_HIGHLIGHT_FIELD_NAME:
-                    continue
+def convert_vertices_to_papermage(
+    vertices, page_width, page_height, page_number, shrink_factor=0.5
+) -> list[Box]:
+    """Convert a highlight's quads, given as a flat list of their vertices, into papermage boxes
+    around each quad, shrunk vertically by `shrink_factor`. Equivalent to `convert_rect_to_papermage`
+    and `vertical_shrink` on each `fitz.Quad(...).rect`, for all the quads at once."""
+    assert len(vertices) % 4 == 0
+    quads = np.asarray(vertices, dtype=np.float64).reshape(-1, 4, 2)
+    x0, y0 = quads.min(axis=1).T
+    x1, y1 = quads.max(axis=1).T
 
-                # get annotation boxes
-                entity_boxes = []
-                vertices = annotation.vertices
+    lefts = x0 / page_width
+    tops = y0 / page_height
+    widths = (x1 - x0) / page_width
+    heights = (y1 - y0) / page_height
+    tops = tops + (1 - shrink_factor) * heights / 2
+    heights = heights * shrink_factor
 
-                assert len(vertices) % 4 == 0
+    return [
+        Box(l=l, t=t, w=w, h=h, page=page_number)
+        for l, t, w, h in zip(lefts.tolist(), tops.tolist(), widths.tolist(), heights.tolist())
+    ]
 
-                if len(vertices) == 4:
-                    box = fitz.Quad(vertices).rect
-                    entity_boxes.append(
-                        vertical_shrink(convert_rect_to_papermage(box, page, page_number), 0.5)
+
+def get_highlight_entities_from_pdf(pdf_filename: str, doc: Document) -> list[Entity]:
+    # the boxes and metadata of every highlight, page by page; their spans are then found against
+    # each page's tokens all at once.
+    highlight_boxes = []
+    highlight_metadata = []
+    with fitz.open(pdf_filename) as pdf:
+        for page_number, page in enumerate(pdf):
+            page_width, page_height = page.rect.width, page.rect.height
+            for annotation in page.annots(types=[fitz.PDF_ANNOT_HIGHLIGHT]):
+                highlight_boxes.append(
+                    convert_vertices_to_papermage(
+                        annotation.vertices, page_width, page_height, page_number
                     )
-                else:
-                    for j in range(0, len(vertices), 4):
-                        box = fitz.Quad(vertices[j : j + 4]).rect
-                        entity_boxes.append(
-                            vertical_shrink(convert_rect_to_papermage(box, page, page_number), 0.5)
-                        )
+                )
 
                 # get annotation color, and then type
                 color = annotation.colors["stroke"]
                 annotation_type = B_VALUE_TO_TYPE[color[2]]
-
-                entity_spans = get_spans_from_boxes(doc, entity_boxes)
-
-                entity_metadata = Metadata(
-                    **{"annotation_color": color, ANNOTATION_TYPE_KEY: annotation_type}
+                highlight_metadata.append(
+                    Metadata(**{"annotation_color": color, ANNOTATION_TYPE_KEY: annotation_type})
                 )
 
-                highlight_entity = Entity(
-                    spans=entity_spans,
-                    boxes=entity_boxes,
-                    images=None,
-                    metadata=entity_metadata,
-                )
-                highlight_entities.append(highlight_entity)
-    return highlight_entities
+    highlight_spans = get_spans_from_box_groups(doc, highlight_boxes)
+
+    return [
+        Entity(spans=entity_spans, boxes=entity_boxes, images=None, metadata=entity_metadata)
+        for entity_spans, entity_boxes, entity_metadata in zip(
+            highlight_spans, highlight_boxes, highlight_metadata
+        )
+    ]
 
 
 class FitzHighlightParser(Parser):
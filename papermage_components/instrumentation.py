@@ -0,0 +1,170 @@
+"""
+Per-stage instrumentation for the processing pipeline.
+
+Each stage records its wall time, CPU time, peak RSS, and counts of the items it processed: the
+size of every layer it added to the document, plus anything counted with `add_count` while it
+runs (e.g. requests to a backend service). The records are stored in the document's metadata, so
+every processed paper carries its own profile, and can be exported as JSONL or in the Prometheus
+text format.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+import json
+import resource
+import sys
+import threading
+import time
+from typing import Iterator, Optional
+
+from papermage.magelib import Document
+
+PIPELINE_METRICS_METADATA_KEY = "pipeline_metrics"
+PROMETHEUS_PREFIX = "collage_stage"
+
+
+@dataclass
+class StageMetrics:
+    stage: str
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    # peak RSS during the stage where the OS lets us reset the high-water mark (Linux), and the
+    # peak for the process so far otherwise.
+    peak_rss_bytes: int = 0
+    counts: dict[str, int] = field(default_factory=dict)
+    failed: bool = False
+
+
+_current_stage: ContextVar[Optional[StageMetrics]] = ContextVar("current_stage", default=None)
+
+
+_counts_lock = threading.Lock()
+
+
+def add_count(item: str, count: int = 1) -> None:
+    """Count items processed by the stage currently running, if any. Stages that fan work out to
+    threads should run it in a copy of their context (`contextvars.copy_context`) for it to be
+    counted."""
+    stage = _current_stage.get()
+    if stage is not None:
+        with _counts_lock:
+            stage.counts[item] = stage.counts.get(item, 0) + count
+
+
+def reset_peak_rss() -> None:
+    try:
+        # "5" resets the process's peak RSS (VmHWM) to its current RSS.
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def get_peak_rss() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere.
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class PipelineMetrics:
+    """Collects the metrics of the stages run on one document."""
+
+    def __init__(self):
+        self.stages: list[StageMetrics] = []
+
+    @contextmanager
+    def stage(self, name: str, doc: Optional[Document] = None) -> Iterator[StageMetrics]:
+        """Measure a stage. If `doc` is given, the size of each layer the stage adds to it is
+        counted as well."""
+        metrics = StageMetrics(stage=name)
+        layers_before = set(doc.layers) if doc is not None else set()
+        reset_peak_rss()
+        context_token = _current_stage.set(metrics)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield metrics
+        except BaseException:
+            metrics.failed = True
+            raise
+        finally:
+            metrics.wall_seconds = time.perf_counter() - wall_start
+            metrics.cpu_seconds = time.process_time() - cpu_start
+            metrics.peak_rss_bytes = get_peak_rss()
+            _current_stage.reset(context_token)
+            if doc is not None:
+                for layer_name in doc.layers:
+                    if layer_name not in layers_before:
+                        metrics.counts.setdefault(layer_name, len(doc.get_layer(layer_name)))
+            self.stages.append(metrics)
+
+    def attach(self, doc: Document) -> None:
+        """Add the stages measured so far to the document's metadata. Records from an earlier run
+        are kept, except for the stages that were run again, whose records are replaced."""
+        rerun_stages = {stage.stage for stage in self.stages}
+        stage_records = [
+            stage_record
+            for stage_record in doc.metadata.get(PIPELINE_METRICS_METADATA_KEY, None) or []
+            if stage_record["stage"] not in rerun_stages
+        ]
+        stage_records.extend(asdict(stage) for stage in self.stages)
+        doc.metadata[PIPELINE_METRICS_METADATA_KEY] = stage_records
+        self.stages = []
+
+
+def get_document_metrics(doc: Document, document_name: str) -> list[dict]:
+    """The stage records stored in a document, each labelled with the document's name."""
+    return [
+        {"document": document_name, **stage_record}
+        for stage_record in doc.metadata.get(PIPELINE_METRICS_METADATA_KEY, None) or []
+    ]
+
+
+def metrics_to_jsonl(records: list[dict]) -> str:
+    return "".join(json.dumps(record) + "\n" for record in records)
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(**labels: str) -> str:
+    return ",".join(f'{key}="{_escape_label_value(str(value))}"' for key, value in labels.items())
+
+
+def metrics_to_prometheus(records: list[dict]) -> str:
+    """Format stage records in the Prometheus text exposition format, as gauges labelled by
+    document and stage. A label set may only appear once, so if a document has more than one
+    record of a stage (e.g. stored before re-run stages replaced their records), the last one is
+    exported."""
+    records = list({(record["document"], record["stage"]): record for record in records}.values())
+    gauges = [
+        ("wall_seconds", "Wall-clock time of a pipeline stage, in seconds."),
+        ("cpu_seconds", "CPU time of a pipeline stage, in seconds."),
+        ("peak_rss_bytes", "Peak resident memory during a pipeline stage, in bytes."),
+    ]
+    lines = []
+    for field_name, description in gauges:
+        metric_name = f"{PROMETHEUS_PREFIX}_{field_name}"
+        lines.append(f"# HELP {metric_name} {description}")
+        lines.append(f"# TYPE {metric_name} gauge")
+        for record in records:
+            labels = _format_labels(document=record["document"], stage=record["stage"])
+            lines.append(f"{metric_name}{{{labels}}} {record[field_name]}")
+
+    metric_name = f"{PROMETHEUS_PREFIX}_items"
+    lines.append(f"# HELP {metric_name} Number of items processed or produced by a pipeline stage.")
+    lines.append(f"# TYPE {metric_name} gauge")
+    for record in records:
+        for item, count in record["counts"].items():
+            labels = _format_labels(document=record["document"], stage=record["stage"], item=item)
+            lines.append(f"{metric_name}{{{labels}}} {count}")
+    return "\n".join(lines) + "\n"
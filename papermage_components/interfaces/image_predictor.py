@@ -1,12 +1,15 @@
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 from dataclasses import asdict, dataclass
-from typing import Callable, List, Optional
+from typing import Callable, Iterator, List, Optional, Union
 
 import pandas as pd
 from papermage import Box, Document, Entity, Metadata, CaptionsFieldName
 from papermage.predictors import BasePredictor
 from tqdm.auto import tqdm
 
+from papermage_components.instrumentation import add_count
 from papermage_components.utils import get_table_image, globalize_box_coordinates
 
 
@@ -38,16 +41,25 @@ class ImagePredictionResult:
 
 
 class ImagePredictorABC(BasePredictor, ABC):
-    def __init__(self, entity_to_process: str, find_caption: bool = True):
+    # how many images may be processed at once, e.g. by predictors that call a web API.
+    max_concurrent_images = 1
+
+    def __init__(
+        self, entity_to_process: str, find_caption: bool = True, dpi: Optional[int] = None
+    ):
         """Init.
 
         Parameters
         ----------
         entity_to_process : What PaperMage layer to iterate through and annotate. Usually "tables"
         find_caption : Whether to use heuristics to find the caption of the given table/image.
+        dpi : The resolution this predictor needs its images at. When the source PDF is available,
+            pages are rasterized at this DPI for this predictor only. If None, the predictor uses
+            whatever page images are attached to the document.
         """
         self.entity_to_process = entity_to_process
         self.find_caption = find_caption
+        self.dpi = dpi
 
     @property
     def REQUIRED_DOCUMENT_FIELDS(self) -> List[str]:
@@ -69,15 +81,58 @@ class ImagePredictorABC(BasePredictor, ABC):
         entity_image = get_table_image(entity, entity.layer.doc)
         return self.process_image(entity_image)
 
-    def _predict(self, doc: Document) -> list[Entity]:
-        all_entities = []
+    def process_entities(
+        self, entities: list[Entity]
+    ) -> Iterator[Union[ImagePredictionResult, Exception]]:
+        """Process each entity, yielding, in order, its result or the exception it raised.
+
+        With `max_concurrent_images` > 1, the entities' images are cropped up front, in this thread,
+        and up to that many are passed to `process_image` at once. Predictors that override
+        `process_entity` should leave it at 1.
+        """
 
-        for entity in tqdm(getattr(doc, self.entity_to_process)):
+        def try_call(function: Callable, argument, context: Optional[contextvars.Context] = None):
             try:
+                return context.run(function, argument) if context else function(argument)
+            except Exception as e:
+                return e
+
+        def single_box(process: Callable) -> Callable:
+            def process_single_box_entity(entity: Entity):
                 if len(entity.boxes) > 1:
                     raise AssertionError("Entity has more than one box!")
+                return process(entity)
+
+            return process_single_box_entity
 
-                predicted_result = self.process_entity(entity)
+        if self.max_concurrent_images <= 1:
+            for entity in tqdm(entities):
+                yield try_call(single_box(self.process_entity), entity)
+            return
+
+        get_image = single_box(lambda entity: get_table_image(entity, entity.layer.doc))
+        images = [try_call(get_image, entity) for entity in entities]
+
+        def process_image(context: contextvars.Context, image):
+            if isinstance(image, Exception):
+                return image
+            return try_call(self.process_image, image, context)
+
+        # each image is processed in its own copy of the caller's context, so it's counted in its
+        # stage.
+        contexts = [contextvars.copy_context() for _ in images]
+        with ThreadPoolExecutor(self.max_concurrent_images) as executor:
+            yield from tqdm(executor.map(process_image, contexts, images), total=len(images))
+
+    def _predict(self, doc: Document) -> list[Entity]:
+        all_entities = []
+
+        entities = getattr(doc, self.entity_to_process)
+        for entity, predicted_result in zip(entities, self.process_entities(entities)):
+            add_count(self.entity_to_process)
+            try:
+                if isinstance(predicted_result, Exception):
+                    raise predicted_result
 
                 meta_dict = {k: v for k, v in asdict(predicted_result).items() if v is not None}
 
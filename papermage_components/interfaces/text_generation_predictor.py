@@ -9,6 +9,8 @@ from tqdm.auto import tqdm
 from papermage import Document, Entity, Metadata
 from papermage.predictors import BasePredictor
 
+from papermage_components.instrumentation import add_count
+
 
 @dataclass
 class LLMMessage:
@@ -104,6 +106,8 @@ class TextGenerationPredictorABC(BasePredictor, ABC):
         all_entities = []
 
         for entity in tqdm(getattr(doc, self.entity_to_process)):
+            add_count(self.entity_to_process)
+            add_count("requests")
             generated_text = self.generate_from_entity_text(entity.text)
             parsed_table = self.postprocess_text_to_dict(generated_text)
             predicted_entity = Entity(
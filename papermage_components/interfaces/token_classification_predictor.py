@@ -1,11 +1,16 @@
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 from dataclasses import dataclass
+from typing import Iterator
 
 from papermage import Entity, Metadata, Span
 from papermage.magelib import Document, Entity, Metadata, SentencesFieldName, Span, TokensFieldName
 from papermage.predictors import BasePredictor
 from tqdm.auto import tqdm
 
+from papermage_components.instrumentation import add_count
+
 
 @dataclass
 class EntityCharSpan:
@@ -65,6 +70,10 @@ def map_char_spans_to_entity(sentence: Entity, entities: list[EntityCharSpan]) -
 
 
 class TokenClassificationPredictorABC(BasePredictor, ABC):
+    # how many batches `tag_entities_in_batch` may be called on at once, from separate threads.
+    # Worth raising for predictors that call a service.
+    max_concurrent_batches = 1
+
     def __init__(self, entity_to_process="reading_order_sections"):
         self.entity_to_process = entity_to_process
 
@@ -130,12 +139,31 @@ class TokenClassificationPredictorABC(BasePredictor, ABC):
             all_batches.append(batch)
         return all_batches
 
+    def tag_batches(
+        self, batches: list[list[tuple[Entity, str]]]
+    ) -> Iterator[list[list[EntityCharSpan]]]:
+        """Tag each batch's texts, yielding the results in the order of the batches. Up to
+        `max_concurrent_batches` batches are tagged at once."""
+        batch_texts = [[text for _, text in batch] for batch in batches]
+        if self.max_concurrent_batches <= 1:
+            yield from map(self.tag_entities_in_batch, tqdm(batch_texts))
+            return
+
+        def tag_batch(context: contextvars.Context, texts: list[str]) -> list[list[EntityCharSpan]]:
+            return context.run(self.tag_entities_in_batch, texts)
+
+        # each batch runs in its own copy of the caller's context, so it's counted in its stage.
+        contexts = [contextvars.copy_context() for _ in batch_texts]
+        with ThreadPoolExecutor(self.max_concurrent_batches) as executor:
+            yield from tqdm(executor.map(tag_batch, contexts, batch_texts), total=len(batch_texts))
+
     def _predict(self, doc: Document) -> list[Entity]:
         all_entities = []
 
-        for batch in tqdm(self.generate_batches(doc)):
-            batch_entities, batch_texts = zip(*batch)
-            tagged_by_instance = self.tag_entities_in_batch(batch_texts)
+        batches = self.generate_batches(doc)
+        for batch, tagged_by_instance in zip(batches, self.tag_batches(batches)):
+            add_count("batches")
+            add_count("sentences", len(batch))
             for (instance_entity, instance_text), instance_tagged in zip(batch, tagged_by_instance):
                 all_entities.extend(map_char_spans_to_entity(instance_entity, instance_tagged))
 
@@ -0,0 +1,254 @@
+"""
+A local, persistent job queue for processing papers, backed by SQLite.
+
+The app submits jobs and polls their progress; one or more worker processes (see
+`paper_worker.py`) claim queued jobs and record each stage as they run it. Since jobs live in the
+database rather than in a Streamlit session, they survive browser refreshes, and any number of
+workers can share the queue.
+
+Jobs' API keys (those of LLM predictors) aren't stored in the database: they're kept in a file per
+job, only readable by its owner, next to the database, and deleted once the job is finished.
+"""
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import json
+import os
+import sqlite3
+import time
+from typing import Iterator, Optional
+import uuid
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+STAGE_RUNNING = "running"
+STAGE_COMPLETE = "complete"
+STAGE_ERROR = "error"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    pdf_path TEXT NOT NULL,
+    output_filename TEXT NOT NULL,
+    pipeline_config TEXT NOT NULL,
+    stages TEXT NOT NULL DEFAULT '[]',
+    error TEXT,
+    worker_pid INTEGER,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created_at);
+"""
+
+
+@dataclass
+class Job:
+    job_id: str
+    status: str
+    pdf_path: str
+    output_filename: str
+    pipeline_config: dict
+    stages: list[dict] = field(default_factory=list)
+    error: Optional[str] = None
+    worker_pid: Optional[int] = None
+    created_at: float = 0.0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> "Job":
+        job_fields = dict(row)
+        job_fields["pipeline_config"] = json.loads(job_fields["pipeline_config"])
+        job_fields["stages"] = json.loads(job_fields["stages"])
+        return cls(**job_fields)
+
+
+def pid_is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def split_api_keys(pipeline_config: dict) -> tuple[dict, list[Optional[str]]]:
+    """A copy of a pipeline config without its LLM predictors' API keys, and the keys, in order."""
+    pipeline_config = json.loads(json.dumps(pipeline_config))
+    api_keys = [
+        llm_config.pop("api_key", None)
+        for llm_config in pipeline_config.get("llm_predictors", [])
+    ]
+    return pipeline_config, api_keys
+
+
+class JobQueue:
+    """A queue of paper processing jobs, shared by every process that opens the same database.
+
+    Each operation uses its own short-lived connection, so a JobQueue can be used from any thread,
+    and claiming a job is atomic across processes.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.secrets_dir = os.path.join(os.path.dirname(os.path.abspath(db_path)), "job_secrets")
+        os.makedirs(self.secrets_dir, mode=0o700, exist_ok=True)
+        with self._connect() as connection:
+            # WAL lets the app poll progress while a worker is writing.
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def _secrets_path(self, job_id: str) -> str:
+        return os.path.join(self.secrets_dir, f"{job_id}.json")
+
+    def submit(self, pdf_path: str, output_filename: str, pipeline_config: dict) -> str:
+        """Queue a paper for processing, returning the new job's ID."""
+        job_id = uuid.uuid4().hex
+        pipeline_config, api_keys = split_api_keys(pipeline_config)
+        if any(api_keys):
+            # written before the job is queued, so a worker can't claim it without its keys.
+            secrets_fd = os.open(
+                self._secrets_path(job_id), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600
+            )
+            with os.fdopen(secrets_fd, "w") as f:
+                json.dump(api_keys, f)
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO jobs (job_id, status, pdf_path, output_filename, pipeline_config,"
+                " created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    QUEUED,
+                    pdf_path,
+                    output_filename,
+                    json.dumps(pipeline_config),
+                    time.time(),
+                ),
+            )
+        return job_id
+
+    def claim(self, worker_pid: Optional[int] = None) -> Optional[Job]:
+        """Take the oldest queued job and mark it as running, or return None if there are none."""
+        worker_pid = worker_pid if worker_pid is not None else os.getpid()
+        with self._connect() as connection:
+            # BEGIN IMMEDIATE takes the write lock up front, so two workers can't claim one job.
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+            started_at = time.time()
+            connection.execute(
+                "UPDATE jobs SET status = ?, worker_pid = ?, started_at = ? WHERE job_id = ?",
+                (RUNNING, worker_pid, started_at, row["job_id"]),
+            )
+            connection.execute("COMMIT")
+
+        job = Job.from_row(row)
+        if os.path.exists(self._secrets_path(job.job_id)):
+            with open(self._secrets_path(job.job_id)) as f:
+                api_keys = json.load(f)
+            for llm_config, api_key in zip(job.pipeline_config.get("llm_predictors", []), api_keys):
+                if api_key is not None:
+                    llm_config["api_key"] = api_key
+        job.status = RUNNING
+        job.worker_pid = worker_pid
+        job.started_at = started_at
+        return job
+
+    def set_stages(self, job_id: str, stages: list[dict]) -> None:
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET stages = ? WHERE job_id = ?", (json.dumps(stages), job_id)
+            )
+
+    def finish(self, job_id: str, error: Optional[str] = None) -> None:
+        """Mark a job as done, or as failed if there's an error. API keys are only needed while it
+        runs, so they're deleted, along with any stored in its pipeline config by earlier versions
+        of the queue."""
+        if os.path.exists(self._secrets_path(job_id)):
+            os.remove(self._secrets_path(job_id))
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT pipeline_config FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            pipeline_config = json.loads(row["pipeline_config"]) if row is not None else {}
+            for llm_config in pipeline_config.get("llm_predictors", []):
+                llm_config.pop("api_key", None)
+            connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ?, pipeline_config = ?"
+                " WHERE job_id = ?",
+                (
+                    FAILED if error is not None else DONE,
+                    error,
+                    time.time(),
+                    json.dumps(pipeline_config),
+                    job_id,
+                ),
+            )
+            connection.execute("COMMIT")
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._connect() as connection:
+            row = connection.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return Job.from_row(row) if row is not None else None
+
+    def get_many(self, job_ids: list[str]) -> list[Job]:
+        """Get jobs by ID, in the order given, skipping any that don't exist."""
+        if not job_ids:
+            return []
+        with self._connect() as connection:
+            rows = connection.execute(
+                f"SELECT * FROM jobs WHERE job_id IN ({', '.join('?' * len(job_ids))})", job_ids
+            ).fetchall()
+        jobs_by_id = {row["job_id"]: Job.from_row(row) for row in rows}
+        return [jobs_by_id[job_id] for job_id in job_ids if job_id in jobs_by_id]
+
+    def count(self, status: str) -> int:
+        with self._connect() as connection:
+            return connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)
+            ).fetchone()[0]
+
+    def requeue_abandoned(self) -> int:
+        """Put running jobs whose worker process has died back on the queue, returning how many
+        there were. Only meaningful for workers on this machine, which is all this queue is for."""
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            rows = connection.execute(
+                "SELECT job_id, worker_pid FROM jobs WHERE status = ?", (RUNNING,)
+            ).fetchall()
+            abandoned = [
+                row["job_id"]
+                for row in rows
+                if row["worker_pid"] is None or not pid_is_alive(row["worker_pid"])
+            ]
+            connection.executemany(
+                "UPDATE jobs SET status = ?, worker_pid = NULL, started_at = NULL, stages = '[]'"
+                " WHERE job_id = ?",
+                [(QUEUED, job_id) for job_id in abandoned],
+            )
+            connection.execute("COMMIT")
+        return len(abandoned)
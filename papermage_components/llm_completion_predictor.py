@@ -64,11 +64,14 @@ class LiteLlmCompletionPredictor(TextGenerationPredictorABC):
         api_key: str,
         prompt_generator_function: Callable[[str], List[LLMMessage]],
         entity_to_process="reading_order_sections",
+        prompt_string: Optional[str] = None,
     ):
         super().__init__(entity_to_process)
         self.model_name = model_name
         self.api_key = api_key
         self.generate_prompt = prompt_generator_function
+        # kept so that the predictor can be recreated in a background worker.
+        self.prompt_string = prompt_string
 
     def validate(self):
         env_validation = validate_environment(model=self.model_name, api_key=self.api_key)
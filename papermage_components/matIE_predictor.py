@@ -133,6 +133,11 @@ class MatIEPredictor(BasePredictor):
     def REQUIRED_DOCUMENT_FIELDS(self) -> List[str]:
         return [SentencesFieldName, TokensFieldName]
 
+    @property
+    def UPDATED_DOCUMENT_FIELDS(self) -> List[str]:
+        # the relations found in each paragraph are stored in its metadata.
+        return ["reading_order_sections"]
+
     @property
     def entity_types(self):
         return MAT_IE_TYPES
@@ -4,10 +4,15 @@ Adapted from
 
 """
 
+from dataclasses import dataclass
+import importlib
 import logging
+from threading import RLock
+import time
 import warnings
 from pathlib import Path
-from typing import Dict, List, Union
+from types import ModuleType
+from typing import Any, Callable, Dict, List, Optional, Union
 
 
 from papermage.magelib import (
@@ -16,7 +21,6 @@ from papermage.magelib import (
     AuthorsFieldName,
     BibliographiesFieldName,
     BlocksFieldName,
-    Box,
     CaptionsFieldName,
     Document,
     EntitiesFieldName,
@@ -38,34 +42,21 @@ from papermage.magelib import (
     SymbolsFieldName,
     TablesFieldName,
     TitlesFieldName,
-    TokensFieldName,
     WordsFieldName,
 )
 from papermage.parsers.pdfplumber_parser import PDFPlumberParser
-from papermage.predictors import (
-    HFBIOTaggerPredictor,
-    IVILATokenClassificationPredictor,
-    LPEffDetFormulaPredictor,
-    LPEffDetPubLayNetBlockPredictor,
-    PysbdSentencePredictor,
-    SVMWordPredictor,
-)
-from papermage.predictors.word_predictors import make_text
-from papermage.rasterizers.rasterizer import PDF2ImageRasterizer
 from papermage.recipes.recipe import Recipe
 from papermage.utils.annotate import group_by
 
-from papermage_components.chem_data_extractor_predictor import ChemDataExtractorPredictor
-from papermage_components.scispacy_sentence_predictor import SciSpacySentencePredictor
-from papermage_components.matIE_predictor import MatIEPredictor
-from papermage_components.matie_service_predictor import MatIEServicePredictor
-from papermage_components.reading_order_parser import GrobidReadingOrderParser
 from papermage_components.highlightParser import FitzHighlightParser
-from papermage_components.table_transformer_structure_predictor import (
-    TableTransformerStructurePredictor,
+from papermage_components.instrumentation import PipelineMetrics, add_count
+from papermage_components.page_images import (
+    LazyPDF2ImageRasterizer,
+    page_sizes_for_stage,
+    rasterized_for_stage,
 )
-from papermage_components.table_structure_predictor_mathpix import MathPixTableStructurePredictor
-from papermage_components.hf_token_classification_predictor import HfTokenClassificationPredictor
+from papermage_components.relation_graph import attach_document_graph
+from papermage_components.utils import set_boxes_and_text_from_tokens
 
 VILA_LABELS_MAP = {
     "Title": TitlesFieldName,
@@ -91,7 +82,41 @@ headers = {"app_id": "", "app_key": ""}
 url = "https://api.mathpix.com/v3/text"
 
 
+@dataclass
+class ComponentLoadTime:
+    import_seconds: float
+    load_seconds: float
+
+
+class LazyComponent:
+    """A recipe component that's only imported and loaded the first time it's used.
+
+    Wraps a method taking the recipe and an `import_module` function, which the method should use
+    to import whatever the component needs, so that import time is profiled separately from the
+    time taken to load the model itself.
+    """
+
+    def __init__(self, load: Callable[["MaterialsRecipe", Callable[[str], ModuleType]], Any]):
+        self.load = load
+        self.name = load.__name__
+        self.__doc__ = load.__doc__
+
+    def __get__(self, recipe: Optional["MaterialsRecipe"], owner=None):
+        if recipe is None:
+            return self
+        # once loaded, the component is stored on the instance, which takes precedence over this
+        # (non-data) descriptor.
+        return recipe._load_component(self)
+
+
 class MaterialsRecipe(Recipe):
+    """The full materials pipeline.
+
+    All models, and the GROBID client, are loaded the first time they're used, so a process that
+    only runs some stages only pays for those. Call `prewarm` to load components ahead of time;
+    `load_profile` records how long each component took to import and load.
+    """
+
     def __init__(
         self,
         ivila_predictor_path: str = "allenai/ivila-row-layoutlm-finetuned-s2vl-v2",
@@ -105,97 +130,227 @@ class MaterialsRecipe(Recipe):
         matie_url: str = "",
         gpu_id: str = "0",
         dpi: int = 300,
+        block_dpi: Optional[int] = None,
+        vila_dpi: Optional[int] = None,
         mathpix_token: dict = None,
+        mathpix_url: str = url,
+        mathpix_cache_dir: Optional[str] = "data/mathpix_cache",
         chemdataextractor_url=None,
     ):
         self.logger = logging.getLogger(self.__class__.__name__)
+        # `dpi` is the resolution of the page images kept with the document. Blocks are predicted
+        # on those images unless given their own `block_dpi`, and table predictors declare their
+        # own DPI. iVILA only reads the page size, which sets the scale of the token coordinates it
+        # sees, so its pages are never rendered; `vila_dpi` defaults to `dpi`.
         self.dpi = dpi
+        self.block_dpi = block_dpi
+        self.vila_dpi = vila_dpi if vila_dpi is not None else dpi
+
+        self.ivila_predictor_path = ivila_predictor_path
+        self.svm_word_predictor_path = svm_word_predictor_path
+        self.scispacy_model = scispacy_model
+        self.grobid_server_url = grobid_server_url
+        self.xml_out_dir = xml_out_dir
+        self.matIE_directory = matIE_directory
+        self.matie_url = matie_url
+        self.gpu_id = gpu_id
+        self.mathpix_token = mathpix_token
+        self.mathpix_url = mathpix_url
+        self.mathpix_cache_dir = mathpix_cache_dir
+        self.chemdataextractor_url = chemdataextractor_url
+
+        self.load_profile: dict[str, ComponentLoadTime] = {}
+        self._component_lock = RLock()
 
-        self.logger.info("Instantiating _recipe...")
         self.pdfplumber_parser = PDFPlumberParser()
-        self.grobid_order_parser = GrobidReadingOrderParser(
-            grobid_server_url, check_server=True, xml_out_dir=xml_out_dir
-        )
         self.highlight_parser = FitzHighlightParser(annotated_pdf_directory)
-        self.rasterizer = PDF2ImageRasterizer()
+        self.rasterizer = LazyPDF2ImageRasterizer()
+
+    @classmethod
+    def component_names(cls) -> list[str]:
+        """The names of all lazily loaded components, in the order they're defined."""
+        return [name for name, value in vars(cls).items() if isinstance(value, LazyComponent)]
 
+    def is_loaded(self, component_name: str) -> bool:
+        return component_name in self.__dict__
+
+    def _load_component(self, component: LazyComponent) -> Any:
+        with self._component_lock:
+            if component.name in self.__dict__:
+                return self.__dict__[component.name]
+
+            import_seconds = 0.0
+
+            def import_module(module_name: str) -> ModuleType:
+                nonlocal import_seconds
+                import_start = time.perf_counter()
+                module = importlib.import_module(module_name)
+                import_seconds += time.perf_counter() - import_start
+                return module
+
+            self.logger.info(f"Loading {component.name}...")
+            start = time.perf_counter()
+            loaded = component.load(self, import_module)
+            total_seconds = time.perf_counter() - start
+
+            self.load_profile[component.name] = ComponentLoadTime(
+                import_seconds=import_seconds, load_seconds=total_seconds - import_seconds
+            )
+            self.__dict__[component.name] = loaded
+            return loaded
+
+    def prewarm(self, component_names: Optional[List[str]] = None) -> Dict[str, ComponentLoadTime]:
+        """Load the given components (by default, all of them) ahead of their first use, and log
+        the load profile."""
+        for component_name in component_names or self.component_names():
+            getattr(self, component_name)
+        self.logger.info("Recipe load profile:\n" + self.format_load_profile())
+        return self.load_profile
+
+    def format_load_profile(self) -> str:
+        lines = [f"{'component':<40} {'import (s)':>10} {'load (s)':>10}"]
+        for component_name, load_time in self.load_profile.items():
+            lines.append(
+                f"{component_name:<40} {load_time.import_seconds:>10.2f}"
+                f" {load_time.load_seconds:>10.2f}"
+            )
+        return "\n".join(lines)
+
+    @LazyComponent
+    def grobid_order_parser(self, import_module):
+        reading_order_parser = import_module("papermage_components.reading_order_parser")
+        return reading_order_parser.GrobidReadingOrderParser(
+            self.grobid_server_url, check_server=True, xml_out_dir=self.xml_out_dir
+        )
+
+    @LazyComponent
+    def word_predictor(self, import_module):
+        predictors = import_module("papermage.predictors")
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            self.word_predictor = SVMWordPredictor.from_path(svm_word_predictor_path)
+            return predictors.SVMWordPredictor.from_path(self.svm_word_predictor_path)
+
+    @LazyComponent
+    def publaynet_block_predictor(self, import_module):
+        predictors = import_module("papermage.predictors")
+        return predictors.LPEffDetPubLayNetBlockPredictor.from_pretrained()
+
+    @LazyComponent
+    def ivila_predictor(self, import_module):
+        predictors = import_module("papermage.predictors")
+        return predictors.IVILATokenClassificationPredictor.from_pretrained(
+            self.ivila_predictor_path
+        )
 
-        self.publaynet_block_predictor = LPEffDetPubLayNetBlockPredictor.from_pretrained()
-        self.ivila_predictor = IVILATokenClassificationPredictor.from_pretrained(
-            ivila_predictor_path
+    @LazyComponent
+    def sent_predictor(self, import_module):
+        scispacy_sentence_predictor = import_module(
+            "papermage_components.scispacy_sentence_predictor"
         )
-        # self.bio_roberta_predictor = HFBIOTaggerPredictor.from_pretrained(
-        #     bio_roberta_predictor_path,
-        #     entity_name="tokens",
-        #     context_name="pages",
-        # )
-        self.sent_predictor = SciSpacySentencePredictor(
-            model_name=scispacy_model,
+        return scispacy_sentence_predictor.SciSpacySentencePredictor(
+            model_name=self.scispacy_model,
         )
 
-        if matie_url:
-            self.matIE_predictor = MatIEServicePredictor(matie_url)
-        elif matIE_directory:
-            self.matIE_predictor = MatIEPredictor(
-                matIE_directory=matIE_directory,
-                gpu_id=gpu_id,
+    @LazyComponent
+    def matIE_predictor(self, import_module):
+        if self.matie_url:
+            matie_service_predictor = import_module("papermage_components.matie_service_predictor")
+            return matie_service_predictor.MatIEServicePredictor(self.matie_url)
+        elif self.matIE_directory:
+            matIE_predictor = import_module("papermage_components.matIE_predictor")
+            return matIE_predictor.MatIEPredictor(
+                matIE_directory=self.matIE_directory,
+                gpu_id=self.gpu_id,
             )
         else:
-            self.matIE_predictor = None
+            return None
 
-        self.table_transformer_structure_predictor = (
-            TableTransformerStructurePredictor.from_model_name()
+    @LazyComponent
+    def table_transformer_structure_predictor(self, import_module):
+        predictor_module = import_module(
+            "papermage_components.table_transformer_structure_predictor"
+        )
+        return predictor_module.TableTransformerStructurePredictor.from_model_name()
+
+    @LazyComponent
+    def mathpix_structure_predictor(self, import_module):
+        if self.mathpix_token is None:
+            return None
+        table_structure_predictor_mathpix = import_module(
+            "papermage_components.table_structure_predictor_mathpix"
+        )
+        return table_structure_predictor_mathpix.MathPixTableStructurePredictor(
+            mathpix_headers=self.mathpix_token,
+            mathpix_url=self.mathpix_url,
+            cache_dir=self.mathpix_cache_dir,
         )
 
-        if mathpix_token is not None:
-            self.mathpix_structure_predictor = MathPixTableStructurePredictor(
-                mathpix_headers=mathpix_token
-            )
-        else:
-            self.mathpix_structure_predictor = None
-
-        if chemdataextractor_url is not None:
-            self.cde_predictor = ChemDataExtractorPredictor(chemdataextractor_url)
-        else:
-            self.cde_predictor = None
-
-        self.logger.info("Finished instantiating _recipe")
+    @LazyComponent
+    def cde_predictor(self, import_module):
+        if self.chemdataextractor_url is None:
+            return None
+        chem_data_extractor_predictor = import_module(
+            "papermage_components.chem_data_extractor_predictor"
+        )
+        return chem_data_extractor_predictor.ChemDataExtractorPredictor(
+            self.chemdataextractor_url
+        )
 
     def from_pdf(self, pdf: Path) -> Document:
+        metrics = PipelineMetrics()
         self.logger.info("Parsing document...")
-        doc = self.pdfplumber_parser.parse(input_pdf_path=pdf)
+        with metrics.stage("parse"):
+            doc = self.pdfplumber_parser.parse(input_pdf_path=pdf)
+            add_count("pages", len(doc.pages))
+            add_count("tokens", len(doc.tokens))
         self.logger.info("Getting Reading Order Sections...")
-        doc = self.grobid_order_parser.parse(
-            pdf,
-            doc,
-        )
+        with metrics.stage("reading_order", doc):
+            doc = self.grobid_order_parser.parse(
+                pdf,
+                doc,
+            )
         # self.logger.info("Parsing highlights...")
         # doc = self.highlight_parser.parse(pdf, doc)
 
+        # pages are rasterized lazily, when first used.
         self.logger.info("Rasterizing document...")
-        images = self.rasterizer.rasterize(input_pdf_path=pdf, dpi=self.dpi)
-        doc.annotate_images(images=list(images))
-        self.rasterizer.attach_images(images=images, doc=doc)
-        return self.from_doc(doc=doc)
+        with metrics.stage("rasterize"):
+            images = self.rasterizer.rasterize(input_pdf_path=pdf, dpi=self.dpi)
+            doc.annotate_images(images=list(images))
+            self.rasterizer.attach_images(images=images, doc=doc)
+        return self.from_doc(doc=doc, pdf_path=pdf, metrics=metrics)
+
+    def from_doc(
+        self,
+        doc: Document,
+        pdf_path: Optional[str] = None,
+        metrics: Optional[PipelineMetrics] = None,
+    ) -> Document:
+        """Run the pipeline on a parsed document. If `pdf_path` is given, each stage rasterizes
+        the pages it needs at its own DPI; otherwise, all stages use the attached page images.
+
+        The metrics of each stage are added to the document's metadata, after those already
+        collected in `metrics`, if given."""
+        metrics = metrics if metrics is not None else PipelineMetrics()
 
-    def from_doc(self, doc: Document) -> Document:
         self.logger.info("Predicting words...")
-        words = self.word_predictor.predict(doc=doc)
-        doc.annotate_layer(name=WordsFieldName, entities=words)
+        with metrics.stage("words", doc):
+            words = self.word_predictor.predict(doc=doc)
+            doc.annotate_layer(name=WordsFieldName, entities=words)
 
         self.logger.info("Predicting sentences...")
-        sentences = self.sent_predictor.predict(doc=doc)
-        doc.annotate_layer(name=SentencesFieldName, entities=sentences)
+        with metrics.stage("sentences", doc):
+            sentences = self.sent_predictor.predict(doc=doc)
+            doc.annotate_layer(name=SentencesFieldName, entities=sentences)
 
         if self.matIE_predictor is not None:
             self.logger.info("Predicting MatIE Entities...")
-            matIE_entities = self.matIE_predictor.predict(doc=doc)
-            doc.annotate_layer(
-                name=self.matIE_predictor.preferred_layer_name, entities=matIE_entities
-            )
+            with metrics.stage("matie", doc):
+                matIE_entities = self.matIE_predictor.predict(doc=doc)
+                doc.annotate_layer(
+                    name=self.matIE_predictor.preferred_layer_name, entities=matIE_entities
+                )
+                attach_document_graph(doc)
             if "entity_types" not in doc.metadata:
                 doc.metadata["entity_types"] = {}
             doc.metadata["entity_types"][
@@ -204,46 +359,43 @@ class MaterialsRecipe(Recipe):
 
         if self.cde_predictor is not None:
             self.logger.info("Predicting ChemDataExtractor Entities")
-            cde_entities = self.cde_predictor.predict(doc=doc)
-            doc.annotate_layer(self.cde_predictor.preferred_layer_name, entities=cde_entities)
+            with metrics.stage("chemdataextractor", doc):
+                cde_entities = self.cde_predictor.predict(doc=doc)
+                doc.annotate_layer(self.cde_predictor.preferred_layer_name, entities=cde_entities)
 
         self.logger.info("Predicting blocks...")
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            blocks = self.publaynet_block_predictor.predict(doc=doc)
-        doc.annotate_layer(name=BlocksFieldName, entities=blocks)
+        with metrics.stage("blocks", doc):
+            with warnings.catch_warnings(), rasterized_for_stage(doc, pdf_path, self.block_dpi):
+                warnings.simplefilter("ignore")
+                blocks = self.publaynet_block_predictor.predict(doc=doc)
+            doc.annotate_layer(name=BlocksFieldName, entities=blocks)
 
         self.logger.info("Predicting vila...")
-        vila_entities = self.ivila_predictor.predict(doc=doc)
-        doc.annotate_layer(name="vila_entities", entities=vila_entities)
-
-        for entity in vila_entities:
-            entity.boxes = [
-                Box.create_enclosing_box(
-                    [
-                        b
-                        for t in doc.intersect_by_span(entity, name=TokensFieldName)
-                        for b in t.boxes
-                    ]
-                )
-            ]
-            entity.text = make_text(entity=entity, document=doc)
-        preds = group_by(
-            entities=vila_entities, metadata_field="label", metadata_values_map=VILA_LABELS_MAP
-        )
-        doc.annotate(*preds)
+        with metrics.stage("vila", doc):
+            with page_sizes_for_stage(doc, pdf_path, self.vila_dpi):
+                vila_entities = self.ivila_predictor.predict(doc=doc)
+            doc.annotate_layer(name="vila_entities", entities=vila_entities)
+
+            set_boxes_and_text_from_tokens(vila_entities, doc)
+            preds = group_by(
+                entities=vila_entities, metadata_field="label", metadata_values_map=VILA_LABELS_MAP
+            )
+            doc.annotate(*preds)
 
         self.logger.info("Predicting table structure - Table Transformer")
-        table_transformer_entities = self.table_transformer_structure_predictor.predict(doc)
-        doc.annotate_layer(
-            self.table_transformer_structure_predictor.preferred_layer_name,
-            table_transformer_entities,
-        )
+        table_predictor = self.table_transformer_structure_predictor
+        with metrics.stage("table_transformer", doc):
+            with rasterized_for_stage(doc, pdf_path, table_predictor.dpi):
+                table_transformer_entities = table_predictor.predict(doc)
+            doc.annotate_layer(table_predictor.preferred_layer_name, table_transformer_entities)
 
         if self.mathpix_structure_predictor is not None:
             self.logger.info("Predicting table structure - MathPix")
-            self.mathpix_structure_predictor.get_table(doc)
+            with metrics.stage("mathpix", doc):
+                with rasterized_for_stage(doc, pdf_path, self.mathpix_structure_predictor.dpi):
+                    self.mathpix_structure_predictor.get_table(doc)
 
+        metrics.attach(doc)
         return doc
 
 
@@ -1,11 +1,12 @@
 from collections import Counter
 import re
+from typing import Optional
 
 from mendeleev import element
-import networkx as nx
 import pandas as pd
-from papermage import Document, Span
-import streamlit as st
+
+from papermage_components.relation_graph import DocumentGraph
+from papermage_components.utils import normalize_entity_string
 
 composed_alloy_re = re.compile(
     "(\(?(((?P<alloy_component>[A-Z][a-z]?) (?P<fraction>0\.\d+)+?) ?)+)(\) ?[CBNO])?"
@@ -13,10 +14,6 @@ composed_alloy_re = re.compile(
 fraction_re = re.compile("(?P<element>[A-Z][a-z]?)+ (?P<fraction>\d\.\d+)")
 
 
-def normalize_entity_string(entity_string: str):
-    return entity_string.replace("-\n", "").replace("\n", " ")
-
-
 def get_most_common_materials(matie_entities, n=3):
     # there's maybe an opportunity to do a little more clustering here?
     material_strings = [
@@ -55,103 +52,61 @@ def get_composition_table(matie_entities, n=3):
     return composition_df.fillna(0)
 
 
-@st.cache_data
-def create_document_graph(_doc: Document, identifier: str = None) -> nx.Graph:
-    doc_graph = nx.Graph()
-    for section in _doc.reading_order_sections:
-        clean_section_name = section.metadata["section_name"].replace(" ", "_")
-        section_prefix = f"{clean_section_name}_{section.metadata['paragraph_reading_order']}"
-        for entity in section.TAGGED_ENTITIES_MatIE:
-            doc_graph.add_node(
-                section_prefix + "_" + entity.metadata["entity_id"],
-                entity_type=entity.metadata["entity_type"],
-                entity_text=entity.text,
-                entity_section=section.metadata["section_name"],
-            )
-
-        for relation in section.metadata["in_section_relations"]:
-            node1 = section_prefix + "_" + relation["arg1"]
-            node2 = section_prefix + "_" + relation["arg2"]
-            if node1 not in doc_graph or node2 not in doc_graph:
-                print(node1, node2)
-                continue
-            doc_graph.add_edge(node1, node2, relation_type=relation["relation_type"])
-
-    return doc_graph
-
-
-def gnp(graph, node, property):
-    if not node:
+def gnp(values: list[str], node: Optional[int]) -> Optional[str]:
+    if node is None:
         return None
-    return normalize_entity_string(graph.nodes[node][property])
-
+    return normalize_entity_string(values[node])
 
-def get_neighbors_of_type(graph, node, e_type):
-    return [n for n in graph.neighbors(node) if graph.nodes[n]["entity_type"] == e_type]
 
-
-def get_property_table(doc_graph):
+def get_property_table(doc_graph: DocumentGraph) -> pd.DataFrame:
     property_table = []
-    property_nodes = [
-        node for node in doc_graph if doc_graph.nodes[node]["entity_type"] in ["Property"]
-    ]
-    property_strings = [gnp(doc_graph, node, "entity_text") for node in property_nodes]
-    for property_node, property_string in zip(property_nodes, property_strings):
-        material_neighbors = get_neighbors_of_type(doc_graph, property_node, "Material")
-        result_neighbors = get_neighbors_of_type(doc_graph, property_node, "Result")
+    texts, sections = doc_graph.node_texts, doc_graph.node_sections
+    for property_node in doc_graph.nodes_of_type("Property"):
+        property_string = gnp(texts, property_node)
+        material_neighbors = doc_graph.neighbors_of_type(property_node, "Material")
+        result_neighbors = doc_graph.neighbors_of_type(property_node, "Result")
         for mat_node in material_neighbors:
             for result_node in result_neighbors:
                 property_table.append(
                     {
-                        "material": gnp(doc_graph, mat_node, "entity_text"),
+                        "material": gnp(texts, mat_node),
                         "property": property_string,
-                        "result": gnp(doc_graph, result_node, "entity_text"),
-                        "section": gnp(doc_graph, mat_node, "entity_section"),
+                        "result": gnp(texts, result_node),
+                        "section": gnp(sections, mat_node),
                     }
                 )
     return pd.DataFrame(property_table)
 
 
-def get_synthesis_method_table(doc_graph):
+def first_neighbor_of_type(doc_graph: DocumentGraph, node: Optional[int], e_type: str):
+    if node is None:
+        return None
+    neighbors = doc_graph.neighbors_of_type(node, e_type)
+    return neighbors[0] if neighbors else None
+
+
+def get_synthesis_method_table(doc_graph: DocumentGraph) -> pd.DataFrame:
     property_table = []
-    synthesis_nodes = [
-        node for node in doc_graph if doc_graph.nodes[node]["entity_type"] in ["Synthesis"]
-    ]
-    synthesis_strings = [gnp(doc_graph, node, "entity_text") for node in synthesis_nodes]
-    for synthesis_node, synthesis_string in zip(synthesis_nodes, synthesis_strings):
-        env_neighbors = get_neighbors_of_type(doc_graph, synthesis_node, "Environment")
-        amt_neighbors = get_neighbors_of_type(doc_graph, synthesis_node, "Amount_Unit")
+    texts, sections = doc_graph.node_texts, doc_graph.node_sections
+    for synthesis_node in doc_graph.nodes_of_type("Synthesis"):
+        synthesis_string = gnp(texts, synthesis_node)
+        env_neighbors = doc_graph.neighbors_of_type(synthesis_node, "Environment")
+        amt_neighbors = doc_graph.neighbors_of_type(synthesis_node, "Amount_Unit")
         for env_neighbor in env_neighbors or [None]:
             for amt_neighbor in amt_neighbors or [None]:
-                amt_value_nodes = (
-                    get_neighbors_of_type(doc_graph, amt_neighbor, "Number")
-                    if amt_neighbor
-                    else None
-                )
-                amt_value_node = None if not amt_value_nodes else amt_value_nodes[0]
-
-                env_unit_nodes = (
-                    get_neighbors_of_type(doc_graph, env_neighbor, "Amount_Unit")
-                    if env_neighbor
-                    else None
-                )
-                env_unit_node = env_unit_nodes[0] if env_unit_nodes else None
-                env_amt_nodes = (
-                    get_neighbors_of_type(doc_graph, env_unit_node, "Number")
-                    if env_unit_node
-                    else None
-                )
-                env_amt_node = env_amt_nodes[0] if env_amt_nodes else None
+                amt_value_node = first_neighbor_of_type(doc_graph, amt_neighbor, "Number")
+                env_unit_node = first_neighbor_of_type(doc_graph, env_neighbor, "Amount_Unit")
+                env_amt_node = first_neighbor_of_type(doc_graph, env_unit_node, "Number")
 
                 property_table.append(
                     {
                         "synthesis_method": synthesis_string,
-                        "amount_value": gnp(doc_graph, amt_value_node, "entity_text"),
-                        "amount_unit": gnp(doc_graph, amt_neighbor, "entity_text"),
-                        "environment": gnp(doc_graph, env_neighbor, "entity_text"),
-                        "environment_value": gnp(doc_graph, env_amt_node, "entity_text"),
-                        "environment_unit": gnp(doc_graph, env_unit_node, "entity_text"),
-                        "section": gnp(doc_graph, synthesis_node, "entity_section"),
+                        "amount_value": gnp(texts, amt_value_node),
+                        "amount_unit": gnp(texts, amt_neighbor),
+                        "environment": gnp(texts, env_neighbor),
+                        "environment_value": gnp(texts, env_amt_node),
+                        "environment_unit": gnp(texts, env_unit_node),
+                        "section": gnp(sections, synthesis_node),
                     }
                 )
     return pd.DataFrame(property_table)
@@ -18,10 +18,11 @@ from papermage.magelib import (
 from papermage.predictors import BasePredictor
 from papermage.utils.annotate import group_by
 from pydantic import TypeAdapter
-import requests
 
 from papermage_components.constants import MAT_IE_TYPES
+from papermage_components.instrumentation import add_count
 from papermage_components.matIE_predictor import fix_entity_offsets, get_offset_map, MatIEEntity
+from papermage_components.service_sessions import service_post
 
 
 @dataclass
@@ -60,6 +61,11 @@ class MatIEServicePredictor(BasePredictor):
     def REQUIRED_DOCUMENT_FIELDS(self) -> List[str]:
         return [SentencesFieldName, TokensFieldName]
 
+    @property
+    def UPDATED_DOCUMENT_FIELDS(self) -> List[str]:
+        # the relations found in each paragraph are stored in its metadata.
+        return ["reading_order_sections"]
+
     @property
     def entity_types(self):
         return MAT_IE_TYPES
@@ -68,15 +74,21 @@ class MatIEServicePredictor(BasePredictor):
     def predictor_identifier(self):
         return "MatIE"
 
+    def annotate_payload(self, document_payload: dict[str, str]) -> dict:
+        """Send the paragraphs to the MatIE service, returning its raw JSON response."""
+        add_count("requests")
+        results = service_post(
+            "matie", self.service_url + "/annotate_strings", json=document_payload
+        )
+        return results.json()
+
     def _predict(self, doc: Document) -> List[Entity]:
         document_payload = construct_document_payload(doc)
 
-        results = requests.post(
-            self.service_url + "/annotate_strings", json=document_payload, timeout=600
+        annotated_content = TypeAdapter(MatIEResponse).validate_python(
+            self.annotate_payload(document_payload)
         )
 
-        annotated_content = TypeAdapter(MatIEResponse).validate_python(results.json())
-
         fixed_entities = []
         for (key, input_text), paragraph in zip(
             document_payload.items(), doc.reading_order_sections
@@ -0,0 +1,320 @@
+"""
+Lazy page images, and external storage for them.
+
+Pages are rasterized on demand, one page at a time, with `LazyPDF2ImageRasterizer`, and pipeline
+stages can temporarily swap in images at the resolution they need with `rasterized_at`. Crops of
+pages that haven't been rasterized, e.g. tables, are rendered directly from the PDF at the page's
+DPI, without rasterizing the rest of the page, and stages that only read page sizes get blank
+stand-ins, sized from the PDF, with `page_sizes_at`.
+
+Rather than serializing page images inside the document, they're written as separate compressed
+files under `<image_dir>/<document hash>/<page number>.<format>`, and the document's metadata keeps
+a reference to them. On load, pages get `LazyPageImage`s, which only read their file when the
+image is first used, so a view showing one page only decodes that page.
+"""
+
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, nullcontext
+import hashlib
+import os
+from typing import Iterator, Optional
+
+import fitz
+from papermage.magelib import Box, Document, Image, ImagesFieldName, PagesFieldName
+from papermage.rasterizers.rasterizer import PDF2ImageRasterizer
+import pdf2image
+from PIL import features
+from PIL import Image as PILImage
+
+PAGE_IMAGES_METADATA_KEY = "page_images"
+DEFAULT_IMAGE_FORMAT = "webp" if features.check("webp") else "png"
+WEBP_QUALITY = 90
+
+
+class LazyImage(Image, ABC):
+    """A papermage Image that only produces its PIL image on first access, from `load`."""
+
+    __slots__ = []
+
+    @abstractmethod
+    def load(self) -> PILImage.Image:
+        pass
+
+    @property
+    def pilimage(self) -> PILImage.Image:
+        if self._pilimage is None:
+            self._pilimage = self.load()
+        return self._pilimage
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self.pilimage.size
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._pilimage is not None
+
+    def unload(self) -> None:
+        """Release the image. It will be produced again if it's needed."""
+        self._pilimage = None
+
+
+class LazyPageImage(LazyImage):
+    """A page image stored in a file, and read from disk on first access."""
+
+    __slots__ = ["path"]
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+
+    def load(self) -> PILImage.Image:
+        pilimage = PILImage.open(self.path)
+        pilimage.load()
+        return pilimage
+
+
+def render_pdf_region(
+    pdf_path: str, box: Box, dpi: int, expand_box_by: float = 0.0
+) -> PILImage.Image:
+    """Render only the region of a PDF page covered by `box` at `dpi`, straight from the PDF.
+
+    `box` is in relative page coordinates, as for any papermage Box. Like `get_table_images`, the
+    box is expanded by `expand_box_by` to the top and left only.
+    """
+    with fitz.open(pdf_path) as pdf:
+        page = pdf[box.page]
+        page_rect = page.rect
+        clip = fitz.Rect(
+            page_rect.x0 + (box.l - expand_box_by) * page_rect.width,
+            page_rect.y0 + (box.t - expand_box_by) * page_rect.height,
+            page_rect.x0 + (box.l + box.w) * page_rect.width,
+            page_rect.y0 + (box.t + box.h) * page_rect.height,
+        )
+        pixmap = page.get_pixmap(dpi=dpi, clip=clip, alpha=False)
+        return PILImage.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+
+
+class LazyRasterizedPage(LazyImage):
+    """A page of a PDF, rasterized at the given DPI on first access."""
+
+    __slots__ = ["pdf_path", "page_number", "dpi", "_size"]
+
+    def __init__(self, pdf_path: str, page_number: int, dpi: int):
+        super().__init__()
+        self.pdf_path = pdf_path
+        self.page_number = page_number
+        self.dpi = dpi
+        self._size = None
+
+    def load(self) -> PILImage.Image:
+        # pdf2image pages are 1-indexed
+        return pdf2image.convert_from_path(
+            self.pdf_path,
+            dpi=self.dpi,
+            first_page=self.page_number + 1,
+            last_page=self.page_number + 1,
+        )[0]
+
+    @property
+    def size(self) -> tuple[int, int]:
+        """The size the page is, or will be, rasterized at, read from the PDF without rendering
+        the page."""
+        if self.is_loaded:
+            return self.pilimage.size
+        if self._size is None:
+            with fitz.open(self.pdf_path) as pdf:
+                page = pdf[self.page_number]
+                # like pdftoppm, which pdf2image runs: the media box, turned by the page's rotation.
+                width, height = page.mediabox.width, page.mediabox.height
+                if page.rotation % 180 == 90:
+                    width, height = height, width
+            scale = self.dpi / 72
+            self._size = (int(width * scale + 0.5), int(height * scale + 0.5))
+        return self._size
+
+    def crop(self, box: Box, expand_box_by: float = 0.0) -> PILImage.Image:
+        """Get the region of this page covered by `box`. If the page hasn't been rasterized, only
+        that region is rendered, rather than the whole page."""
+        if self.is_loaded:
+            page_w, page_h = self.pilimage.size
+            return self.pilimage.crop(
+                (
+                    (box.l - expand_box_by) * page_w,
+                    (box.t - expand_box_by) * page_h,
+                    (box.l + box.w) * page_w,
+                    (box.t + box.h) * page_h,
+                )
+            )
+        return render_pdf_region(self.pdf_path, box, self.dpi, expand_box_by)
+
+
+class BlankRasterizedPage(LazyRasterizedPage):
+    """A blank image the size of a page rasterized at the given DPI, which is never rendered."""
+
+    __slots__ = []
+
+    def load(self) -> PILImage.Image:
+        return PILImage.new("1", self.size)
+
+
+class LazyPDF2ImageRasterizer(PDF2ImageRasterizer):
+    """Drop-in replacement for PDF2ImageRasterizer that returns unrendered pages, each of which is
+    rasterized when its image is first used."""
+
+    def rasterize(self, input_pdf_path: str, dpi: int, **kwargs) -> list[LazyRasterizedPage]:
+        page_count = pdf2image.pdfinfo_from_path(input_pdf_path)["Pages"]
+        return [
+            LazyRasterizedPage(input_pdf_path, page_number, dpi)
+            for page_number in range(page_count)
+        ]
+
+
+def release_images(images: list[Image]) -> None:
+    for image in images:
+        if isinstance(image, LazyImage):
+            image.unload()
+
+
+@contextmanager
+def _with_stage_images(doc: Document, stage_images: list[Image]) -> Iterator[list[Image]]:
+    pages = doc.get_layer(PagesFieldName)
+    original_doc_images = getattr(doc, ImagesFieldName, None)
+    original_page_images = [page.images for page in pages]
+
+    setattr(doc, ImagesFieldName, stage_images)
+    for page, image in zip(pages, stage_images):
+        page.images = [image]
+    try:
+        yield stage_images
+    finally:
+        release_images(stage_images)
+        setattr(doc, ImagesFieldName, original_doc_images)
+        for page, images in zip(pages, original_page_images):
+            page.images = images
+
+
+def rasterized_at(doc: Document, pdf_path: str, dpi: int):
+    """Temporarily replace a document's page images with lazily rasterized ones at `dpi`.
+
+    Used by pipeline stages that need a particular resolution: only the pages the stage actually
+    looks at get rasterized, and all of them are released, and the original images restored, when
+    the stage finishes.
+    """
+    return _with_stage_images(doc, LazyPDF2ImageRasterizer().rasterize(pdf_path, dpi=dpi))
+
+
+def page_sizes_at(doc: Document, pdf_path: str, dpi: int):
+    """Like `rasterized_at`, but for stages that only read the size of each page image, e.g. iVILA,
+    which scales token coordinates by it: the images are blank, of the size the pages would be
+    rasterized at, and no page is rendered."""
+    page_count = len(doc.get_layer(PagesFieldName))
+    return _with_stage_images(
+        doc, [BlankRasterizedPage(pdf_path, page_number, dpi) for page_number in range(page_count)]
+    )
+
+
+def rasterized_for_stage(doc: Document, pdf_path: Optional[str], dpi: Optional[int]):
+    """`rasterized_at`, or a no-op if there's no PDF to rasterize or the stage has no DPI, in which
+    case the stage uses the images already attached to the document."""
+    if pdf_path is None or dpi is None:
+        return nullcontext()
+    return rasterized_at(doc, pdf_path, dpi)
+
+
+def page_sizes_for_stage(doc: Document, pdf_path: Optional[str], dpi: Optional[int]):
+    """`page_sizes_at`, or a no-op, as for `rasterized_for_stage`."""
+    if pdf_path is None or dpi is None:
+        return nullcontext()
+    return page_sizes_at(doc, pdf_path, dpi)
+
+
+def get_document_hash(doc: Document) -> str:
+    hasher = hashlib.sha256(doc.symbols.encode("utf-8"))
+    hasher.update(str(len(doc.get_layer(PagesFieldName))).encode("utf-8"))
+    return hasher.hexdigest()[:16]
+
+
+def has_page_images(doc: Document) -> bool:
+    return PagesFieldName in doc.layers and all(
+        page.images for page in doc.get_layer(PagesFieldName)
+    )
+
+
+def write_page_images(
+    doc: Document,
+    image_dir: str,
+    relative_to: str,
+    image_format: str = DEFAULT_IMAGE_FORMAT,
+    overwrite: bool = False,
+) -> dict:
+    """Write each page's image to `image_dir`, keyed by document hash and page number, and record
+    where they are in the document's metadata.
+
+    Parameters
+    ----------
+    doc : The document, whose pages have images attached.
+    image_dir : The root directory for page images.
+    relative_to : The directory the document is saved in. The image directory is stored relative to
+        this, so the two can be moved together.
+    image_format : "webp" or "png".
+    overwrite : Whether to rewrite images that already exist. Images are keyed by document hash, so
+        by default images from a previous run on the same paper are reused.
+
+    Returns
+    -------
+    The page image reference stored in the document metadata.
+    """
+    doc_hash = get_document_hash(doc)
+    doc_image_dir = os.path.join(image_dir, doc_hash)
+    os.makedirs(doc_image_dir, exist_ok=True)
+
+    page_files = []
+    for page_number, page in enumerate(doc.get_layer(PagesFieldName)):
+        page_file = f"{page_number}.{image_format}"
+        page_path = os.path.join(doc_image_dir, page_file)
+        if overwrite or not os.path.exists(page_path):
+            pilimage = page.images[0].pilimage
+            if image_format == "webp":
+                pilimage.save(page_path, format="WEBP", quality=WEBP_QUALITY)
+            else:
+                pilimage.save(page_path, format="PNG", optimize=True)
+            # pages rasterized just to be written out don't need to stay in memory.
+            release_images(page.images)
+        page_files.append(page_file)
+
+    page_image_reference = {
+        "document_hash": doc_hash,
+        "directory": os.path.relpath(doc_image_dir, relative_to),
+        "files": page_files,
+    }
+    doc.metadata[PAGE_IMAGES_METADATA_KEY] = page_image_reference
+    return page_image_reference
+
+
+def update_page_image_directory(doc: Document, relative_to: str) -> None:
+    """Point a document's page image reference at the images its pages were loaded from, relative
+    to a new document directory, e.g. when saving a loaded document somewhere else."""
+    page_image_reference = doc.metadata.get(PAGE_IMAGES_METADATA_KEY, None)
+    if not page_image_reference or PagesFieldName not in doc.layers:
+        return
+    first_page_images = doc.get_layer(PagesFieldName)[0].images
+    if first_page_images and isinstance(first_page_images[0], LazyPageImage):
+        image_dir = os.path.dirname(first_page_images[0].path)
+        page_image_reference["directory"] = os.path.relpath(image_dir, relative_to)
+
+
+def attach_page_images(doc: Document, document_dir: str) -> Optional[list[LazyPageImage]]:
+    """Attach lazy page images to a loaded document's pages, if it references external images."""
+    page_image_reference = doc.metadata.get(PAGE_IMAGES_METADATA_KEY, None)
+    if not page_image_reference or PagesFieldName not in doc.layers:
+        return None
+
+    image_dir = os.path.join(document_dir, page_image_reference["directory"])
+    images = [
+        LazyPageImage(os.path.join(image_dir, page_file))
+        for page_file in page_image_reference["files"]
+    ]
+    for page, image in zip(doc.get_layer(PagesFieldName), images):
+        page.images = [image]
+    return images
@@ -18,7 +18,9 @@ from papermage.magelib import (
     Metadata,
 )
 from papermage.parsers.parser import Parser
+import requests
 
+from papermage_components.service_sessions import service_post
 from papermage_components.utils import get_spans_from_boxes, merge_overlapping_entities
 
 
@@ -164,6 +166,36 @@ def segment_and_consolidate_boxes(
     return consolidated_boxes
 
 
+class PooledGrobidClient(GrobidClient):
+    """A GROBID client whose requests go through the shared "grobid" session, with its timeouts,
+    retries and circuit breaker. The stock client retries a busy (503) server forever."""
+
+    def post(self, url, params=None, data=None, files=None, **kwargs):
+        kwargs.pop("timeout", None)
+        try:
+            response = service_post("grobid", url, params=params, data=data, files=files, **kwargs)
+        except requests.HTTPError as e:
+            # the stock client expects error statuses back, except for 503, which it would retry
+            # forever; that one was already retried by the session, so it's raised instead.
+            if e.response.status_code != 503:
+                return e.response, e.response.status_code
+            close_posted_files(files)
+            raise
+        except Exception:
+            close_posted_files(files)
+            raise
+        return response, response.status_code
+
+
+def close_posted_files(files: Optional[dict]) -> None:
+    """Close the files of a failed request. The stock client only closes the PDF it opened when
+    the request returns, so an error raised from `post` would otherwise leak its handle."""
+    for file in (files or {}).values():
+        handle = file[1] if isinstance(file, tuple) else file
+        if hasattr(handle, "close"):
+            handle.close()
+
+
 class GrobidReadingOrderParser(Parser):
     def __init__(
         self,
@@ -186,7 +218,7 @@ class GrobidReadingOrderParser(Parser):
             json.dump(self.grobid_config, f)
             config_path = f.name
 
-        self.client = GrobidClient(config_path=config_path, check_server=check_server)
+        self.client = PooledGrobidClient(config_path=config_path, check_server=check_server)
 
         self.xml_out_dir = xml_out_dir
         os.remove(config_path)
@@ -194,17 +226,24 @@ class GrobidReadingOrderParser(Parser):
     def parse(self, input_pdf_path: str, doc: Document) -> Document:
         assert doc.symbols != ""
 
-        (_, _, xml) = self.client.process_pdf(
-            service="processFulltextDocument",
-            pdf_file=input_pdf_path,
-            generateIDs=False,
-            consolidate_header=False,
-            consolidate_citations=False,
-            include_raw_citations=False,
-            include_raw_affiliations=False,
-            tei_coordinates=True,
-            segment_sentences=True,
-        )
+        try:
+            (_, status, xml) = self.client.process_pdf(
+                service="processFulltextDocument",
+                pdf_file=input_pdf_path,
+                generateIDs=False,
+                consolidate_header=False,
+                consolidate_citations=False,
+                include_raw_citations=False,
+                include_raw_affiliations=False,
+                tei_coordinates=True,
+                segment_sentences=True,
+            )
+        except requests.HTTPError as e:
+            # a 503 that remained after retrying, which `post` raises rather than reporting.
+            status, xml = e.response.status_code, e.response.text
+        # the client reports other failed requests, and read timeouts, as a status.
+        if status != 200:
+            raise RuntimeError(f"GROBID failed to parse {input_pdf_path} ({status}): {xml}")
         assert xml is not None, "Grobid returned no XML"
 
         if self.xml_out_dir:
@@ -0,0 +1,142 @@
+"""
+The graph of the entities MatIE tags in a document and the relations it finds between them.
+
+The graph is built once, when MatIE is run on a paper, and stored in the document's metadata, so
+the views don't rebuild it from the entity layer and the relations in each paragraph. Nodes are
+numbered in the order MatIE's entities appear; besides the edge list, the graph keeps each node's
+neighbors grouped by entity type, and the nodes of each type, so questions like "the Results of
+this Property" are answered by a lookup, rather than by filtering every node.
+"""
+
+from typing import Optional
+
+from papermage import Document
+
+MATIE_LAYER_NAME = "TAGGED_ENTITIES_MatIE"
+DOCUMENT_GRAPH_METADATA_KEY = "matie_relation_graph"
+
+
+class DocumentGraph:
+    def __init__(
+        self,
+        node_types: list[str],
+        node_texts: list[str],
+        node_sections: list[str],
+        edges: list[tuple[int, int, str]],
+        nodes_by_type: Optional[dict[str, list[int]]] = None,
+        neighbors_by_type: Optional[list[dict[str, list[int]]]] = None,
+    ):
+        self.node_types = node_types
+        self.node_texts = node_texts
+        self.node_sections = node_sections
+        self.edges = edges
+        if nodes_by_type is None or neighbors_by_type is None:
+            nodes_by_type, neighbors_by_type = self._index_by_type()
+        self.nodes_by_type = nodes_by_type
+        self.neighbors_by_type = neighbors_by_type
+
+    def _index_by_type(self) -> tuple[dict[str, list[int]], list[dict[str, list[int]]]]:
+        nodes_by_type = {}
+        for node, node_type in enumerate(self.node_types):
+            nodes_by_type.setdefault(node_type, []).append(node)
+
+        # each node's neighbors, in the order they were first connected to it.
+        neighbors = [{} for _ in self.node_types]
+        for node1, node2, _ in self.edges:
+            neighbors[node1].setdefault(node2, None)
+            neighbors[node2].setdefault(node1, None)
+        neighbors_by_type = []
+        for node_neighbors in neighbors:
+            by_type = {}
+            for neighbor in node_neighbors:
+                by_type.setdefault(self.node_types[neighbor], []).append(neighbor)
+            neighbors_by_type.append(by_type)
+        return nodes_by_type, neighbors_by_type
+
+    def __len__(self) -> int:
+        return len(self.node_types)
+
+    def nodes_of_type(self, entity_type: str) -> list[int]:
+        return self.nodes_by_type.get(entity_type, [])
+
+    def neighbors_of_type(self, node: int, entity_type: str) -> list[int]:
+        return self.neighbors_by_type[node].get(entity_type, [])
+
+    @classmethod
+    def from_document(cls, doc: Document) -> "DocumentGraph":
+        """Build the graph from a document's MatIE entities, and the relations MatIE found in each
+        paragraph (`in_section_relations`). Relations whose entities aren't in the paragraph are
+        skipped; if the same pair of entities is related more than once, the last relation wins."""
+        node_ids = {}
+        node_types = []
+        node_texts = []
+        node_sections = []
+        edges = {}
+        for section in doc.reading_order_sections:
+            section_key = (
+                section.metadata["section_name"],
+                section.metadata["paragraph_reading_order"],
+            )
+            for entity in getattr(section, MATIE_LAYER_NAME):
+                key = section_key + (entity.metadata["entity_id"],)
+                if key not in node_ids:
+                    node_ids[key] = len(node_types)
+                    node_types.append(None)
+                    node_texts.append(None)
+                    node_sections.append(None)
+                node = node_ids[key]
+                node_types[node] = entity.metadata["entity_type"]
+                node_texts[node] = entity.text
+                node_sections[node] = section.metadata["section_name"]
+
+            for relation in section.metadata.get("in_section_relations", None) or []:
+                node1 = node_ids.get(section_key + (relation["arg1"],))
+                node2 = node_ids.get(section_key + (relation["arg2"],))
+                if node1 is None or node2 is None:
+                    continue
+                edge_key = (min(node1, node2), max(node1, node2))
+                if edge_key in edges:
+                    edges[edge_key] = (*edges[edge_key][:2], relation["relation_type"])
+                else:
+                    edges[edge_key] = (node1, node2, relation["relation_type"])
+
+        return cls(node_types, node_texts, node_sections, list(edges.values()))
+
+    def to_json(self) -> dict:
+        return {
+            "node_types": self.node_types,
+            "node_texts": self.node_texts,
+            "node_sections": self.node_sections,
+            "edges": [list(edge) for edge in self.edges],
+            "nodes_by_type": self.nodes_by_type,
+            "neighbors_by_type": self.neighbors_by_type,
+        }
+
+    @classmethod
+    def from_json(cls, graph_json: dict) -> "DocumentGraph":
+        return cls(
+            graph_json["node_types"],
+            graph_json["node_texts"],
+            graph_json["node_sections"],
+            [tuple(edge) for edge in graph_json["edges"]],
+            graph_json["nodes_by_type"],
+            graph_json["neighbors_by_type"],
+        )
+
+
+def attach_document_graph(doc: Document) -> DocumentGraph:
+    """Build the graph of the document's MatIE entities, and store it in the document's
+    metadata."""
+    graph = DocumentGraph.from_document(doc)
+    doc.metadata[DOCUMENT_GRAPH_METADATA_KEY] = graph.to_json()
+    return graph
+
+
+def get_document_graph(doc: Document) -> Optional[DocumentGraph]:
+    """The graph stored with the document, or built from its entities for documents processed
+    before graphs were stored; None if MatIE hasn't been run on it."""
+    if DOCUMENT_GRAPH_METADATA_KEY in doc.metadata:
+        return DocumentGraph.from_json(doc.metadata[DOCUMENT_GRAPH_METADATA_KEY])
+    if MATIE_LAYER_NAME not in doc.layers:
+        return None
+    return DocumentGraph.from_document(doc)
@@ -0,0 +1,390 @@
+"""
+Compact binary serialization for PaperMage documents.
+
+Documents are stored as `.npz` containers: the symbols are stored once as UTF-8 bytes, and each
+layer's spans and boxes are stored as flat columnar arrays indexed by per-entity offsets.
+Everything that isn't a span or a box (entity metadata, document metadata, relations...) is kept
+as JSON, so the round trip through `Document.to_json` and `Document.from_json` is lossless.
+
+Layers can be added to (or replaced in) a saved binary document with `append_layers`, which only
+writes the new layers and the document's metadata, rather than rewriting the whole file.
+
+Documents are written by the app's workers and by scripts like `apply_predictors.py`, possibly at
+the same time, and read by the app while they're written. Writers hold an exclusive lock on the
+document (`document_lock`), and readers a shared one; full saves are written to a temporary file
+that then replaces the document, so a document is never seen half-written.
+"""
+
+from contextlib import contextmanager
+import fcntl
+from io import BytesIO
+import json
+import os
+from threading import Lock, get_ident
+from typing import Any, Iterator, Optional, Union
+import warnings
+import zipfile
+
+import numpy as np
+from papermage.magelib import (
+    Document,
+    EntitiesFieldName,
+    Entity,
+    ImagesFieldName,
+    Layer,
+    Metadata,
+    MetadataFieldName,
+    SymbolsFieldName,
+)
+
+from papermage_components.page_images import (
+    PAGE_IMAGES_METADATA_KEY,
+    attach_page_images,
+    has_page_images,
+    update_page_image_directory,
+    write_page_images,
+)
+
+BINARY_DOCUMENT_SUFFIX = ".npz"
+JSON_DOCUMENT_SUFFIX = ".json"
+DOCUMENT_SUFFIXES = [BINARY_DOCUMENT_SUFFIX, JSON_DOCUMENT_SUFFIX]
+
+FORMAT_VERSION = 1
+
+FORMAT_VERSION_KEY = "format_version"
+SYMBOLS_KEY = "symbols"
+DOCUMENT_KEY = "document"
+LAYER_NAMES_KEY = "layer_names"
+LAYER_FIELDS = ["span_offsets", "spans", "box_offsets", "boxes", "box_pages", "entities"]
+
+
+@contextmanager
+def document_lock(path: Union[str, os.PathLike], shared: bool = False) -> Iterator[None]:
+    """Hold a lock on the document stored at `path`: exclusive to write it, shared to read it. The
+    lock is taken on a separate `<path>.lock` file, as saving replaces the document's file."""
+    with open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def encode_json(obj: Any) -> np.ndarray:
+    return np.frombuffer(json.dumps(obj).encode("utf-8"), dtype=np.uint8)
+
+
+def decode_json(array: np.ndarray) -> Any:
+    return json.loads(array.tobytes().decode("utf-8"))
+
+
+def layer_key(layer_index: int, field: str) -> str:
+    return f"layers/{layer_index}/{field}"
+
+
+def encode_layer(entity_jsons: list[dict]) -> dict[str, np.ndarray]:
+    """Convert a list of serialized entities into columnar arrays.
+
+    Spans become an (n_spans, 2) int64 array, boxes an (n_boxes, 4) float64 array plus an int32
+    page array, each indexed by an (n_entities + 1) offset array. Everything else on the entity is
+    kept in a JSON list, one dict per entity.
+    """
+    span_counts = np.zeros(len(entity_jsons), dtype=np.int64)
+    box_counts = np.zeros(len(entity_jsons), dtype=np.int64)
+    spans = []
+    boxes = []
+    remainders = []
+    for i, entity_json in enumerate(entity_jsons):
+        entity_spans = entity_json.get("spans", [])
+        entity_boxes = entity_json.get("boxes", [])
+        span_counts[i] = len(entity_spans)
+        box_counts[i] = len(entity_boxes)
+        spans.extend(entity_spans)
+        boxes.extend(entity_boxes)
+        remainders.append({k: v for k, v in entity_json.items() if k not in ("spans", "boxes")})
+
+    box_array = np.array(boxes, dtype=np.float64).reshape(-1, 5)
+    return {
+        "span_offsets": np.concatenate([[0], np.cumsum(span_counts)]),
+        "spans": np.array(spans, dtype=np.int64).reshape(-1, 2),
+        "box_offsets": np.concatenate([[0], np.cumsum(box_counts)]),
+        "boxes": box_array[:, :4],
+        "box_pages": box_array[:, 4].astype(np.int32),
+        "entities": encode_json(remainders),
+    }
+
+
+def decode_layer(arrays: dict[str, np.ndarray]) -> list[dict]:
+    """Inverse of `encode_layer`: rebuild the list of serialized entities."""
+    span_offsets = arrays["span_offsets"].tolist()
+    box_offsets = arrays["box_offsets"].tolist()
+    spans = arrays["spans"].tolist()
+    boxes = arrays["boxes"].tolist()
+    box_pages = arrays["box_pages"].tolist()
+    remainders = decode_json(arrays["entities"])
+
+    entity_jsons = []
+    for i, remainder in enumerate(remainders):
+        entity_json = {}
+        entity_spans = spans[span_offsets[i] : span_offsets[i + 1]]
+        if entity_spans:
+            entity_json["spans"] = entity_spans
+        entity_boxes = [
+            box + [page]
+            for box, page in zip(
+                boxes[box_offsets[i] : box_offsets[i + 1]],
+                box_pages[box_offsets[i] : box_offsets[i + 1]],
+            )
+        ]
+        if entity_boxes:
+            entity_json["boxes"] = entity_boxes
+        entity_json.update(remainder)
+        entity_jsons.append(entity_json)
+    return entity_jsons
+
+
+def document_json_to_arrays(doc_json: dict) -> dict[str, np.ndarray]:
+    layer_names = list(doc_json[EntitiesFieldName].keys())
+    arrays = {
+        FORMAT_VERSION_KEY: np.array([FORMAT_VERSION], dtype=np.int32),
+        SYMBOLS_KEY: np.frombuffer(doc_json[SymbolsFieldName].encode("utf-8"), dtype=np.uint8),
+        DOCUMENT_KEY: encode_json(
+            {k: v for k, v in doc_json.items() if k not in (SymbolsFieldName, EntitiesFieldName)}
+        ),
+        LAYER_NAMES_KEY: encode_json(layer_names),
+    }
+    for i, layer_name in enumerate(layer_names):
+        for field, array in encode_layer(doc_json[EntitiesFieldName][layer_name]).items():
+            arrays[layer_key(i, field)] = array
+    return arrays
+
+
+def arrays_to_document_json(arrays) -> dict:
+    """Rebuild the output of `Document.to_json` from the arrays of a binary document. `arrays` can
+    be any mapping from key to array, including the lazy `NpzFile` returned by `np.load`."""
+    check_format_version(arrays)
+    doc_json = {SymbolsFieldName: arrays[SYMBOLS_KEY].tobytes().decode("utf-8")}
+    doc_json.update(decode_json(arrays[DOCUMENT_KEY]))
+    doc_json[EntitiesFieldName] = {}
+    for i, layer_name in enumerate(decode_json(arrays[LAYER_NAMES_KEY])):
+        layer_arrays = {field: arrays[layer_key(i, field)] for field in LAYER_FIELDS}
+        doc_json[EntitiesFieldName][layer_name] = decode_layer(layer_arrays)
+    return doc_json
+
+
+def check_format_version(arrays) -> None:
+    version = int(arrays[FORMAT_VERSION_KEY][0])
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported binary document format version: {version}")
+
+
+class LazyDocument(Document):
+    """A Document backed by a binary document, that only decodes a layer on first access.
+
+    Each array of the `.npz` container is a separate member of a zip file, so the zip's central
+    directory serves as an offset index: opening the document only reads the symbols, metadata and
+    layer names, and e.g. `doc.tokens` is decompressed and built the first time it's used.
+    """
+
+    def __init__(self, arrays, symbols: str, metadata: Metadata, layer_names: list[str]):
+        super().__init__(symbols=symbols, metadata=metadata)
+        self._arrays = arrays
+        self._unloaded_layers = {name: i for i, name in enumerate(layer_names)}
+        self._layers = list(layer_names)
+        self._load_lock = Lock()
+
+    @classmethod
+    def from_path(cls, path: Union[str, os.PathLike]) -> "LazyDocument":
+        # read the whole (compressed) file up front, so that we don't hold the file open, or
+        # read from a file that's been rewritten since.
+        with document_lock(path, shared=True), open(path, "rb") as f:
+            arrays = np.load(BytesIO(f.read()), allow_pickle=False)
+        check_format_version(arrays)
+        document_fields = decode_json(arrays[DOCUMENT_KEY])
+        return cls(
+            arrays,
+            symbols=arrays[SYMBOLS_KEY].tobytes().decode("utf-8"),
+            metadata=Metadata(**document_fields.get(MetadataFieldName, {})),
+            layer_names=decode_json(arrays[LAYER_NAMES_KEY]),
+        )
+
+    def is_loaded(self, name: str) -> bool:
+        return name not in self._unloaded_layers
+
+    def get_layer_arrays(self, name: str) -> dict[str, np.ndarray]:
+        layer_index = self._unloaded_layers[name]
+        return {field: self._arrays[layer_key(layer_index, field)] for field in LAYER_FIELDS}
+
+    def _load_layer(self, name: str) -> Layer:
+        with self._load_lock:
+            if name in self.__dict__:
+                return self.__dict__[name]
+            entity_jsons = decode_layer(self.get_layer_arrays(name))
+            layer = Layer(entities=[Entity.from_json(entity_json) for entity_json in entity_jsons])
+            layer.doc = self
+            layer.name = name
+            setattr(self, name, layer)
+            del self._unloaded_layers[name]
+            return layer
+
+    def __getattr__(self, name: str):
+        # only called when normal attribute lookup fails, i.e. for layers that aren't loaded yet.
+        if name in self.__dict__.get("_unloaded_layers", {}):
+            return self._load_layer(name)
+        raise AttributeError(f"{self.__class__.__name__} has no attribute or layer {name}")
+
+    def remove_layer(self, name: str):
+        if name in self._unloaded_layers:
+            del self._unloaded_layers[name]
+            self._layers.remove(name)
+        else:
+            super().remove_layer(name)
+
+
+def layer_has_boxes(doc: Document, name: str) -> bool:
+    """Whether every entity in a layer has at least one box, without loading the layer if possible."""
+    if isinstance(doc, LazyDocument) and not doc.is_loaded(name):
+        return bool(np.all(np.diff(doc.get_layer_arrays(name)["box_offsets"]) > 0))
+    return all(entity.boxes for entity in doc.get_layer(name))
+
+
+def write_binary_document(doc_json: dict, path: Union[str, os.PathLike]) -> None:
+    # write through a file handle, so that numpy doesn't append its own suffix to the path.
+    temp_path = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        np.savez_compressed(f, **document_json_to_arrays(doc_json))
+    os.replace(temp_path, path)
+
+
+def read_binary_document(path: Union[str, os.PathLike]) -> dict:
+    with document_lock(path, shared=True), np.load(path, allow_pickle=False) as arrays:
+        return arrays_to_document_json(arrays)
+
+
+def strip_images(doc_json: dict) -> dict:
+    """Remove inline images from a serialized document, both document-level and per-entity."""
+    doc_json.pop(ImagesFieldName, None)
+    for entity_jsons in doc_json[EntitiesFieldName].values():
+        for entity_json in entity_jsons:
+            entity_json.pop(ImagesFieldName, None)
+    return doc_json
+
+
+def save_document(
+    doc: Document, path: Union[str, os.PathLike], page_image_dir: Optional[str] = None
+) -> None:
+    """Serialize a document to `path`, in the binary format if the path ends with `.npz`, and as
+    JSON otherwise.
+
+    If `page_image_dir` is given, page images are written there as separate files, and the
+    document only keeps a reference to them. Documents that were loaded with external page images
+    keep referencing them.
+    """
+    document_dir = os.path.dirname(os.path.abspath(path))
+    if page_image_dir is not None and has_page_images(doc):
+        write_page_images(doc, page_image_dir, relative_to=document_dir)
+    else:
+        update_page_image_directory(doc, relative_to=document_dir)
+
+    doc_json = doc.to_json()
+    if PAGE_IMAGES_METADATA_KEY in doc.metadata:
+        strip_images(doc_json)
+
+    with document_lock(path):
+        if str(path).endswith(BINARY_DOCUMENT_SUFFIX):
+            write_binary_document(doc_json, path)
+        else:
+            temp_path = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(doc_json, f, indent=4)
+            os.replace(temp_path, path)
+
+
+def append_layers(doc: Document, path: Union[str, os.PathLike], layer_names: list[str]) -> None:
+    """Save the given layers of a document, and its metadata, to the document previously saved at
+    `path`, keeping the other layers stored there. Layers that are already stored are replaced.
+
+    Binary documents are zip containers, so the layers are appended to the file as new members,
+    and the rest of it is left as it is. The layer names and document fields are small, and are
+    appended again too; the zip's central directory then points at the newest copy of each, which
+    is the one that's read. The stale copies take up space until the document is next saved with
+    `save_document`. JSON documents are rewritten in full.
+    """
+    if not str(path).endswith(BINARY_DOCUMENT_SUFFIX):
+        save_document(doc, path)
+        return
+
+    layer_names = list(dict.fromkeys(layer_names))
+    update_page_image_directory(doc, relative_to=os.path.dirname(os.path.abspath(path)))
+    doc_json = doc.to_json(layers=layer_names)
+    if PAGE_IMAGES_METADATA_KEY in doc.metadata:
+        strip_images(doc_json)
+
+    with document_lock(path), zipfile.ZipFile(
+        path, "a", compression=zipfile.ZIP_DEFLATED
+    ) as archive:
+        with archive.open(f"{FORMAT_VERSION_KEY}.npy") as f:
+            check_format_version({FORMAT_VERSION_KEY: np.lib.format.read_array(f)})
+        with archive.open(f"{LAYER_NAMES_KEY}.npy") as f:
+            stored_layer_names = decode_json(np.lib.format.read_array(f))
+
+        arrays = {}
+        for layer_name in layer_names:
+            if layer_name not in stored_layer_names:
+                stored_layer_names.append(layer_name)
+            layer_index = stored_layer_names.index(layer_name)
+            for field, array in encode_layer(doc_json[EntitiesFieldName][layer_name]).items():
+                arrays[layer_key(layer_index, field)] = array
+        arrays[LAYER_NAMES_KEY] = encode_json(stored_layer_names)
+        arrays[DOCUMENT_KEY] = encode_json(
+            {k: v for k, v in doc_json.items() if k not in (SymbolsFieldName, EntitiesFieldName)}
+        )
+
+        with warnings.catch_warnings():
+            # zipfile warns about each member that's written again under the same name.
+            warnings.simplefilter("ignore", UserWarning)
+            for key, array in arrays.items():
+                # the same member layout as np.savez.
+                with archive.open(f"{key}.npy", "w", force_zip64=True) as f:
+                    np.lib.format.write_array(f, array, allow_pickle=False)
+
+
+def load_document_json(path: Union[str, os.PathLike]) -> dict:
+    if str(path).endswith(BINARY_DOCUMENT_SUFFIX):
+        return read_binary_document(path)
+    with document_lock(path, shared=True), open(path) as f:
+        return json.load(f)
+
+
+def load_document(path: Union[str, os.PathLike], lazy: bool = False) -> Document:
+    """Load a document saved with `save_document`, in either format. With `lazy`, binary documents
+    are loaded as a `LazyDocument`; JSON documents have to be parsed in full either way."""
+    if lazy and str(path).endswith(BINARY_DOCUMENT_SUFFIX):
+        doc = LazyDocument.from_path(path)
+    else:
+        doc = Document.from_json(load_document_json(path))
+    attach_page_images(doc, os.path.dirname(os.path.abspath(path)))
+    return doc
+
+
+def list_documents(folder: str, preferred_suffix: str = BINARY_DOCUMENT_SUFFIX) -> list[str]:
+    """List the documents in a folder. If a document has been saved in more than one format, e.g.
+    after converting it to binary, only the preferred format is listed."""
+    by_stem = {}
+    for filename in sorted(os.listdir(folder)):
+        stem, suffix = os.path.splitext(filename)
+        if suffix not in DOCUMENT_SUFFIXES:
+            continue
+        if stem not in by_stem or suffix == preferred_suffix:
+            by_stem[stem] = filename
+    return list(by_stem.values())
+
+
+def convert_json_to_binary(json_path: str, binary_path: str = None) -> str:
+    """Convert an existing JSON document to the binary format, returning the new path."""
+    if binary_path is None:
+        binary_path = os.path.splitext(json_path)[0] + BINARY_DOCUMENT_SUFFIX
+    with open(json_path) as f:
+        doc_json = json.load(f)
+    write_binary_document(doc_json, binary_path)
+    return binary_path
@@ -0,0 +1,231 @@
+"""
+Shared HTTP sessions for the predictors that call backend services (GROBID, MatIE,
+ChemDataExtractor, MathPix).
+
+Each service gets one `requests.Session` per process, whose connection pool keeps connections to
+the service alive between calls, and a `ServicePolicy`: connect and read timeouts, how often
+failed requests (connection errors and 429/5xx responses) are retried with exponential backoff,
+how many requests per second may be sent to it, and when to stop calling the service altogether.
+Read timeouts aren't retried by default (`read_retries`): a call that timed out may still be
+running on the service, and retrying it would multiply the time lost to a hung backend. After
+`failure_threshold` calls in a row fail, even after retrying, the service's circuit breaker opens,
+and calls fail immediately with `CircuitOpenError` for `reset_seconds`; then a single trial call is
+let through, which closes the circuit again if it succeeds. A backend that hangs then costs each
+process at most `failure_threshold` read timeouts, rather than one for every remaining request of a
+batch run.
+"""
+
+from dataclasses import dataclass, replace
+import os
+import threading
+import time
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from papermage_components.instrumentation import add_count
+
+
+@dataclass(frozen=True)
+class ServicePolicy:
+    connect_timeout: float = 5.0
+    read_timeout: float = 300.0
+    # retries after the first attempt, waiting backoff_seconds * 2 ** (retry - 1) before each.
+    max_retries: int = 2
+    # retries of requests whose response timed out, out of max_retries.
+    read_retries: int = 0
+    backoff_seconds: float = 1.0
+    retry_statuses: tuple[int, ...] = (429, 500, 502, 503, 504)
+    # consecutive failed calls before the circuit opens, and how long it stays open.
+    failure_threshold: int = 5
+    reset_seconds: float = 60.0
+    # connections kept alive per host; at least as many as the threads calling the service.
+    pool_size: int = 10
+    # calls are spaced out to at most this many per second, per process; None for no limit.
+    max_requests_per_second: Optional[float] = None
+
+    @property
+    def timeout(self) -> tuple[float, float]:
+        return (self.connect_timeout, self.read_timeout)
+
+
+SERVICE_POLICIES: dict[str, ServicePolicy] = {
+    # GROBID answers 503 while all its workers are busy, so it gets more, longer retries.
+    "grobid": ServicePolicy(read_timeout=300.0, max_retries=4, backoff_seconds=2.0),
+    "matie": ServicePolicy(read_timeout=600.0),
+    "chemdataextractor": ServicePolicy(read_timeout=300.0),
+    # MathPix allows 200 requests a minute by default, and answers 429 beyond that.
+    "mathpix": ServicePolicy(read_timeout=60.0, max_retries=3, max_requests_per_second=3.0),
+}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service whose circuit breaker is open."""
+
+
+class CircuitBreaker:
+    def __init__(self, service: str, failure_threshold: int, reset_seconds: float):
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def before_call(self) -> None:
+        """Raise `CircuitOpenError` if the service shouldn't be called right now."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            seconds_open = time.monotonic() - self.opened_at
+            if seconds_open < self.reset_seconds or self.trial_in_progress:
+                raise CircuitOpenError(
+                    f"{self.service} failed {self.consecutive_failures} times in a row; not "
+                    f"calling it for another {max(self.reset_seconds - seconds_open, 0):.0f}s."
+                )
+            # let one call through, to find out whether the service has recovered.
+            self.trial_in_progress = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.trial_in_progress or self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_in_progress = False
+
+
+class RateLimiter:
+    """Spaces out calls, from any number of threads, to at most `max_per_second`."""
+
+    def __init__(self, max_per_second: float):
+        self.interval = 1.0 / max_per_second
+        self.next_call_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            call_at = max(now, self.next_call_at)
+            self.next_call_at = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
+
+
+_sessions: dict[str, requests.Session] = {}
+_circuit_breakers: dict[str, CircuitBreaker] = {}
+_rate_limiters: dict[str, Optional[RateLimiter]] = {}
+_sessions_pid: Optional[int] = None
+_sessions_lock = threading.Lock()
+
+
+def _reset_after_fork() -> None:
+    # connections (and their locks) can't be shared with forked workers, which start afresh.
+    global _sessions_pid
+    if _sessions_pid != os.getpid():
+        _sessions.clear()
+        _circuit_breakers.clear()
+        _rate_limiters.clear()
+        _sessions_pid = os.getpid()
+
+
+def get_service_policy(service: str) -> ServicePolicy:
+    return SERVICE_POLICIES.get(service, ServicePolicy())
+
+
+def set_service_policy(service: str, **changes) -> ServicePolicy:
+    """Change some of a service's policy, e.g. `set_service_policy("matie", read_timeout=60)`.
+    Sessions created from the old policy are discarded."""
+    with _sessions_lock:
+        SERVICE_POLICIES[service] = replace(get_service_policy(service), **changes)
+        _sessions.pop(service, None)
+        _circuit_breakers.pop(service, None)
+        _rate_limiters.pop(service, None)
+        return SERVICE_POLICIES[service]
+
+
+def get_session(service: str) -> requests.Session:
+    with _sessions_lock:
+        _reset_after_fork()
+        if service not in _sessions:
+            policy = get_service_policy(service)
+            retry = Retry(
+                total=policy.max_retries,
+                read=policy.read_retries,
+                backoff_factor=policy.backoff_seconds,
+                status_forcelist=policy.retry_statuses,
+                # the services' POST endpoints only annotate, so they're safe to retry.
+                allowed_methods=None,
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=policy.pool_size, max_retries=retry
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[service] = session
+        return _sessions[service]
+
+
+def get_circuit_breaker(service: str) -> CircuitBreaker:
+    with _sessions_lock:
+        _reset_after_fork()
+        if service not in _circuit_breakers:
+            policy = get_service_policy(service)
+            _circuit_breakers[service] = CircuitBreaker(
+                service, policy.failure_threshold, policy.reset_seconds
+            )
+        return _circuit_breakers[service]
+
+
+def get_rate_limiter(service: str) -> Optional[RateLimiter]:
+    with _sessions_lock:
+        _reset_after_fork()
+        if service not in _rate_limiters:
+            max_per_second = get_service_policy(service).max_requests_per_second
+            _rate_limiters[service] = RateLimiter(max_per_second) if max_per_second else None
+        return _rate_limiters[service]
+
+
+def service_post(service: str, url: str, **kwargs) -> requests.Response:
+    """POST to a service through its pooled session, with its policy's timeouts and retries.
+    Raises `requests.HTTPError` for error statuses that remain after retrying, and
+    `CircuitOpenError` if the service has been failing."""
+    circuit_breaker = get_circuit_breaker(service)
+    circuit_breaker.before_call()
+    kwargs.setdefault("timeout", get_service_policy(service).timeout)
+    rate_limiter = get_rate_limiter(service)
+    if rate_limiter is not None:
+        rate_limiter.wait()
+    try:
+        response = get_session(service).post(url, **kwargs)
+        retries = response.raw.retries.history if response.raw.retries else ()
+        if retries:
+            add_count("retries", len(retries))
+        response.raise_for_status()
+    except requests.HTTPError as e:
+        # the request reached the service, and was rejected: only server errors count against it.
+        if e.response.status_code >= 500:
+            circuit_breaker.record_failure()
+        else:
+            circuit_breaker.record_success()
+        raise
+    except Exception:
+        circuit_breaker.record_failure()
+        raise
+    circuit_breaker.record_success()
+    return response
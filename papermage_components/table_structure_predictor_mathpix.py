@@ -1,24 +1,35 @@
 import base64
 import csv
+import hashlib
 import io
+import json
+import os
+import tempfile
+from typing import Optional
 
 import pandas as pd
-import requests
 
 from papermage import TablesFieldName
+from papermage_components.instrumentation import add_count
 from papermage_components.interfaces.image_predictor import ImagePredictionResult, ImagePredictorABC
+from papermage_components.service_sessions import service_post
 
 
 MATHPIX_ENDPOINT = "https://api.mathpix.com/v3/text"
 
 
+MATHPIX_OPTIONS = {
+    "formats": ["text", "data"],
+    "data_options": {
+        "include_tsv": True,
+    },
+}
+
+
 def get_mathpix_input(encoded_image):
     json_data = {
         "src": f"data:image/jpeg;base64,{encoded_image}",
-        "formats": ["text", "data"],
-        "data_options": {
-            "include_tsv": True,
-        },
+        **MATHPIX_OPTIONS,
     }
     return json_data
 
@@ -77,11 +88,66 @@ def convert_mathpix_to_json(tsv_string, latex_input):
     return table_dict
 
 
+def get_image_hash(pil_image) -> str:
+    """A hash of the image's pixels, and of the options it's sent to MathPix with."""
+    hasher = hashlib.sha256(f"{pil_image.mode}:{pil_image.size}".encode("utf-8"))
+    hasher.update(pil_image.tobytes())
+    hasher.update(json.dumps(MATHPIX_OPTIONS, sort_keys=True).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class MathPixResponseCache:
+    """MathPix responses, stored on disk as `<cache_dir>/<image hash>.json`, so that a table that's
+    already been parsed, e.g. when a paper is reprocessed, isn't sent (and paid for) again."""
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, image_hash: str) -> str:
+        return os.path.join(self.cache_dir, f"{image_hash}.json")
+
+    def get(self, image_hash: str) -> Optional[dict]:
+        try:
+            with open(self._path(image_hash)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def put(self, image_hash: str, response_data: dict) -> None:
+        # written to a temporary file first, so concurrent workers never read a partial response.
+        # The temporary file's name is unique, as threads of one process may store the same image.
+        with tempfile.NamedTemporaryFile("w", dir=self.cache_dir, suffix=".tmp", delete=False) as f:
+            json.dump(response_data, f)
+        os.replace(f.name, self._path(image_hash))
+
+
 class MathPixTableStructurePredictor(ImagePredictorABC):
-    def __init__(self, mathpix_headers, expansion_value=0.01):
-        super().__init__(entity_to_process=TablesFieldName, find_caption=True)
+    def __init__(
+        self,
+        mathpix_headers,
+        expansion_value=0.01,
+        dpi=300,
+        mathpix_url=MATHPIX_ENDPOINT,
+        cache_dir: Optional[str] = None,
+        max_concurrent_requests: int = 8,
+    ):
+        """Init.
+
+        Parameters
+        ----------
+        mathpix_headers : The MathPix app_id and app_key.
+        cache_dir : Where to keep MathPix's responses, keyed by a hash of the table image. If None,
+            nothing is cached.
+        max_concurrent_requests : How many tables are sent to MathPix at once. The rate at which
+            they're sent is limited by the "mathpix" service policy.
+        """
+        super().__init__(entity_to_process=TablesFieldName, find_caption=True, dpi=dpi)
         self.expand_ratio = expansion_value
         self.headers = mathpix_headers
+        self.mathpix_url = mathpix_url
+        self.cache = MathPixResponseCache(cache_dir) if cache_dir else None
+        self.max_concurrent_images = max_concurrent_requests
 
     @property
     def predictor_identifier(self) -> str:
@@ -91,13 +157,30 @@ class MathPixTableStructurePredictor(ImagePredictorABC):
     def preferred_layer_name(self) -> str:
         return f"TAGGED_IMAGE_{self.predictor_identifier}"
 
+    def get_response_data(self, image) -> dict:
+        image_hash = None
+        if self.cache:
+            image_hash = get_image_hash(image)
+            response_data = self.cache.get(image_hash)
+            if response_data is not None:
+                add_count("cache_hits")
+                return response_data
+
+        math_pix_input = get_mathpix_input(encode_image(image))
+        add_count("requests")
+        response = service_post(
+            "mathpix", self.mathpix_url, headers=self.headers, json=math_pix_input
+        )
+        response_data = response.json()
+        if "error_info" in response_data.keys():
+            raise Exception(f"MathPix failed to parse a table!: {response_data['error_info']}")
+        if self.cache:
+            self.cache.put(image_hash, response_data)
+        return response_data
+
     def process_image(self, image) -> ImagePredictionResult:
         try:
-            math_pix_input = get_mathpix_input(encode_image(image))
-            response = requests.post(MATHPIX_ENDPOINT, headers=self.headers, json=math_pix_input)
-            response_data = response.json()
-            if "error_info" in response_data.keys():
-                raise Exception(f"MathPix failed to parse a table!: {response_data['error_info']}")
+            response_data = self.get_response_data(image)
             tsv_data = response_data["data"][0]["value"]
             latex_data = response_data["text"]
             json_data = convert_mathpix_to_json(tsv_data, latex_data)
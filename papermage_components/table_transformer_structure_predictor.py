@@ -140,8 +140,8 @@ def convert_table_mapping_to_boxes_and_text(
 
 
 class TableTransformerStructurePredictor(ImagePredictorABC):
-    def __init__(self, model, device, w_shrink=0.95, h_shrink=0.5):
-        super().__init__(TablesFieldName)
+    def __init__(self, model, device, w_shrink=0.95, h_shrink=0.5, dpi=200):
+        super().__init__(TablesFieldName, dpi=dpi)
         self.model = model.to(device)
         self.w_shrink = w_shrink
         self.h_shrink = h_shrink
@@ -1,14 +1,37 @@
 import itertools
+import re
 from typing import Optional
 
 from ncls import NCLS
 import numpy as np
 
-from papermage import Document, Box, Entity, Span
+from papermage import Document, Box, Entity, Span, TokensFieldName, WordsFieldName
 from papermage.utils.merge import cluster_and_merge_neighbor_spans
 from papermage.visualizers import plot_entities_on_page
 
 from papermage_components.constants import MAT_IE_TYPES
+from papermage_components.page_images import LazyImage, LazyRasterizedPage
+
+
+def normalize_entity_string(entity_string: str):
+    return entity_string.replace("-\n", "").replace("\n", " ")
+
+
+# entity types whose case is meaningful (e.g. "Co" and "CO"), so it's kept when canonicalizing.
+CASE_SENSITIVE_ENTITY_TYPES = {"Material", "Number"}
+_dashes_re = re.compile("[\u2010-\u2015\u2212]")
+_whitespace_re = re.compile(r"\s+")
+
+
+def canonicalize_entity_string(entity_string: str, entity_type: Optional[str] = None) -> str:
+    """The form of an entity's text under which mentions from different papers are merged: line
+    breaks removed as in `normalize_entity_string`, whitespace collapsed, dashes unified, and case
+    folded for entity types whose case isn't meaningful."""
+    canonical = normalize_entity_string(entity_string)
+    canonical = _whitespace_re.sub(" ", _dashes_re.sub("-", canonical)).strip(" .,;:")
+    if entity_type not in CASE_SENSITIVE_ENTITY_TYPES:
+        canonical = canonical.casefold()
+    return canonical
 
 
 def get_spans_from_boxes(doc: Document, boxes: list[Box]):
@@ -21,6 +44,60 @@ def get_spans_from_boxes(doc: Document, boxes: list[Box]):
     return filtered_for_strays
 
 
+def get_spans_from_box_groups(doc: Document, box_groups: list[list[Box]]) -> list[list[Span]]:
+    """`get_spans_from_boxes` for many groups of boxes at once.
+
+    Rather than scanning every token once per box, the token boxes are gathered into arrays once,
+    and each page's tokens are tested against all the query boxes on that page together.
+    """
+    tokens = doc.get_layer(TokensFieldName).entities
+    token_l, token_t, token_r, token_b, token_page, token_ids = get_box_arrays(tokens)
+    query_l, query_t, query_r, query_b, query_page, query_groups = get_box_arrays(
+        [Entity(boxes=boxes) for boxes in box_groups]
+    )
+
+    # token boxes, sorted by page, so each page's tokens are a contiguous slice.
+    page_order = np.argsort(token_page, kind="stable")
+    token_l, token_t, token_r, token_b, token_page, token_ids = (
+        array[page_order] for array in (token_l, token_t, token_r, token_b, token_page, token_ids)
+    )
+
+    matched_groups = []
+    matched_tokens = []
+    for page in np.unique(query_page):
+        lo, hi = np.searchsorted(token_page, [page, page + 1])
+        on_page = np.flatnonzero(query_page == page)
+        # the same test as papermage's box indexer, for every (query box, token box) pair.
+        overlaps = (
+            (token_l[None, lo:hi] <= query_r[on_page, None])
+            & (token_r[None, lo:hi] >= query_l[on_page, None])
+            & (token_t[None, lo:hi] <= query_b[on_page, None])
+            & (token_b[None, lo:hi] >= query_t[on_page, None])
+        )
+        query_index, token_index = np.nonzero(overlaps)
+        matched_groups.append(query_groups[on_page[query_index]])
+        matched_tokens.append(token_ids[lo + token_index])
+
+    tokens_by_group = [[] for _ in box_groups]
+    if matched_groups:
+        # unique (group, token) pairs, with each group's tokens in document order.
+        pairs = np.unique(
+            np.column_stack([np.concatenate(matched_groups), np.concatenate(matched_tokens)]),
+            axis=0,
+        )
+        for group_id, token_id in pairs:
+            tokens_by_group[group_id].append(tokens[token_id])
+
+    group_spans = []
+    for group_tokens in tokens_by_group:
+        token_spans = list(itertools.chain(*(token.spans for token in group_tokens)))
+        clustered_token_spans = cluster_and_merge_neighbor_spans(token_spans).merged
+        group_spans.append(
+            [merged for merged in clustered_token_spans if merged.end - merged.start > 1]
+        )
+    return group_spans
+
+
 def get_span_by_box(box, doc) -> Optional[Span]:
     overlapping_tokens = doc.intersect_by_box(Entity(boxes=[box]), "tokens")
     token_spans = []
@@ -38,7 +115,11 @@ def get_text_in_box(box, doc):
 
 
 def globalize_bbox_coordinates(bbox, context_box, doc):
-    page_width, page_height = doc.pages[context_box.page].images[0].pilimage.size
+    page_image = doc.pages[context_box.page].images[0]
+    # a lazy page knows its size without being rasterized.
+    page_width, page_height = (
+        page_image.size if isinstance(page_image, LazyImage) else page_image.pilimage.size
+    )
     bbox_left = context_box.l + (bbox[0] / page_width)
     bbox_top = context_box.t + (bbox[1] / page_height)
     bbox_width = (bbox[2] - bbox[0]) / page_width
@@ -47,7 +128,6 @@ def globalize_bbox_coordinates(bbox, context_box, doc):
 
 
 def globalize_box_coordinates(box: Box, context_box: Box, doc):
-    page_width, page_height = doc.pages[context_box.page].images[0].pilimage.size
     bbox_left = context_box.l + (box.l * context_box.w)
     bbox_top = context_box.t + (box.t * context_box.h)
     bbox_width = box.w * context_box.w
@@ -55,6 +135,157 @@ def globalize_box_coordinates(box: Box, context_box: Box, doc):
     return Box(bbox_left, bbox_top, bbox_width, bbox_height, page=context_box.page)
 
 
+def get_span_arrays(entities: list[Entity]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Flatten the spans of a list of entities into (starts, ends, entity_ids) arrays, sorted by
+    span start. For a disjoint layer, like tokens or words, ends are sorted as well."""
+    starts = []
+    ends = []
+    ids = []
+    for entity_id, entity in enumerate(entities):
+        for span in entity.spans:
+            starts.append(span.start)
+            ends.append(span.end)
+            ids.append(entity_id)
+
+    starts = np.array(starts, dtype=np.int64)
+    ends = np.array(ends, dtype=np.int64)
+    ids = np.array(ids, dtype=np.int64)
+    order = np.argsort(starts, kind="stable")
+    return starts[order], ends[order], ids[order]
+
+
+def get_box_arrays(
+    entities: list[Entity],
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Flatten the boxes of a list of entities into (lefts, tops, rights, bottoms, pages,
+    entity_ids) arrays."""
+    boxes = [(box, entity_id) for entity_id, entity in enumerate(entities) for box in entity.boxes]
+    return (
+        np.array([box.l for box, _ in boxes], dtype=np.float64),
+        np.array([box.t for box, _ in boxes], dtype=np.float64),
+        np.array([box.l + box.w for box, _ in boxes], dtype=np.float64),
+        np.array([box.t + box.h for box, _ in boxes], dtype=np.float64),
+        np.array([box.page for box, _ in boxes], dtype=np.int64),
+        np.array([entity_id for _, entity_id in boxes], dtype=np.int64),
+    )
+
+
+def find_overlapping_ranges(
+    layer_starts: np.ndarray, layer_ends: np.ndarray, query_starts: np.ndarray, query_ends: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """For each query span, get the [lo, hi) range of the spans of a disjoint, sorted layer that
+    overlap it. Empty ranges have lo == hi."""
+    lo = np.searchsorted(layer_ends, query_starts, side="right")
+    hi = np.searchsorted(layer_starts, query_ends, side="left")
+    return lo, np.maximum(lo, hi)
+
+
+def _reduce_ranges(ufunc, values: np.ndarray, lo: np.ndarray, hi: np.ndarray, fill) -> np.ndarray:
+    if len(lo) == 0:
+        return np.empty(0, dtype=values.dtype)
+    # reduceat over interleaved [lo, hi) pairs; the appended fill value makes hi == len valid.
+    padded = np.append(values, fill).astype(values.dtype)
+    reduced = ufunc.reduceat(padded, np.column_stack([lo, hi]).ravel())[::2]
+    return np.where(hi > lo, reduced, fill)
+
+
+def set_boxes_and_text_from_tokens(entities: list[Entity], doc: Document) -> None:
+    """Set the box of each entity to the box enclosing its tokens, and its text to the text of
+    its words, as `make_text` would.
+
+    This is equivalent to calling `doc.intersect_by_span` and `make_text` on each entity, but
+    does all the interval lookups at once against flat arrays of the token and word spans.
+    Entities that overlap no tokens keep their existing boxes.
+    """
+    if not entities:
+        return
+
+    tokens = doc.get_layer(TokensFieldName)
+    token_l = np.full(len(tokens), np.inf)
+    token_t = np.full(len(tokens), np.inf)
+    token_r = np.full(len(tokens), -np.inf)
+    token_b = np.full(len(tokens), -np.inf)
+    token_page_min = np.full(len(tokens), np.iinfo(np.int64).max)
+    token_page_max = np.full(len(tokens), -1)
+    for i, token in enumerate(tokens):
+        if not token.boxes:
+            continue
+        token_l[i] = min(box.l for box in token.boxes)
+        token_t[i] = min(box.t for box in token.boxes)
+        token_r[i] = max(box.l + box.w for box in token.boxes)
+        token_b[i] = max(box.t + box.h for box in token.boxes)
+        token_page_min[i] = min(box.page for box in token.boxes)
+        token_page_max[i] = max(box.page for box in token.boxes)
+
+    query_starts, query_ends, query_ids = get_span_arrays(entities)
+
+    # enclosing boxes, first per query span, then per entity.
+    tok_starts, tok_ends, tok_ids = get_span_arrays(tokens.entities)
+    lo, hi = find_overlapping_ranges(tok_starts, tok_ends, query_starts, query_ends)
+    span_l = _reduce_ranges(np.minimum, token_l[tok_ids], lo, hi, np.inf)
+    span_t = _reduce_ranges(np.minimum, token_t[tok_ids], lo, hi, np.inf)
+    span_r = _reduce_ranges(np.maximum, token_r[tok_ids], lo, hi, -np.inf)
+    span_b = _reduce_ranges(np.maximum, token_b[tok_ids], lo, hi, -np.inf)
+    span_page_min = _reduce_ranges(
+        np.minimum, token_page_min[tok_ids], lo, hi, np.iinfo(np.int64).max
+    )
+    span_page_max = _reduce_ranges(np.maximum, token_page_max[tok_ids], lo, hi, -1)
+
+    entity_l = np.full(len(entities), np.inf)
+    entity_t = np.full(len(entities), np.inf)
+    entity_r = np.full(len(entities), -np.inf)
+    entity_b = np.full(len(entities), -np.inf)
+    entity_page_min = np.full(len(entities), np.iinfo(np.int64).max)
+    entity_page_max = np.full(len(entities), -1)
+    np.minimum.at(entity_l, query_ids, span_l)
+    np.minimum.at(entity_t, query_ids, span_t)
+    np.maximum.at(entity_r, query_ids, span_r)
+    np.maximum.at(entity_b, query_ids, span_b)
+    np.minimum.at(entity_page_min, query_ids, span_page_min)
+    np.maximum.at(entity_page_max, query_ids, span_page_max)
+
+    # words overlapping each entity, in document order.
+    words = doc.get_layer(WordsFieldName)
+    word_texts = [str(word.text) for word in words]
+    word_entity_starts = [word.start for word in words]
+    word_entity_ends = [word.end for word in words]
+    word_starts, word_ends, word_ids = get_span_arrays(words.entities)
+    word_lo, word_hi = find_overlapping_ranges(word_starts, word_ends, query_starts, query_ends)
+    words_by_entity = [[] for _ in entities]
+    for query_id, start, end in zip(query_ids, word_lo, word_hi):
+        if end > start:
+            words_by_entity[query_id].append(word_ids[start:end])
+
+    for i, entity in enumerate(entities):
+        if entity_page_max[i] >= 0:
+            if entity_page_min[i] != entity_page_max[i]:
+                raise ValueError(
+                    f"Boxes not all on same page. Pages={entity_page_min[i]}-{entity_page_max[i]}"
+                )
+            entity.boxes = [
+                Box(
+                    l=entity_l[i],
+                    t=entity_t[i],
+                    w=entity_r[i] - entity_l[i],
+                    h=entity_b[i] - entity_t[i],
+                    page=entity_page_min[i],
+                )
+            ]
+
+        entity_word_ids = (
+            np.unique(np.concatenate(words_by_entity[i])) if words_by_entity[i] else []
+        )
+        text_parts = []
+        for j, word_id in enumerate(entity_word_ids):
+            text_parts.append(word_texts[word_id])
+            if j < len(entity_word_ids) - 1:
+                current_end = word_entity_ends[word_id]
+                next_start = word_entity_starts[entity_word_ids[j + 1]]
+                if current_end != next_start:
+                    text_parts.append(doc.symbols[current_end:next_start])
+        entity.text = "".join(text_parts)
+
+
 def merge_overlapping_entities(entities):
     starts = []
     ends = []
@@ -162,10 +393,16 @@ def get_table_image(table_entity: Entity, doc: Document, page_image=None, expand
 def get_table_images(table_entity: Entity, doc: Document, page_image=None, expand_box_by=0.01):
     table_images = []
     for box in table_entity.boxes:
-        if page_image is None:
-            page_image = doc.pages[box.page].images[0].pilimage
-        page_w, page_h = page_image.size
-        table_image = page_image.crop(
+        box_page_image = page_image
+        if box_page_image is None:
+            doc_page_image = doc.pages[box.page].images[0]
+            if isinstance(doc_page_image, LazyRasterizedPage):
+                # render just the table at the page's DPI, rather than rasterizing the whole page.
+                table_images.append(doc_page_image.crop(box, expand_box_by))
+                continue
+            box_page_image = doc_page_image.pilimage
+        page_w, page_h = box_page_image.size
+        table_image = box_page_image.crop(
             (
                 (box.l - expand_box_by) * page_w,
                 (box.t - expand_box_by) * page_h,
@@ -2,12 +2,15 @@ from datetime import datetime
 import json
 import logging
 import os
+from typing import Optional
 
 import fire
 from tqdm.auto import tqdm
 
 from papermage import Document
+from papermage_components.forked_workers import map_with_forked_workers
 from papermage_components.materials_recipe import MaterialsRecipe
+from papermage_components.serialization import JSON_DOCUMENT_SUFFIX, save_document
 
 
 def get_doc_title(document: Document):
@@ -20,13 +23,42 @@ def get_doc_title(document: Document):
     return document_title
 
 
-def parse_papers_to_json(input_folder: str, output_folder: str, overwrite_if_present: bool = False):
+def parse_paper(recipe: MaterialsRecipe, task: tuple[str, str, str, str]) -> Optional[dict]:
+    """Parse and save a single paper, returning a description of the error if it failed."""
+    input_folder, pdf_filename, output_path, page_image_folder = task
+    try:
+        parsed_paper = recipe.from_pdf(os.path.join(input_folder, pdf_filename))
+        save_document(parsed_paper, output_path, page_image_dir=page_image_folder)
+    except Exception as e:
+        logging.error(f"Failed to parse paper {pdf_filename}", exc_info=True)
+        return {"filename": pdf_filename, "exception_type": str(type(e)), "error_message": str(e)}
+    return None
+
+
+def parse_papers_to_json(
+    input_folder: str,
+    output_folder: str,
+    overwrite_if_present: bool = False,
+    output_suffix: str = JSON_DOCUMENT_SUFFIX,
+    page_image_folder: str = None,
+    prewarm: bool = True,
+    num_workers: int = 1,
+):
+    """Parse every PDF in `input_folder` with the MaterialsRecipe.
+
+    With `num_workers` > 1, the models are loaded once, and that many worker processes are forked
+    from this one, sharing the loaded weights rather than each loading their own.
+    """
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     recipe = MaterialsRecipe(
         matIE_directory="/Users/sireeshgururaja/src/MatIE",
         grobid_server_url="http://windhoek.sp.cs.cmu.edu:8070",
         # chemdataextractor_url="http://windhoek.sp.cs.cmu.edu:8002",
     )
+    if prewarm or num_workers > 1:
+        # load every model up front, rather than partway through the first paper, and log how
+        # long each one took. Workers need the models loaded before they're forked to share them.
+        recipe.prewarm()
 
     pdf_list = [
         pdf_filename
@@ -34,23 +66,21 @@ def parse_papers_to_json(input_folder: str, output_folder: str, overwrite_if_pre
         if pdf_filename.lower().endswith(".pdf")
     ]
 
-    failed_files = []
-    for pdf_filename in tqdm(pdf_list):
-        output_path = os.path.join(output_folder, pdf_filename.lower().replace(".pdf", ".json"))
+    tasks = []
+    for pdf_filename in pdf_list:
+        output_path = os.path.join(output_folder, pdf_filename.lower().replace(".pdf", output_suffix))
 
         if os.path.exists(output_path) and not overwrite_if_present:
             print(f"File {output_path} already exists! Skipping parsing.")
             continue
+        tasks.append((input_folder, pdf_filename, output_path, page_image_folder))
+
+    if num_workers > 1:
+        results = map_with_forked_workers(parse_paper, recipe, tasks, num_workers)
+    else:
+        results = (parse_paper(recipe, task) for task in tasks)
+    failed_files = [result for result in tqdm(results, total=len(tasks)) if result is not None]
 
-        try:
-            parsed_paper = recipe.from_pdf(os.path.join(input_folder, pdf_filename))
-            with open(output_path, "w") as f:
-                json.dump(parsed_paper.to_json(), f, indent=4)
-        except Exception as e:
-            logging.error(f"Failed to parse paper {pdf_filename}", exc_info=True)
-            failed_files.append(
-                {"filename": pdf_filename, "exception_type": str(type(e)), "error_message": str(e)}
-            )
     with open(f"data/failed_files_{timestamp}.json", "w") as f:
         json.dump(
             {"input_folder": input_folder, "files": pdf_list, "errors": failed_files}, f, indent=4